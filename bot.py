@@ -1,7 +1,7 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputTextMessageContent, InlineQueryResultArticle, ReplyKeyboardMarkup, ReplyKeyboardRemove, ParseMode
-from telegram.ext import Updater, CommandHandler, CallbackContext, MessageHandler, Filters, InlineQueryHandler, CallbackQueryHandler, ConversationHandler, ChatMemberHandler
-from cashier import invoice, handle_payment, go_back, handle_screenshot, approve_invoice, decline_invoice, do_nothing, set_invoice_type_outgoing, set_invoice_type_incoming, generate_vip_invite_link
-from reports import reports, sales_book_report, clients_book_report, input_date, generate_sales_report, generate_clients_report, set_today, set_yesterday, set_this_month, set_this_week,  set_30_days, set_custom_period, START, INPUT_DATE, GENERATE_SALES_BOOK_REPORT, GENERATE_CLIENTS_BOOK_REPORT
+from telegram.ext import CommandHandler, CallbackContext, MessageHandler, Filters, InlineQueryHandler, CallbackQueryHandler, ConversationHandler, ChatMemberHandler
+from cashier import invoice, handle_payment, go_back, handle_screenshot, approve_invoice, decline_invoice, do_nothing, set_invoice_type_outgoing, set_invoice_type_incoming
+from reports import reports, sales_book_report, clients_book_report, input_date, generate_sales_report, generate_clients_report, set_today, set_yesterday, set_this_month, set_this_week,  set_30_days, set_custom_period, START, INPUT_DATE, GENERATE_SALES_BOOK_REPORT, GENERATE_CLIENTS_BOOK_REPORT, invalidate_reports, cohorts_report, salesmen_report
 from settings import conv_handler_payments_and_salesman, manage_salesman
 from config import PAYMENT_MANAGERS, SALES_MANAGERS, ANALYTICS, BOT_TOKEN, MANAGER_URL, PAYMENT_MESSAGE, VIP_PAYMENT_MESSAGE, I_PAID_TEXT, CONTACT_MANAGER_TEXT, BOT_CANCEL_TEXT, GROUP_ID, MY_VIP_TEXT, get_card_number, set_card_number
 from apscheduler.schedulers.background import BackgroundScheduler
@@ -10,6 +10,19 @@ import traceback
 import uuid
 import random
 import database
+import migrations
+import instrumentation
+import webhook
+import updates
+import outbox
+import expiry
+import persistence
+import leader
+import invites
+import report_jobs
+import revenue
+import config
+import sys
 import logging
 from datetime import datetime
 import json
@@ -37,18 +50,6 @@ def get_vip_payment_message(amount, subscription_length):
     
     return VIP_PAYMENT_MESSAGE.format(amount=amount, subscription_length=subscription_length, bank=bank, card_number=card_number)
 
-def generate_invoice_id():
-    invoice_id = int(database.get_latest_invoice_id()) + 1
-    while database.check_invoice_id(invoice_id):
-        invoice_id += 1
-
-    # Log created invoice_id
-    logger.info(f'Generated unique invoice_id={invoice_id}')
-
-    return invoice_id
-
-
-
 def start(update: Update, context: CallbackContext) -> None:
     user = update.effective_user
     name = f"{user.first_name} {user.last_name}" if user.last_name else user.first_name
@@ -92,10 +93,8 @@ def handle_payment_start_command(start_data, user_id, name, username, update, co
     # Log parsed amount and product
     logger.info(f'Parsed amount={amount} and product={product}')
 
-    invoice_id = generate_invoice_id()
-
-    # Store new invoice in the db
-    database.add_invoice(invoice_id, amount, product, user_id, name, username, current_salesman)
+    # Store new invoice in the db, the id is allocated by the database
+    invoice_id = database.add_invoice(amount, product, user_id, name, username, current_salesman)
 
     # Saving invoice_id in context.chat_data
     context.chat_data['invoice_id'] = invoice_id
@@ -135,9 +134,7 @@ def handle_vip_payment_start_command(start_data, user_id, name, username, update
     subscription_length = int(start_data[3])
     current_salesman = database.get_current_salesman()
 
-    invoice_id = generate_invoice_id()
-
-    database.add_invoice(invoice_id, amount, 'VIP', user_id, name, username, current_salesman, subscription_length) 
+    invoice_id = database.add_invoice(amount, 'VIP', user_id, name, username, current_salesman, subscription_length)
     logger.info(f'Invoice info added')
     
     logger.info(f'Added new invoice in database for invoice_id={invoice_id}, user_id={user_id}')
@@ -192,9 +189,43 @@ def handle_myvip_command(update: Update, context: CallbackContext) -> None:
 
 
 
+def handle_dbstats_command(update: Update, context: CallbackContext) -> None:
+    user_id = update.effective_user.id
+    if user_id not in ANALYTICS:
+        return
+
+    stats = instrumentation.registry.snapshot()
+    if not stats:
+        update.message.reply_text("Нет данных о запросах к базе.")
+        return
+
+    # Slowest functions first
+    rows = sorted(stats.items(), key=lambda item: item[1]['p95_ms'], reverse=True)[:20]
+    lines = [f"{'function':<32} {'calls':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'acq':>7} {'rows':>7}"]
+    for name, s in rows:
+        lines.append(f"{name[:32]:<32} {s['calls']:>6} {s['p50_ms']:>8} {s['p95_ms']:>8} {s['p99_ms']:>8} {s['avg_acquire_ms']:>7} {s['rows']:>7}")
+
+    update.message.reply_text('<pre>' + html.escape('\n'.join(lines)) + '</pre>', parse_mode=ParseMode.HTML)
+
+
+def handle_updatestats_command(update: Update, context: CallbackContext) -> None:
+    user_id = update.effective_user.id
+    if user_id not in ANALYTICS:
+        return
+
+    stats = context.dispatcher.stats()
+    stats.update({f'send_{name}': value for name, value in outbox.sender.stats().items()})
+    stats.update({f'report_{name}': value for name, value in report_jobs.runner.stats().items()})
+    lines = [f"{name:<22} {value:>10}" for name, value in stats.items()]
+
+    update.message.reply_text('<pre>' + html.escape('\n'.join(lines)) + '</pre>', parse_mode=ParseMode.HTML)
+
+
 def cancel(update: Update, context: CallbackContext) -> int:
     user = update.effective_user
     logger.info(f"User {user.id} canceled the conversation.")
+    # Reports keep generating after their conversation ended, /cancel stops those too
+    report_jobs.runner.cancel(user.id)
     update.message.reply_text(BOT_CANCEL_TEXT, reply_markup=ReplyKeyboardRemove())
 
     return ConversationHandler.END
@@ -225,8 +256,12 @@ def error_callback(update: Update, context: CallbackContext) -> None:
     # Finally, send the message
     context.bot.send_message(chat_id=56424449, text=message, parse_mode=ParseMode.HTML)
 
-def kick_users(context: CallbackContext):
-    user_ids = database.get_users_to_kick()
+def kick_user(bot, user_id, kick_date):
+    # Claim the expiry first, so it is handled once even with several bot processes. The claim
+    # is given back if the user cannot be removed
+    if not database.mark_vip_expired(user_id, kick_date):
+        return
+
     message = f"""⌛️ Ваша подписка на Вип-чат закончилась. 
     
     Чтобы продлить подписку, напишите нам!"""
@@ -237,18 +272,28 @@ def kick_users(context: CallbackContext):
     ]
 
     reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    for user_id in user_ids:
-        try:
-            context.bot.unban_chat_member(chat_id=GROUP_ID, user_id=user_id)
-            context.bot.send_message(chat_id=user_id, text=message, reply_markup=reply_markup)
-        except Exception as e:
-            logger.info(f"Could not kick user {user_id}: {e}")
 
+    def notify_user(removal):
+        if removal.exception() is not None:
+            # Pending again, the scheduler's next resync retries the removal
+            logger.info(f"Could not kick user {user_id}: {removal.exception()}")
+            database.release_vip_expiry(user_id, kick_date)
+            return
+        outbox.send(bot.send_message, priority=outbox.BROADCAST, chat_id=user_id, text=message, reply_markup=reply_markup)
 
-def main() -> None:
+    try:
+        removal = outbox.send(bot.unban_chat_member, priority=outbox.BROADCAST, per_chat=False, chat_id=GROUP_ID, user_id=user_id)
+    except Exception:
+        database.release_vip_expiry(user_id, kick_date)
+        raise
+    removal.add_done_callback(notify_user)
+
+
+def main(mode=config.BOT_MODE) -> None:
     # You should replace 'YOUR BOT TOKEN' with your actual token
-    updater = Updater(BOT_TOKEN, use_context=True) 
+    # chat_data, user_data and conversation states survive restarts and deploys
+    bot_persistence = persistence.DatabasePersistence()
+    updater = updates.build_updater(BOT_TOKEN, bot_persistence)
 
     dispatcher = updater.dispatcher
     dispatcher.add_handler(conv_handler_payments_and_salesman)
@@ -262,7 +307,9 @@ def main() -> None:
     states={
         START: [
             CallbackQueryHandler(sales_book_report, pattern='sales_book'),
-            CallbackQueryHandler(clients_book_report, pattern='clients_book')
+            CallbackQueryHandler(clients_book_report, pattern='clients_book'),
+            CallbackQueryHandler(cohorts_report, pattern='cohorts_book'),
+            CallbackQueryHandler(salesmen_report, pattern='salesmen_book')
         ],
         INPUT_DATE: [
             CallbackQueryHandler(set_today, pattern='today'),
@@ -277,6 +324,8 @@ def main() -> None:
         GENERATE_CLIENTS_BOOK_REPORT: [MessageHandler(Filters.text & ~Filters.command, generate_clients_report)],
     },
     fallbacks=[CommandHandler('cancel', cancel), MessageHandler(Filters.all, lambda u, c: ConversationHandler.END)],
+    name='reports',
+    persistent=True,
 )
 
 
@@ -293,20 +342,59 @@ def main() -> None:
     dispatcher.add_handler(CallbackQueryHandler(set_invoice_type_outgoing, pattern='outgoing'))
     dispatcher.add_handler(CallbackQueryHandler(set_invoice_type_incoming, pattern='incoming'))
     dispatcher.add_handler(CommandHandler('myvip', handle_myvip_command))
+    dispatcher.add_handler(CommandHandler('dbstats', handle_dbstats_command))
+    dispatcher.add_handler(CommandHandler('updatestats', handle_updatestats_command))
+    dispatcher.add_handler(CommandHandler('cancel', cancel))
 
  
 
 
     dispatcher.add_error_handler(error_callback)
 
-    scheduler = BackgroundScheduler(timezone=timezone('Europe/Moscow'))  # Adjust 'UTC' if needed
-    scheduler.add_job(kick_users, 'cron', hour=0, minute=0, second=0, args=(updater,))
-    scheduler.start()
-
-    updater.start_polling()
+    # Every subscription is expired at its own kick_date
+    expiries = expiry.ExpiryScheduler(lambda user_id, kick_date: kick_user(updater.bot, user_id, kick_date))
+    database.subscription_listeners.append(expiries.schedule)
+    # Preset report stats are summed from running totals kept in memory. Recorded before the
+    # cache is invalidated, or a report job could cache stale totals under the new generation
+    database.invoice_listeners.append(revenue.totals.record)
+    # Cached reports are dropped when a payment lands in their period
+    database.invoice_listeners.append(invalidate_reports)
+    revenue.totals.start()
 
-    updater.idle()
+    scheduler = BackgroundScheduler(timezone=timezone('Europe/Moscow'))  # Adjust 'UTC' if needed
+    scheduler.add_job(expiries.resync, 'interval', minutes=expiry.EXPIRY_RESYNC_MINUTES)
+    scheduler.add_job(invites.refill, 'interval', minutes=invites.INVITE_REFILL_MINUTES, args=(updater.bot,),
+                      next_run_time=datetime.now(timezone('Europe/Moscow')))
+    scheduler.start(paused=True)
+
+    def start_scheduled_jobs():
+        expiries.start()
+        scheduler.resume()
+
+    def stop_scheduled_jobs():
+        scheduler.pause()
+        expiries.stop()
+
+    # Only one replica runs the scheduled jobs, another one takes over if it dies
+    election = leader.LeaderElection('scheduled_jobs', start_scheduled_jobs, stop_scheduled_jobs)
+    election.start()
+
+    if not (mode == 'webhook' and webhook.run(updater)):
+        updater.start_polling()
+        updater.idle()
+
+    election.stop()
+    scheduler.shutdown()
+    report_jobs.runner.stop()
+    revenue.totals.stop()
+    bot_persistence.flush()
+    outbox.sender.stop()
 
 if __name__ == '__main__':
-    database.create_table()
-    main()
+    migrations.migrate()
+    if '--webhook' in sys.argv[1:]:
+        main('webhook')
+    elif '--polling' in sys.argv[1:]:
+        main('polling')
+    else:
+        main()
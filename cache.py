@@ -0,0 +1,82 @@
+import threading
+import time
+
+
+class TTLCache:
+    """Thread-safe in-process cache for slowly changing values.
+
+    Entries are dropped explicitly with `invalidate` by whoever changes the underlying
+    data, and expire after `ttl` seconds anyway so several bot processes converge on
+    changes made through another process. Expired entries are pruned whenever a value
+    is stored, so keys that are never asked for again do not pile up.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}  # key -> (value, expires_at)
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > now:
+                return entry[0]
+            generation = self._generation
+
+        value = loader()
+
+        with self._lock:
+            # Do not store a value that was loaded before a concurrent invalidation
+            if generation == self._generation:
+                now = time.monotonic()
+                self._entries = {k: entry for k, entry in self._entries.items() if entry[1] > now}
+                self._entries[key] = (value, now + self.ttl)
+        return value
+
+    def invalidate(self, *keys):
+        with self._lock:
+            self._generation += 1
+            if keys:
+                for key in keys:
+                    self._entries.pop(key, None)
+            else:
+                self._entries.clear()
+
+
+class PeriodCache:
+    """Thread-safe cache for values computed over a range of days, such as reports.
+
+    Each entry remembers the last day it covers. A change to the data of some day drops
+    every entry reaching that day or later with `invalidate_from`, so entries for closed
+    periods stay until a late change touches them. `ttl` bounds how long changes made by
+    other processes go unnoticed.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}  # key -> (value, last_day, expires_at)
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns (value or None, generation), pass the generation on to `put`."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] > time.monotonic():
+                return entry[0], self._generation
+            return None, self._generation
+
+    def put(self, key, last_day, value, generation):
+        with self._lock:
+            # Do not store a value that was computed before a concurrent invalidation
+            if generation == self._generation:
+                now = time.monotonic()
+                self._entries = {k: entry for k, entry in self._entries.items() if entry[2] > now}
+                self._entries[key] = (value, last_day, now + self.ttl)
+
+    def invalidate_from(self, day):
+        with self._lock:
+            self._generation += 1
+            self._entries = {key: entry for key, entry in self._entries.items() if entry[1] < day}
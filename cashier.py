@@ -1,9 +1,12 @@
-import uuid
 import database
 import logging
+import threading
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputTextMessageContent, InlineQueryResultArticle
 from telegram.ext import CallbackContext, CallbackQueryHandler, InlineQueryHandler, MessageHandler, Filters
 import config
+import outbox
+import invites
+from cache import TTLCache
 from datetime import datetime
 
 # Logging setup
@@ -11,30 +14,38 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(level
 logger = logging.getLogger(__name__)
 
 
-def invoice(update: Update, context: CallbackContext) -> None:
-    user_id = update.inline_query.from_user.id
-    if user_id not in config.SALES_MANAGERS:
-        logging.info(f"User {user_id} tried to issue an invoice but is not in the list of sales managers.")
-        return
+INLINE_CACHE_TIME = 10  # seconds Telegram may reuse an answer for the same manager and query
+INLINE_DEBOUNCE_SECONDS = 0.3  # a query is answered once the manager stopped typing for this long
+INLINE_PRODUCTS = ['Express', 'Ordinar', 'Combo', 'Lesenka']
 
-    query = update.inline_query.query.split()
+# Prebuilt result lists by (query type, amount, days, current salesman)
+inline_results = TTLCache(ttl=600)
 
-    # Log the received query
-    logger.info(f'Received inline query: {query}')
+# user_id -> (id of the newest inline query, timer that answers it), older ones are not answered
+_latest_inline_query = {}
+_inline_lock = threading.Lock()
+
+
+def parse_invoice_query(text):
+    """Returns (query type, amount, days) or None if the query cannot produce an invoice."""
+    query = text.split()
 
     if len(query) >= 2 and query[0].isdigit() and query[1].isdigit():
-        # Handle VIP invoices
-        amount = int(query[0])
-        days = int(query[1])
+        return 'vip', int(query[0]), int(query[1])
+    if query and query[0].isdigit():
+        return 'product', int(query[0]), None
+    return None
+
 
+def build_invoice_results(kind, amount, days, current_salesman):
+    if kind == 'vip':
         # Log the extracted amount and subscription length
         logger.info(f'Creating VIP invoice for amount: {amount}, subscription length: {days} days')
-        
+
         pay_url = f"{config.BOT_URL}?start=vip_{amount}_days_{days}"
-        current_salesman = database.get_current_salesman()
-        
-        results = [InlineQueryResultArticle(
-            id=str(uuid.uuid4()),
+
+        return [InlineQueryResultArticle(
+            id=f"vip_{amount}_{days}",
             title=f"Вип-чат • {amount} рублей",
             description=f"Длительность подписки: {days} дней | Продажник: {current_salesman}",
             input_message_content=InputTextMessageContent(config.INVOICE_TEXT_VIP.format(amount=amount,days=days)),
@@ -43,39 +54,70 @@ def invoice(update: Update, context: CallbackContext) -> None:
             ]),
             thumb_url="https://cdn-icons-png.flaticon.com/512/2982/2982899.png",
         )]
-    else:
-        # Handle regular invoices
-        if not query or not query[0].isdigit():
-            return
 
-        amount = int(query[0])
+    results = []
+    for product in INLINE_PRODUCTS:
+        # Log the extracted amount and product
+        logger.info(f'Creating invoice for amount: {amount}, product: {product}')
 
-        products = ['Express', 'Ordinar', 'Combo', 'Lesenka']
+        pay_url = f"{config.BOT_URL}?start=amount_{amount}_product_{product}"
 
-        results = []
+        results.append(InlineQueryResultArticle(
+            id=f"{product}_{amount}",
+            title=f"Создать счет • {amount} рублей",
+            description=f"Продукт: {product} | Продажник: {current_salesman}",
+            input_message_content=InputTextMessageContent(config.INVOICE_TEXT.format(amount=amount)),
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton(config.INVOICE_PAY_BUTTON, url=pay_url)]
+            ]),
+            thumb_url="https://cdn-icons-png.flaticon.com/512/1117/1117142.png",
+        ))
+    return results
 
-        # Fetch current salesman from the database
-        current_salesman = database.get_current_salesman()
 
-        for product in products:
-            # Log the extracted amount and product
-            logger.info(f'Creating invoice for amount: {amount}, product: {product}')
+def invoice(update: Update, context: CallbackContext) -> None:
+    user_id = update.inline_query.from_user.id
+    if user_id not in config.SALES_MANAGERS:
+        logging.info(f"User {user_id} tried to issue an invoice but is not in the list of sales managers.")
+        return
+
+    # Log the received query
+    logger.info(f'Received inline query: {update.inline_query.query}')
 
-            pay_url = f"{config.BOT_URL}?start=amount_{amount}_product_{product}"
+    parsed = parse_invoice_query(update.inline_query.query)
+    if parsed is None:
+        return
+
+    # Telegram sends a query per keystroke, only the one the manager stops at is answered.
+    # A plain timer rather than the job queue, which saves the bot persistence after every job
+    timer = threading.Timer(INLINE_DEBOUNCE_SECONDS, answer_invoice_query,
+                            args=(context.bot, user_id, update.inline_query.id, parsed))
+    timer.daemon = True
+    with _inline_lock:
+        previous = _latest_inline_query.get(user_id)
+        _latest_inline_query[user_id] = (update.inline_query.id, timer)
+    if previous is not None:
+        previous[1].cancel()
+    timer.start()
+
+
+def answer_invoice_query(bot, user_id, inline_query_id, parsed) -> None:
+    with _inline_lock:
+        latest = _latest_inline_query.get(user_id)
+        if latest is None or latest[0] != inline_query_id:
+            return
+        del _latest_inline_query[user_id]
 
-            results.append(InlineQueryResultArticle(
-                id=str(uuid.uuid4()),
-                title=f"Создать счет • {amount} рублей",
-                description=f"Продукт: {product} | Продажник: {current_salesman}",  
-                input_message_content=InputTextMessageContent(config.INVOICE_TEXT.format(amount=amount)),
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton(config.INVOICE_PAY_BUTTON, url=pay_url)]
-                ]),
-                thumb_url="https://cdn-icons-png.flaticon.com/512/1117/1117142.png",
-            ))
+    kind, amount, days = parsed
+    try:
+        current_salesman = database.get_current_salesman()
+        results = inline_results.get((kind, amount, days, current_salesman),
+                                     lambda: build_invoice_results(kind, amount, days, current_salesman))
 
-    # Send all results
-    context.bot.answer_inline_query(update.inline_query.id, results, cache_time=0)
+        # Results show the current salesman, so Telegram only reuses them briefly and per manager
+        bot.answer_inline_query(inline_query_id, results, cache_time=INLINE_CACHE_TIME, is_personal=True)
+    except Exception:
+        logger.exception(f"Failed to answer inline query {inline_query_id}")
 
 
 
@@ -151,44 +193,40 @@ def handle_screenshot(update: Update, context: CallbackContext) -> None:
             invoice_amount = invoice_details["amount"]
             product = invoice_details["product"]
 
-            for manager_id in config.SALES_MANAGERS:
-                # Forward the screenshot to the payment manager
-                context.bot.forward_message(chat_id=manager_id, from_chat_id=update.effective_chat.id, message_id=update.message.message_id)
+            # Acknowledge the customer before anything goes out to the managers
+            outbox.send(context.bot.send_message, priority=outbox.CUSTOMER, chat_id=update.effective_chat.id, text=config.CHECK_SCREEN_TEXT)
 
-                logger.info(f"Forwarded screenshot to payment manager: id={manager_id}")
+            logger.info(f"Sent thank you message to user: id={user_id}")
 
-                # Build the message string
-                msg = f"""Поступил новый скриншот оплаты. 
+            # Build the caption once, it is the same for every manager
+            caption = f"""Поступил новый скриншот оплаты. 
                 
 Пожалуйста, проверьте скриншот.
 
 """
-                msg += f"Имя клиента: {name}\n"
-                if username:
-                    msg += f"Username клиента: {username}\n"
-                msg += f"User ID клиента : {user_id}\n"
-                msg += f"Номер счета: {invoice_id}\n"
-                msg += f"Сумма счета: {invoice_amount}\n"
-                if product != 'null':
-                    msg += f"Продукт: {product}\n"
-
-                msg += f"💳: {database.get_current_card_and_bank()}"
-
-                # Send the invoice details to the payment manager
-                context.bot.send_message(
-                    chat_id=manager_id,
-                    text=msg,
-                    reply_markup=InlineKeyboardMarkup([
-                        [InlineKeyboardButton("✅ Подтвердить", callback_data=f'approve_{invoice_id}'),
-                        InlineKeyboardButton("❌ Отклонить", callback_data=f'decline_{invoice_id}')]]
-                    )
-                )
-
-                logger.info(f"Sent invoice details to payment manager: id={manager_id}")
-
-            context.bot.send_message(chat_id=update.effective_chat.id, text=config.CHECK_SCREEN_TEXT)
+            caption += f"Имя клиента: {name}\n"
+            if username:
+                caption += f"Username клиента: {username}\n"
+            caption += f"User ID клиента : {user_id}\n"
+            caption += f"Номер счета: {invoice_id}\n"
+            caption += f"Сумма счета: {invoice_amount}\n"
+            if product != 'null':
+                caption += f"Продукт: {product}\n"
+
+            caption += f"💳: {database.get_current_card_and_bank()}"
+
+            reply_markup = InlineKeyboardMarkup([
+                [InlineKeyboardButton("✅ Подтвердить", callback_data=f'approve_{invoice_id}'),
+                InlineKeyboardButton("❌ Отклонить", callback_data=f'decline_{invoice_id}')]]
+            )
+
+            # One copy of the screenshot with the details as its caption per manager. The outbox
+            # delivers to all managers concurrently and retries each of them on its own.
+            for manager_id in config.SALES_MANAGERS:
+                outbox.send(context.bot.copy_message, chat_id=manager_id, from_chat_id=update.effective_chat.id,
+                            message_id=update.message.message_id, caption=caption, reply_markup=reply_markup)
 
-            logger.info(f"Sent thank you message to user: id={user_id}")
+                logger.info(f"Queued screenshot for payment manager: id={manager_id}")
         else:
             logger.warning(f"No invoices found for user: id={user_id}")
 
@@ -215,156 +253,62 @@ def approve_invoice(update: Update, context: CallbackContext) -> None:
     except Exception as e:
         logger.error(f"An error occurred in approve_invoice: {e}")
         
-def generate_vip_invite_link(context: CallbackContext):
-    chat_id = config.GROUP_ID  # replace with your VIP chat ID
-    try:
-        invite_link = context.bot.create_chat_invite_link(chat_id,member_limit=1)
-        return invite_link.invite_link  # return the actual URL
-    except Exception as e:
-        print(f"Failed to export invite link for VIP chat: {e}")
-        return None
+def set_invoice_type_outgoing(update: Update, context: CallbackContext) -> None:
+    complete_invoice_approval(update, context, 'Outgoing', "📤 Исходящий")
 
 
+def set_invoice_type_incoming(update: Update, context: CallbackContext) -> None:
+    complete_invoice_approval(update, context, 'Incoming', "📥 Входящий")
 
-def set_invoice_type_outgoing(update: Update, context: CallbackContext) -> None:
+
+def complete_invoice_approval(update: Update, context: CallbackContext, invoice_type, type_text) -> None:
     query = update.callback_query
     invoice_id = query.data.split('_')[1]
-    database.update_invoice_status(invoice_id, 'PAID')
-    database.update_invoice_type(invoice_id, 'Outgoing')  # Assuming you have this function defined
-    query.edit_message_text(text=f"""✅ Счет {invoice_id} был подтвержден!
-    
-Тип продажи: 📤 Исходящий.""")
 
-    invoice_details = database.get_invoice_details(invoice_id)
+    # Status, type and subscription are updated atomically in a single round trip
+    invoice_details = database.approve_invoice(invoice_id, invoice_type)
     if invoice_details is None:
-        print("set_invoice_type_outgoing: invoice_details is None!")
+        query.edit_message_text(text=f"Счет {invoice_id} уже был подтвержден.")
         return
 
-    user_id = invoice_details["user_id"]
-    amount = invoice_details["amount"]
-    name = invoice_details["name"]
-    username = invoice_details["username"]
-    subscription_length = invoice_details["subscription_length"]
-
-    # Update the user's subscription
-   
-    subscription_updated = False
-    if subscription_length is not None:
-        subscription_updated = database.update_vip_subscription(user_id, subscription_length)
-
-    if not subscription_updated:
-        # If the user is not in the vip table yet, add them
-        invite_link = generate_vip_invite_link(context)
-        if invite_link is None:
-            # Handle the error if the invite link could not be generated
-            return
-        if subscription_length is not None: # add this check here also if needed
-            database.add_subscription(name, username, user_id, subscription_length)
-
-    kick_date = database.get_kickdate(user_id)
-    kick_date = kick_date.strftime("%d.%m.%Y")
-
-    invite_link = generate_vip_invite_link(context)
-    if invite_link is None:
-        # Handle the error if the invite link could not be generated
-        return
-
-    # Determine which message to send based on product type
-    if subscription_length is not None: 
-        msg = config.VIP_INVITE_TEXT.format(kick_date=kick_date)
-        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("Вступить в Вип-чат", url=invite_link)]])
-    else:
-        msg = config.DEAL_DONE_TEXT.format(amount=amount)
-        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton(config.GET_SERVICE_TEXT, url=config.MANAGER_URL)]])
-        
-    context.bot.send_message(chat_id=user_id, text=msg, reply_markup=keyboard)
-    database.update_vip_status(user_id)
-
-    # Get the screenshot info from the database
-    screenshot_id = database.get_screenshot_id(invoice_id)
-    if screenshot_id is not None:
-        from_chat_id = invoice_details["user_id"]
-        for manager_id in config.PAYMENT_MANAGERS:
-            # Forward the screenshot to the payment manager
-            context.bot.forward_message(chat_id=manager_id, from_chat_id=from_chat_id, message_id=screenshot_id)
-
-            # Send the message to the payment manager
-            context.bot.send_message(chat_id=manager_id, text=f"""🆕 Новый перевод на сумму {amount} рублей.
-    💳: {database.get_current_card_and_bank()} 
-
-    Счет №: {invoice_id}
-    Клиент: {name}
-    User ID: {from_chat_id}
-            """)
-
-
-def set_invoice_type_incoming(update: Update, context: CallbackContext) -> None:
-    query = update.callback_query
-    invoice_id = query.data.split('_')[1]
-    database.update_invoice_status(invoice_id, 'PAID')
-    database.update_invoice_type(invoice_id, 'Incoming')  # Assuming you have this function defined
     query.edit_message_text(text=f"""✅ Счет {invoice_id} был подтвержден!
 
-Тип продажи: 📥 Входящий.""")
-
-    invoice_details = database.get_invoice_details(invoice_id)
-    if invoice_details is None:
-        print("set_invoice_type_incoming: invoice_details is None!")
-        return
+Тип продажи: {type_text}.""")
 
     user_id = invoice_details["user_id"]
     amount = invoice_details["amount"]
     name = invoice_details["name"]
-    username = invoice_details["username"]
     subscription_length = invoice_details["subscription_length"]
 
-    subscription_updated = False
+    # Determine which message to send based on product type
     if subscription_length is not None:
-        subscription_updated = database.update_vip_subscription(user_id, subscription_length)
-
-    if not subscription_updated:
-        # If the user is not in the vip table yet, add them
-        invite_link = generate_vip_invite_link(context)
+        # Taken from the pre-created pool, recorded against the user and invoice
+        invite_link = invites.issue_invite_link(context.bot, user_id, invoice_id)
         if invite_link is None:
-            # Handle the error if the invite link could not be generated
+            # The payment is already recorded, let the manager send the link by hand
+            outbox.send(context.bot.send_message, chat_id=query.message.chat_id, text=f"⚠️ Не удалось создать ссылку в Вип-чат для счета {invoice_id}.")
             return
-        if subscription_length is not None: # add this check here also if needed
-            database.add_subscription(name, username, user_id, subscription_length)
 
-    kick_date = database.get_kickdate(user_id)
-    kick_date = kick_date.strftime("%d.%m.%Y")
-
-    invite_link = generate_vip_invite_link(context)
-    if invite_link is None:
-        # Handle the error if the invite link could not be generated
-        return
-
-    # Determine which message to send based on product type
-    if subscription_length is not None: 
+        kick_date = invoice_details["kick_date"].strftime("%d.%m.%Y")
         msg = config.VIP_INVITE_TEXT.format(kick_date=kick_date)
         keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("Вступить в Вип-чат", url=invite_link)]])
     else:
         msg = config.DEAL_DONE_TEXT.format(amount=amount)
         keyboard = InlineKeyboardMarkup([[InlineKeyboardButton(config.GET_SERVICE_TEXT, url=config.MANAGER_URL)]])
 
-    context.bot.send_message(chat_id=user_id, text=msg, reply_markup=keyboard)
-    database.update_vip_status(user_id)
+    outbox.send(context.bot.send_message, priority=outbox.CUSTOMER, chat_id=user_id, text=msg, reply_markup=keyboard)
 
-    # Get the screenshot info from the database
-    screenshot_id = database.get_screenshot_id(invoice_id)
+    screenshot_id = invoice_details["screenshot_id"]
     if screenshot_id is not None:
-        from_chat_id = invoice_details["user_id"]
+        card_and_bank = database.get_current_card_and_bank()
         for manager_id in config.PAYMENT_MANAGERS:
-            # Forward the screenshot to the payment manager
-            context.bot.forward_message(chat_id=manager_id, from_chat_id=from_chat_id, message_id=screenshot_id)
-
-            # Send the message to the payment manager
-            context.bot.send_message(chat_id=manager_id, text=f"""🆕 Новый перевод на сумму {amount} рублей.
-💳: {database.get_current_card_and_bank()} 
+            # The screenshot with the transfer details as its caption
+            outbox.send(context.bot.copy_message, chat_id=manager_id, from_chat_id=user_id, message_id=screenshot_id, caption=f"""🆕 Новый перевод на сумму {amount} рублей.
+💳: {card_and_bank} 
 
 Счет №: {invoice_id}
 Клиент: {name}
-User ID: {from_chat_id}
+User ID: {user_id}
 """)
 
 
@@ -387,7 +331,7 @@ def decline_invoice(update: Update, context: CallbackContext) -> None:
         user_id = invoice_details["user_id"]
         msg = config.SCREEN_DECLINED_TEXT
         keyboard = InlineKeyboardMarkup([[InlineKeyboardButton(config.CONTACT_MANAGER_TEXT, url=config.MANAGER_URL)]])
-        context.bot.send_message(chat_id=user_id, text=msg, reply_markup=keyboard)
+        outbox.send(context.bot.send_message, priority=outbox.CUSTOMER, chat_id=user_id, text=msg, reply_markup=keyboard)
         query.edit_message_text(text=f"Счет {invoice_id} был отклонен.")  # This will update the confirmation message to the decline message
 
 
@@ -0,0 +1,99 @@
+import logging
+import pandas as pd
+
+# Logging setup
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def load_paid_invoices(file):
+    """Read database.export_paid_invoices output into a DataFrame of user_id, month, amount."""
+    return pd.read_csv(file, dtype={'user_id': 'int64', 'month': 'int32', 'amount': 'int64'})
+
+
+def month_label(month):
+    return f"{month // 12:04d}-{month % 12 + 1:02d}"
+
+
+def cohort_tables(invoices, current_month):
+    """Monthly acquisition cohorts of `invoices`, as {sheet name: DataFrame}.
+
+    A customer's cohort is the month of their first paid invoice, the age of an invoice
+    is the number of months since then. Every table is computed with grouped, vectorized
+    operations, cells for ages a cohort has not reached by `current_month` are left empty.
+    """
+    first_month = invoices.groupby('user_id')['month'].transform('min')
+    invoices = invoices.assign(cohort=first_month, age=invoices['month'] - first_month)
+
+    customers = invoices.groupby('user_id').agg(cohort=('cohort', 'first'), orders=('amount', 'size'), revenue=('amount', 'sum'))
+    customers['repeat'] = customers['orders'] > 1
+
+    summary = customers.groupby('cohort').agg(
+        customers=('orders', 'size'),
+        repeat_customers=('repeat', 'sum'),
+        orders=('orders', 'sum'),
+        revenue=('revenue', 'sum'),
+    )
+    summary['repeat_rate'] = (summary['repeat_customers'] / summary['customers']).round(4)
+    summary['orders_per_customer'] = (summary['orders'] / summary['customers']).round(2)
+    summary['ltv'] = (summary['revenue'] / summary['customers']).round(2)
+
+    by_age = invoices.groupby(['cohort', 'age'])
+    active = invoices.drop_duplicates(['user_id', 'month']).groupby(['cohort', 'age']).size().unstack(fill_value=0)
+    revenue = by_age['amount'].sum().unstack(fill_value=0).reindex(columns=active.columns, fill_value=0)
+
+    # Ages past the current month have not happened yet for that cohort
+    ages = active.columns.to_numpy()
+    reached = (active.index.to_numpy()[:, None] + ages[None, :]) <= current_month
+
+    retention = active.div(summary['customers'], axis=0).round(4).where(reached)
+    ltv = revenue.cumsum(axis=1).div(summary['customers'], axis=0).round(2).where(reached)
+    active = active.where(reached)
+
+    tables = {
+        'Cohorts': summary.rename(columns={
+            'customers': 'Customers',
+            'repeat_customers': 'Repeat customers',
+            'orders': 'Orders',
+            'revenue': 'Revenue',
+            'repeat_rate': 'Repeat rate',
+            'orders_per_customer': 'Orders per customer',
+            'ltv': 'LTV',
+        }),
+        'Retention': retention,
+        'Active customers': active,
+        'Cumulative LTV': ltv,
+    }
+    for name, table in tables.items():
+        table.index = pd.Index([month_label(month) for month in table.index], name='Cohort')
+        if name != 'Cohorts':
+            table.columns = pd.Index([f'M{age}' for age in table.columns], name='Months since first purchase')
+    return tables
+
+
+def write_workbook(tables, file):
+    """Write each table to its own sheet of an .xlsx workbook in `file`."""
+    with pd.ExcelWriter(file, engine='openpyxl') as writer:
+        for name, table in tables.items():
+            table.to_excel(writer, sheet_name=name)
+
+
+def build_cohort_workbook(source, target, current_month):
+    """Read paid invoices from `source`, write the cohort workbook to `target`.
+
+    Returns the totals shown with the report, None if there are no paid invoices.
+    """
+    invoices = load_paid_invoices(source)
+    if invoices.empty:
+        return None
+
+    tables = cohort_tables(invoices, current_month)
+    write_workbook(tables, target)
+
+    summary = tables['Cohorts']
+    return {
+        'cohorts': len(summary),
+        'customers': int(summary['Customers'].sum()),
+        'repeat_rate': round(float(summary['Repeat customers'].sum() / summary['Customers'].sum()), 4),
+        'ltv': round(float(summary['Revenue'].sum() / summary['Customers'].sum()), 2),
+    }
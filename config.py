@@ -1,3 +1,5 @@
+import os
+import hashlib
 import database
 
 PAYMENT_MANAGERS = [236030478]
@@ -9,6 +11,28 @@ MANAGER_URL = "https://t.me/BRUTAL_S"
 BOT_URL = "https://t.me/brubetbot"
 GROUP_ID = "-1001974358724"
 
+# Update delivery: 'polling' or 'webhook', `python bot.py --webhook` / `--polling` overrides
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')  # public https base url of the app
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/telegram')
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('PORT', 8443))
+# Every process behind the load balancer must share the secret, so the default is derived from the token
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', 100))  # pending updates before answering 503
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', 40))
+
+# Threads handling updates in parallel (one chat at a time each), 0 handles them on the dispatcher thread
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', 8))
+
+# Outgoing API call limits, kept under Telegram's flood limits (30/s overall, 1/s per chat, 20/min per group)
+SEND_GLOBAL_RATE = float(os.environ.get('SEND_GLOBAL_RATE', 25))
+SEND_CHAT_RATE = float(os.environ.get('SEND_CHAT_RATE', 1))
+SEND_GROUP_RATE = float(os.environ.get('SEND_GROUP_RATE', 20 / 60))
+SEND_BURST = int(os.environ.get('SEND_BURST', 3))
+SEND_WORKERS = int(os.environ.get('SEND_WORKERS', 4))
+SEND_MAX_RETRIES = int(os.environ.get('SEND_MAX_RETRIES', 5))
+
 def get_card_number():
     return database.get_current_card()  # Fetches the current card number from the database
 
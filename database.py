@@ -1,168 +1,201 @@
 import os
-import psycopg2
+from contextlib import contextmanager
 from psycopg2 import sql
 from datetime import datetime, timedelta
 import time
 import pytz
 import logging
+from cache import TTLCache
+import instrumentation
+import storage
 
 # Set up logging at the top of your file
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 
-DATABASE_URL = os.environ['DATABASE_URL']  # provided by Heroku
+# Provided by Heroku. sqlite:///file.db or sqlite:// (in memory) runs on the embedded
+# SQLite backend instead, for local runs, load tests and benchmarks.
+DATABASE_URL = os.environ['DATABASE_URL']
+DB_TIMEZONE = storage.DB_TIMEZONE
+
+MOSCOW = pytz.timezone(DB_TIMEZONE)
+
+backend = storage.backend_from_url(DATABASE_URL)
+
+# Current card and salesman only change through the admin menus. Every change made in this
+# process invalidates them right away, the TTL lets other replicas pick changes up.
+CONFIG_CACHE_TTL = float(os.environ.get('CONFIG_CACHE_TTL', 60))
+config_cache = TTLCache(CONFIG_CACHE_TTL)
+
+
+# Called with (user_id, kick_date) after a VIP subscription is created or extended
+subscription_listeners = []
+
+
+def notify_subscription_changed(user_id, kick_date):
+    for listener in subscription_listeners:
+        try:
+            listener(user_id, kick_date)
+        except Exception:
+            logger.exception(f"Subscription listener failed for user {user_id}")
 
-def create_connection():
-    conn = psycopg2.connect(DATABASE_URL, sslmode='require')
-    cur = conn.cursor()
-    cur.execute("SET TIMEZONE='Europe/Moscow';") 
 
-    # Fetch and print the current timezone setting
-    cur.execute("SHOW timezone;")
-    tz_setting = cur.fetchone()[0]
-    print(f"Database timezone setting: {tz_setting}")
+# Called with an invoice change (see invoice_change) after an invoice starts or stops
+# counting as paid
+invoice_listeners = []
 
+
+def invoice_change(date, user_id, amount, invoice_type, delta, customer):
+    # `customer` is the buyer's (first_paid_at, paid_total) after the change
+    first_paid_at, paid_total = customer
+    return {
+        "date": date,
+        "user_id": user_id,
+        "amount": amount or 0,
+        "type": invoice_type,
+        "delta": delta,  # 1 when the invoice became paid, -1 when it stopped being paid
+        "first_paid_at": first_paid_at,
+        "paid_total": paid_total,
+    }
+
+
+def notify_invoice_changed(change):
+    for listener in invoice_listeners:
+        try:
+            listener(change)
+        except Exception:
+            logger.exception(f"Invoice listener failed for {change['date']}")
+
+
+def create_connection():
+    start = time.perf_counter()
+    conn = backend.getconn()
+    instrumentation.record_acquire(time.perf_counter() - start)
     return conn
 
 def close_connection(conn):
-    conn.close()
+    backend.putconn(conn)
 
-def create_table():
+
+@contextmanager
+def connection():
+    """Yields (conn, cur) with a pooled connection. Whatever was not committed is rolled
+    back and the connection always goes back to the pool, a broken one is dropped there."""
     conn = create_connection()
-    cur = conn.cursor()
-
-    # Create salesman table
-    cur.execute(sql.SQL("""CREATE TABLE IF NOT EXISTS salesman (
-                        id SERIAL PRIMARY KEY, 
-                        name TEXT NOT NULL,
-                        is_current BOOLEAN DEFAULT FALSE)"""))
-
-    # Create invoices table
-    cur.execute(sql.SQL("""CREATE TABLE IF NOT EXISTS invoices (
-                        invoice_id INTEGER PRIMARY KEY, 
-                        amount INTEGER,
-                        name TEXT, 
-                        username TEXT, 
-                        user_id BIGINT, 
-                        product TEXT, 
-                        status TEXT, 
-                        type TEXT,
-                        date TIMESTAMPTZ, 
-                        screenshot_id INTEGER, 
-                        salesman TEXT,
-                        subscription_length INTEGER)""")) 
-
-    # Create cards table
-    cur.execute(sql.SQL("""
-        CREATE TABLE IF NOT EXISTS cards (
-            id SERIAL PRIMARY KEY,
-            card_number VARCHAR(255),
-            bank VARCHAR(255),
-            is_current BOOLEAN DEFAULT FALSE
-        )
-    """))
+    try:
+        yield conn, conn.cursor()
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception:
+            logger.warning("Could not roll back a failed transaction, dropping the connection")
+        raise
+    finally:
+        close_connection(conn)
 
 
-    cur.execute(sql.SQL("""
-    CREATE TABLE IF NOT EXISTS vip (
-        name TEXT,
-        username TEXT,
-        user_id BIGINT PRIMARY KEY,
-        duration INTEGER,
-        kick_date TIMESTAMP WITH TIME ZONE,
-        paid BOOLEAN DEFAULT FALSE,
-        renewal_times INTEGER DEFAULT 0
-    );
-    """))
+def dialect_sql(variants):
+    # Pick the statement written for the configured backend
+    return variants[backend.dialect]
 
-    
-    # Save (commit) the changes and close the connection
-    conn.commit()
-    close_connection(conn)
 
+def moscow_date(value):
+    # Calendar day in Moscow, the key of daily_sales_rollup
+    if value.tzinfo is None:
+        value = MOSCOW.localize(value)
+    return value.astimezone(MOSCOW).date()
 
-def add_invoice(invoice_id, amount, product, user_id, name, username, current_salesman, subscription_length=None):
-    conn = create_connection()
 
-    date = datetime.now(pytz.timezone('Europe/Moscow'))
+def add_invoice(amount, product, user_id, name, username, current_salesman, subscription_length=None):
+    with connection() as (conn, cur):
+        date = datetime.now(pytz.timezone('Europe/Moscow'))
     
-    cur = conn.cursor()
 
-    cur.execute(sql.SQL("INSERT INTO invoices (invoice_id, amount, product, user_id, name, username, salesman, date, subscription_length) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)"), 
-                (invoice_id, amount, product, user_id, name, username, current_salesman, date, subscription_length))
+        # invoice_id comes from the invoices sequence, so concurrent inserts never collide
+        cur.execute(sql.SQL("INSERT INTO invoices (amount, product, user_id, name, username, salesman, date, subscription_length) VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING invoice_id"), 
+                    (amount, product, user_id, name, username, current_salesman, date, subscription_length))
+        invoice_id = cur.fetchone()[0]
+
+        conn.commit()
 
-    conn.commit()
-    close_connection(conn)
+    return invoice_id
 
 
 def add_subscription(name, username, user_id, subscription_length):
     logger.info(f"add_subscription called with parameters name={name}, username={username}, user_id={user_id}, subscription_length={subscription_length}")
-    conn = create_connection()
-
-    now = datetime.now(pytz.timezone('Europe/Moscow')) 
-    kick_date = now + timedelta(days=int(subscription_length))
-    logger.info(f'Kick date calculated: {kick_date}')
+    with connection() as (conn, cur):
+        now = datetime.now(pytz.timezone('Europe/Moscow')) 
+        kick_date = now + timedelta(days=int(subscription_length))
+        logger.info(f'Kick date calculated: {kick_date}')
         
-    cur = conn.cursor()
 
-    cur.execute(sql.SQL("INSERT INTO vip (name, username, user_id, duration, kick_date) VALUES (%s, %s, %s, %s, %s)"),
-            (name, username, user_id, subscription_length, kick_date))
+        cur.execute(sql.SQL("INSERT INTO vip (name, username, user_id, duration, kick_date) VALUES (%s, %s, %s, %s, %s)"),
+                (name, username, user_id, subscription_length, kick_date))
 
 
-    conn.commit()
-    close_connection(conn)
+        conn.commit()
 
+    notify_subscription_changed(user_id, kick_date)
 
-def get_latest_invoice_id():
-    conn = create_connection()
-    cur = conn.cursor()
 
-    cur.execute(sql.SQL("SELECT MAX(invoice_id) FROM invoices"))
-    result = cur.fetchone()
+def get_pending_expiries():
+    """Returns (user_id, kick_date) of every subscription whose expiry was not handled yet."""
+    with connection() as (conn, cur):
+        cur.execute(
+            "SELECT user_id, kick_date FROM vip WHERE expired_at IS NULL AND kick_date IS NOT NULL"
+        )
 
-    close_connection(conn)
+        # Fetch all the rows
+        rows = cur.fetchall()
 
-    # Return the maximum invoice_id if it exists, else return 0
-    return result[0] if result[0] is not None else 0
+        # Close communication with the database
+        cur.close()
 
+    return [(row[0], row[1]) for row in rows]
 
-    # Return the maximum invoice_id if it exists, else return 0
-    return result[0] if result[0] is not None else 0
 
-def get_users_to_kick():
-    conn = create_connection()
-    cur = conn.cursor()
+def mark_vip_expired(user_id, kick_date):
+    """Claim the expiry of the subscription ending at `kick_date`.
 
-    cur.execute(
-        "SELECT user_id FROM vip WHERE kick_date <= NOW()"
-    )
+    Returns True for exactly one caller, False if the expiry was already handled or the
+    subscription was extended in the meantime.
+    """
+    with connection() as (conn, cur):
+        cur.execute(
+            "UPDATE vip SET expired_at = NOW() WHERE user_id = %s AND kick_date = %s AND expired_at IS NULL",
+            (user_id, kick_date)
+        )
+        claimed = cur.rowcount == 1
 
-    # Fetch all the rows
-    rows = cur.fetchall()
+        conn.commit()
 
-    # Close communication with the database
-    cur.close()
-    conn.close()
+    return claimed
 
-    return [row[0] for row in rows]
 
+def release_vip_expiry(user_id, kick_date):
+    """Give back a claim taken with mark_vip_expired, the expiry is pending again."""
+    with connection() as (conn, cur):
+        cur.execute(
+            "UPDATE vip SET expired_at = NULL WHERE user_id = %s AND kick_date = %s AND expired_at IS NOT NULL",
+            (user_id, kick_date)
+        )
 
-def get_subscription_duration(user_id):
-    conn = create_connection()
-    cur = conn.cursor()
+        conn.commit()
 
-    # Execute a query
-    cur.execute(
-        "SELECT duration FROM vip WHERE user_id = %s", (user_id,)
-    )
 
-    # Fetch the first row
-    row = cur.fetchone()
+def get_subscription_duration(user_id):
+    with connection() as (conn, cur):
+        # Execute a query
+        cur.execute(
+            "SELECT duration FROM vip WHERE user_id = %s", (user_id,)
+        )
 
-    # Close communication with the database
-    cur.close()
-    conn.close()
+        # Fetch the first row
+        row = cur.fetchone()
+
+        # Close communication with the database
+        cur.close()
 
     if row:
         # If a row was found, return the duration
@@ -172,17 +205,13 @@ def get_subscription_duration(user_id):
         return None
 
 def get_invite_link(user_id):
-    conn = create_connection()
-    cur = conn.cursor()
-
-    # Execute a query
-    cur.execute(
-        "SELECT link FROM vip WHERE user_id = %s", (user_id,)
-    )
-
-    result = cur.fetchone()
+    with connection() as (conn, cur):
+        # Execute a query
+        cur.execute(
+            "SELECT link FROM vip WHERE user_id = %s", (user_id,)
+        )
 
-    close_connection(conn)
+        result = cur.fetchone()
 
     if result is not None:
         return result[0]  # Return the amount
@@ -191,41 +220,18 @@ def get_invite_link(user_id):
 
 
 
-def check_invoice_id(invoice_id):
-    conn = create_connection()
-    cur = conn.cursor()
-    
-    cur.execute(sql.SQL('SELECT * FROM invoices WHERE invoice_id=%s'), (invoice_id,))
-    
-    result = cur.fetchone()
-    close_connection(conn)
-
-    logger.info(f'Checking existence of invoice_id={invoice_id} in database. Found? {"Yes" if result else "No"}')
-
-    if result is None:
-        return False  # The invoice_id does not exist in the database
-    else:
-        return True  # The invoice_id exists in the database
-
-
 def add_customer_details():
-    conn = create_connection()
-    cur = conn.cursor()
-
-    cur.execute(sql.SQL("ALTER TABLE invoices ADD COLUMN IF NOT EXISTS name TEXT, ADD COLUMN IF NOT EXISTS username TEXT, ADD COLUMN IF NOT EXISTS user_id INTEGER"))
+    with connection() as (conn, cur):
+        cur.execute(sql.SQL("ALTER TABLE invoices ADD COLUMN IF NOT EXISTS name TEXT, ADD COLUMN IF NOT EXISTS username TEXT, ADD COLUMN IF NOT EXISTS user_id INTEGER"))
     
-    conn.commit()
-    close_connection(conn)
+        conn.commit()
     
     return result is not None
 
 def get_kickdate(user_id):
-    conn = create_connection()
-
-    cur = conn.cursor()
-    
-    cur.execute("SELECT kick_date FROM vip WHERE user_id = %s", (user_id,))
-    result = cur.fetchone()
+    with connection() as (conn, cur):
+        cur.execute("SELECT kick_date FROM vip WHERE user_id = %s", (user_id,))
+        result = cur.fetchone()
 
     if result is not None:
         return result[0]
@@ -234,27 +240,20 @@ def get_kickdate(user_id):
 
 
 def update_invoice_date(invoice_id):
-    conn = create_connection()
-    cur = conn.cursor()
+    with connection() as (conn, cur):
+        # Get current time in UTC+3 timezone
+        current_time = datetime.now(pytz.timezone('Europe/Moscow'))  # Moscow is in the UTC+3 timezone
 
-    # Get current time in UTC+3 timezone
-    current_time = datetime.now(pytz.timezone('Europe/Moscow'))  # Moscow is in the UTC+3 timezone
+        # Update the Date column for this invoice
+        cur.execute(sql.SQL("UPDATE invoices SET Date=%s WHERE invoice_id=%s"), (current_time, invoice_id))
 
-    # Update the Date column for this invoice
-    cur.execute(sql.SQL("UPDATE invoices SET Date=%s WHERE invoice_id=%s"), (current_time, invoice_id))
-
-    conn.commit()
-    close_connection(conn)
+        conn.commit()
 
 
 def get_invoice_amount(invoice_id):
-    conn = create_connection()
-    cur = conn.cursor()
-    
-    cur.execute(sql.SQL('SELECT amount FROM invoices WHERE invoice_id=%s'), (invoice_id,))
-    result = cur.fetchone()
-
-    close_connection(conn)
+    with connection() as (conn, cur):
+        cur.execute(sql.SQL('SELECT amount FROM invoices WHERE invoice_id=%s'), (invoice_id,))
+        result = cur.fetchone()
 
     if result is not None:
         return result[0]  # Return the amount
@@ -263,14 +262,10 @@ def get_invoice_amount(invoice_id):
 
 
 def get_last_invoice_id_for_user(user_id):
-    conn = create_connection()
-    cur = conn.cursor()
-
-    cur.execute(sql.SQL('SELECT invoice_id FROM invoices WHERE user_id=%s ORDER BY date DESC LIMIT 1'), (user_id,))
+    with connection() as (conn, cur):
+        cur.execute(sql.SQL('SELECT invoice_id FROM invoices WHERE user_id=%s ORDER BY date DESC LIMIT 1'), (user_id,))
 
-    result = cur.fetchone()
-
-    close_connection(conn)
+        result = cur.fetchone()
 
     return result[0] if result else None
 
@@ -278,13 +273,9 @@ def get_last_invoice_id_for_user(user_id):
 def get_invoice_details(invoice_id):
     logger.info("Fetching invoice details for invoice_id: %s", invoice_id)
 
-    conn = create_connection()
-    cur = conn.cursor()
-
-    cur.execute(sql.SQL('SELECT user_id, invoice_id, amount, product, name, username, subscription_length FROM invoices WHERE invoice_id=%s'), (invoice_id,))
-    result = cur.fetchone()
-
-    close_connection(conn)
+    with connection() as (conn, cur):
+        cur.execute(sql.SQL('SELECT user_id, invoice_id, amount, product, name, username, subscription_length FROM invoices WHERE invoice_id=%s'), (invoice_id,))
+        result = cur.fetchone()
     
     if result is None:
         logger.warning("No result found for invoice_id: %s", invoice_id)
@@ -305,143 +296,324 @@ def get_invoice_details(invoice_id):
         
 
 def update_vip_status(user_id):
-    conn = create_connection()
-    cur = conn.cursor()
-
-    # Update status
-    cur.execute("UPDATE vip SET paid = true WHERE user_id = %s", (user_id,))
+    with connection() as (conn, cur):
+        # Update status
+        cur.execute("UPDATE vip SET paid = true WHERE user_id = %s", (user_id,))
 
-    conn.commit()
-    close_connection(conn)
+        conn.commit()
 
 
 
 def update_invoice_status(invoice_id: str, new_status: str) -> None:
-    conn = create_connection()
-    cur = conn.cursor()
-
-    # Update status
-    cur.execute(sql.SQL("UPDATE invoices SET status = %s WHERE invoice_id = %s"),
-                (new_status, invoice_id))
-
-    conn.commit()
-    close_connection(conn)
-
-
-def generate_sales_book_report(start_date, end_date):
-    conn = create_connection()
-    cur = conn.cursor()
+    with connection() as (conn, cur):
+        if backend.dialect == 'sqlite':
+            change = _update_invoice_status_sqlite(cur, invoice_id, new_status)
+        else:
+            # Update status, and move the invoice in or out of the daily rollup and the
+            # customer's totals when it starts or stops being PAID
+            cur.execute("""
+                WITH previous AS (
+                    SELECT invoice_id, status FROM invoices WHERE invoice_id = %(invoice_id)s FOR UPDATE
+                ),
+                updated AS (
+                    UPDATE invoices i
+                    SET status = %(status)s,
+                        paid_at = CASE WHEN %(status)s = 'PAID' AND p.status IS DISTINCT FROM 'PAID' THEN NOW() ELSE i.paid_at END
+                    FROM previous p
+                    WHERE i.invoice_id = p.invoice_id
+                    RETURNING i.user_id, i.date, i.salesman, i.product, i.type, i.amount,
+                              CASE WHEN i.status = 'PAID' AND p.status IS DISTINCT FROM 'PAID' THEN 1
+                                   WHEN i.status IS DISTINCT FROM 'PAID' AND p.status = 'PAID' THEN -1
+                              END AS delta
+                ),
+                rollup AS (
+                    INSERT INTO daily_sales_rollup AS r (day, salesman, product, type, deals, revenue)
+                    SELECT (date AT TIME ZONE 'Europe/Moscow')::date, COALESCE(salesman, ''), COALESCE(product, ''), COALESCE(type, ''),
+                           delta, delta * COALESCE(amount, 0)
+                    FROM updated
+                    WHERE delta IS NOT NULL
+                    ON CONFLICT (day, salesman, product, type) DO UPDATE
+                    SET deals = r.deals + EXCLUDED.deals, revenue = r.revenue + EXCLUDED.revenue
+                )
+                SELECT user_id, delta, date, amount, type FROM updated
+            """, {'invoice_id': invoice_id, 'status': new_status})
+            result = cur.fetchone()
+
+            change = None
+            if result is not None and result[1] is not None:
+                user_id, delta, date, amount, invoice_type = result
+                refresh_customer(cur, user_id)
+                change = invoice_change(date, user_id, amount, invoice_type, delta, customer_totals(cur, user_id))
+
+        conn.commit()
+
+    if change is not None:
+        notify_invoice_changed(change)
+
+
+def _update_invoice_status_sqlite(cur, invoice_id, new_status):
+    # Same effect as the Postgres statement, as separate statements under SQLite's write lock.
+    # Returns the invoice change if it started or stopped counting as paid.
+    cur.execute("BEGIN IMMEDIATE")
+    cur.execute("SELECT status, user_id, date, salesman, product, type, amount FROM invoices WHERE invoice_id = %s", (invoice_id,))
+    row = cur.fetchone()
+    if row is None:
+        return None
 
-    query = sql.SQL("""
-        SELECT invoice_id, amount, date, name, username, user_id, type
-        FROM invoices
-        WHERE status = 'PAID'
-        AND date BETWEEN %s AND %s
-    """)
+    previous_status, user_id, date, salesman, product, invoice_type, amount = row
+    cur.execute("UPDATE invoices SET status = %s WHERE invoice_id = %s", (new_status, invoice_id))
 
-    cur.execute(query, (start_date, end_date))
+    if new_status == 'PAID' and previous_status != 'PAID':
+        delta = 1
+        cur.execute("UPDATE invoices SET paid_at = NOW() WHERE invoice_id = %s", (invoice_id,))
+    elif new_status != 'PAID' and previous_status == 'PAID':
+        delta = -1
+    else:
+        return None
 
-    result_set = cur.fetchall()
+    add_to_rollup(cur, date, salesman, product, invoice_type, delta, delta * (amount or 0))
+    refresh_customer(cur, user_id)
+    return invoice_change(date, user_id, amount, invoice_type, delta, customer_totals(cur, user_id))
 
-    # Log the result set
-    logger.info(f'Result set: {result_set}')
 
-    close_connection(conn)
-    
-    logger.info(f'Result set: {result_set}')  # <--- Log the result set.
-
-    if result_set:
-        formatted_report = []
+def add_to_rollup(cur, invoice_date, salesman, product, invoice_type, deals, revenue):
+    cur.execute("""
+        INSERT INTO daily_sales_rollup AS r (day, salesman, product, type, deals, revenue)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON CONFLICT (day, salesman, product, type) DO UPDATE
+        SET deals = r.deals + EXCLUDED.deals, revenue = r.revenue + EXCLUDED.revenue
+    """, (moscow_date(invoice_date), salesman or '', product or '', invoice_type or '', deals, revenue))
+
+
+def approve_invoice(invoice_id, invoice_type):
+    """Mark the invoice as PAID with the given type, count it in the daily rollup and the
+    customer's totals and extend or create the VIP subscription in one statement (one
+    transaction on SQLite), so an approval is applied completely or not at all.
+
+    Returns the invoice details together with `kick_date` and `screenshot_id`, or None
+    if the invoice does not exist or was already approved.
+    """
+    with connection() as (conn, cur):
+        if backend.dialect == 'sqlite':
+            result = _approve_invoice_sqlite(cur, invoice_id, invoice_type)
+        else:
+            cur.execute("""
+                WITH approved AS (
+                    UPDATE invoices
+                    SET status = 'PAID', type = %(invoice_type)s, paid_at = NOW()
+                    WHERE invoice_id = %(invoice_id)s AND status IS DISTINCT FROM 'PAID'
+                    RETURNING user_id, invoice_id, amount, product, name, username, subscription_length, screenshot_id, date, salesman
+                ),
+                rollup AS (
+                    INSERT INTO daily_sales_rollup AS r (day, salesman, product, type, deals, revenue)
+                    SELECT (date AT TIME ZONE 'Europe/Moscow')::date, COALESCE(salesman, ''), COALESCE(product, ''), %(invoice_type)s, 1, COALESCE(amount, 0)
+                    FROM approved
+                    ON CONFLICT (day, salesman, product, type) DO UPDATE
+                    SET deals = r.deals + EXCLUDED.deals, revenue = r.revenue + EXCLUDED.revenue
+                ),
+                customer AS (
+                    INSERT INTO customers AS c (user_id, name, username, first_paid_at, last_paid_at, paid_count, paid_total)
+                    SELECT user_id, name, username, date, date, 1, COALESCE(amount, 0)
+                    FROM approved
+                    WHERE user_id IS NOT NULL
+                    ON CONFLICT (user_id) DO UPDATE
+                    SET name = CASE WHEN EXCLUDED.last_paid_at >= c.last_paid_at THEN EXCLUDED.name ELSE c.name END,
+                        username = CASE WHEN EXCLUDED.last_paid_at >= c.last_paid_at THEN EXCLUDED.username ELSE c.username END,
+                        first_paid_at = LEAST(c.first_paid_at, EXCLUDED.first_paid_at),
+                        last_paid_at = GREATEST(c.last_paid_at, EXCLUDED.last_paid_at),
+                        paid_count = c.paid_count + 1,
+                        paid_total = c.paid_total + EXCLUDED.paid_total
+                    RETURNING first_paid_at, paid_total
+                ),
+                subscription AS (
+                    INSERT INTO vip AS v (name, username, user_id, duration, kick_date, paid)
+                    SELECT name, username, user_id, subscription_length, NOW() + subscription_length * INTERVAL '1 day', TRUE
+                    FROM approved
+                    WHERE subscription_length IS NOT NULL
+                    ON CONFLICT (user_id) DO UPDATE
+                    SET duration = v.duration + EXCLUDED.duration,
+                        kick_date = GREATEST(v.kick_date, NOW()) + EXCLUDED.duration * INTERVAL '1 day',
+                        renewal_times = v.renewal_times + 1,
+                        paid = TRUE,
+                        expired_at = NULL
+                    RETURNING kick_date
+                )
+                SELECT a.user_id, a.invoice_id, a.amount, a.product, a.name, a.username, a.subscription_length,
+                       a.screenshot_id, COALESCE(s.kick_date, v.kick_date), a.date, c.first_paid_at, COALESCE(c.paid_total, 0)
+                FROM approved a
+                LEFT JOIN subscription s ON TRUE
+                LEFT JOIN customer c ON TRUE
+                LEFT JOIN vip v ON v.user_id = a.user_id
+            """, {'invoice_id': invoice_id, 'invoice_type': invoice_type})
+            result = cur.fetchone()
+
+        conn.commit()
+
+    return _approved_invoice_details(invoice_id, invoice_type, result)
+
+
+def _approve_invoice_sqlite(cur, invoice_id, invoice_type):
+    # Same effect as the Postgres statement, as separate statements under SQLite's write lock
+    cur.execute("BEGIN IMMEDIATE")
+    cur.execute("""
+        UPDATE invoices
+        SET status = 'PAID', type = %(invoice_type)s, paid_at = NOW()
+        WHERE invoice_id = %(invoice_id)s AND status IS DISTINCT FROM 'PAID'
+        RETURNING user_id, invoice_id, amount, product, name, username, subscription_length, screenshot_id, date, salesman
+    """, {'invoice_id': invoice_id, 'invoice_type': invoice_type})
+    approved = cur.fetchone()
+    if approved is None:
+        return None
 
-        for row in result_set:
-            invoice_id, amount, date, name, username, user_id, type = row
-            # Convert the date to your desired format.
-            formatted_date = date.strftime("%Y-%m-%d %H:%M")
-            formatted_report.append([invoice_id, amount, formatted_date, name, username, user_id, type])
+    user_id, _, amount, product, name, username, subscription_length, _, date, salesman = approved
+
+    add_to_rollup(cur, date, salesman, product, invoice_type, 1, amount or 0)
+
+    # Like Postgres, invoices without a user are not counted as a customer (SQLite
+    # would accept a NULL primary key)
+    if user_id is not None:
+        cur.execute("""
+            INSERT INTO customers AS c (user_id, name, username, first_paid_at, last_paid_at, paid_count, paid_total)
+            VALUES (%(user_id)s, %(name)s, %(username)s, %(date)s, %(date)s, 1, %(amount)s)
+            ON CONFLICT (user_id) DO UPDATE
+            SET name = CASE WHEN EXCLUDED.last_paid_at >= c.last_paid_at THEN EXCLUDED.name ELSE c.name END,
+                username = CASE WHEN EXCLUDED.last_paid_at >= c.last_paid_at THEN EXCLUDED.username ELSE c.username END,
+                first_paid_at = LEAST(c.first_paid_at, EXCLUDED.first_paid_at),
+                last_paid_at = GREATEST(c.last_paid_at, EXCLUDED.last_paid_at),
+                paid_count = c.paid_count + 1,
+                paid_total = c.paid_total + EXCLUDED.paid_total
+        """, {'user_id': user_id, 'name': name, 'username': username, 'date': date, 'amount': amount or 0})
 
-        return formatted_report
-    else:
+    cur.execute("SELECT kick_date FROM vip WHERE user_id = %s", (user_id,))
+    row = cur.fetchone()
+    kick_date = row[0] if row else None
+
+    if subscription_length is not None:
+        now = datetime.now(MOSCOW)
+        kick_date = max(kick_date, now) if kick_date else now
+        kick_date += timedelta(days=subscription_length)
+        cur.execute("""
+            INSERT INTO vip AS v (name, username, user_id, duration, kick_date, paid)
+            VALUES (%s, %s, %s, %s, %s, TRUE)
+            ON CONFLICT (user_id) DO UPDATE
+            SET duration = v.duration + EXCLUDED.duration,
+                kick_date = EXCLUDED.kick_date,
+                renewal_times = v.renewal_times + 1,
+                paid = TRUE,
+                expired_at = NULL
+        """, (name, username, user_id, subscription_length, kick_date))
+
+    return approved[:8] + (kick_date, date) + customer_totals(cur, user_id)
+
+
+def _approved_invoice_details(invoice_id, invoice_type, result):
+    if result is None:
+        logger.warning("Invoice %s was not approved: not found or already paid", invoice_id)
         return None
 
+    details = {
+        "user_id": result[0],
+        "invoice_id": result[1],
+        "amount": result[2],
+        "product": result[3],
+        "name": result[4],
+        "username": result[5],
+        "subscription_length": result[6],
+        "screenshot_id": result[7],
+        "kick_date": result[8],
+        "date": result[9]
+    }
+
+    # The transaction is committed by now, let the expiry scheduler pick up the new date
+    if details["subscription_length"] is not None:
+        notify_subscription_changed(details["user_id"], details["kick_date"])
+    notify_invoice_changed(invoice_change(details["date"], details["user_id"], details["amount"], invoice_type, 1, result[10:12]))
+
+    return details
+
+
+def generate_sales_book_report(start_date, end_date, file):
+    """Write the sales book for the period as CSV into `file`, returns the number of rows."""
+    with connection() as (conn, cur):
+        query = """
+            SELECT invoice_id AS "Invoice ID",
+                   amount AS "Amount",
+                   to_char(date, 'YYYY-MM-DD HH24:MI') AS "Date",
+                   name AS "Name",
+                   username AS "Username",
+                   user_id AS "User ID",
+                   type AS "In/Out"
+            FROM invoices
+            WHERE status = 'PAID'
+            AND date BETWEEN %s AND %s
+            ORDER BY date
+        """
 
-def generate_clients_book_report(start_date, end_date):
-    logger.info(f"Querying data for generate_clients_book_report for range: {start_date} - {end_date}")
-    
-    conn = create_connection()
-    cur = conn.cursor()
-
-    query = sql.SQL("""
-        SELECT user_id, username, name, MIN(date) as first_deal_date, MAX(date) as last_deal_date, COUNT(*) as total_deals, SUM(amount) as total_amount
-        FROM invoices
-        WHERE status = 'PAID'
-        AND date BETWEEN %s AND %s
-        GROUP BY user_id, username, name
-    """)
+        row_count = backend.copy_to_csv(cur, query, (start_date, end_date), file)
 
-    logger.info(f"Executing SQL: {query}")
+    logger.info(f'Sales book for {start_date} - {end_date}: {row_count} rows')
 
-    cur.execute(query, (start_date, end_date))
+    return row_count
 
-    result_set = cur.fetchall()
-   
-    logger.info("Start date: %s", start_date)
-    logger.info("End date: %s", end_date)
-    logger.info("Result set: %s", result_set)
 
-    
-    close_connection(conn)
+def generate_clients_book_report(start_date, end_date, file):
+    """Write the clients book for the period as CSV into `file`, returns the number of rows."""
+    with connection() as (conn, cur):
+        # One row per client: latest name and first ever deal come from the customers
+        # table, the rest is aggregated over the period
+        query = """
+            SELECT p.user_id AS "Client ID",
+                   c.username AS "Username",
+                   c.name AS "Name",
+                   to_char(c.first_paid_at, 'YYYY-MM-DD HH24:MI') AS "Date of First Deal",
+                   to_char(p.last_deal_date, 'YYYY-MM-DD HH24:MI') AS "Date of Last Deal",
+                   p.total_deals AS "Total Deals",
+                   p.total_amount AS "Total Amount"
+            FROM (
+                SELECT user_id, MAX(date) AS last_deal_date, COUNT(*) AS total_deals, SUM(amount) AS total_amount
+                FROM invoices
+                WHERE status = 'PAID'
+                AND date BETWEEN %s AND %s
+                GROUP BY user_id
+            ) p
+            LEFT JOIN customers c ON c.user_id = p.user_id
+        """
 
-    if result_set:
-        formatted_report = []
+        row_count = backend.copy_to_csv(cur, query, (start_date, end_date), file)
 
-        for row in result_set:
-            user_id, username, name, first_deal_date, last_deal_date, total_deals, total_amount = row
-            # Convert the date to your desired format.
-            formatted_first_deal_date = first_deal_date.strftime("%Y-%m-%d %H:%M")
-            formatted_last_deal_date = last_deal_date.strftime("%Y-%m-%d %H:%M")
-            formatted_report.append([user_id, username, name, formatted_first_deal_date, formatted_last_deal_date, total_deals, total_amount])
+    logger.info(f'Clients book for {start_date} - {end_date}: {row_count} rows')
 
-        return formatted_report
-    else:
-        return None
+    return row_count
 
 
 def add_screenshot_id(invoice_id, message_id):
-    conn = create_connection()
-
-    cur = conn.cursor()
-
-    cur.execute(
-        """
-        UPDATE invoices
-        SET screenshot_id = %s
-        WHERE invoice_id = %s
-        """, 
-        (message_id, invoice_id)
-    )
+    with connection() as (conn, cur):
+        cur.execute(
+            """
+            UPDATE invoices
+            SET screenshot_id = %s
+            WHERE invoice_id = %s
+            """, 
+            (message_id, invoice_id)
+        )
 
-    conn.commit()
-    cur.close()
-    conn.close()
+        conn.commit()
+        cur.close()
 
 def get_screenshot_id(invoice_id):
-    conn = create_connection()
-
-    cur = conn.cursor()
-
-    cur.execute(
-        """
-        SELECT screenshot_id
-        FROM invoices
-        WHERE invoice_id = %s
-        """, 
-        (invoice_id,)
-    )
+    with connection() as (conn, cur):
+        cur.execute(
+            """
+            SELECT screenshot_id
+            FROM invoices
+            WHERE invoice_id = %s
+            """, 
+            (invoice_id,)
+        )
 
-    result = cur.fetchone()
+        result = cur.fetchone()
 
-    cur.close()
-    conn.close()
+        cur.close()
 
     if result is not None:
         return result[0]  # return the message id
@@ -449,12 +621,9 @@ def get_screenshot_id(invoice_id):
         return None
 
 def get_invoice_status(invoice_id):
-    conn = create_connection()
-
-    cur = conn.cursor()
-    
-    cur.execute("SELECT status FROM invoices WHERE invoice_id = %s", (invoice_id,))
-    result = cur.fetchone()
+    with connection() as (conn, cur):
+        cur.execute("SELECT status FROM invoices WHERE invoice_id = %s", (invoice_id,))
+        result = cur.fetchone()
 
     if result is not None:
         return result[0]
@@ -463,20 +632,17 @@ def get_invoice_status(invoice_id):
 
 def get_invoice_by_invite_link(invite_link):
     try:
-        conn = create_connection()
-        cur = conn.cursor()
-        
-        query = """
-        SELECT * FROM invoices
-        WHERE invite_link = %s;
-        """
+        with connection() as (conn, cur):
+            query = """
+            SELECT * FROM invoices
+            WHERE invite_link = %s;
+            """
     
-        cur.execute(query, (invite_link,))
+            cur.execute(query, (invite_link,))
 
-        result = cur.fetchone()
+            result = cur.fetchone()
  
-        cur.close()
-        conn.close()
+            cur.close()
      
         return result
     except Exception as e:
@@ -485,114 +651,134 @@ def get_invoice_by_invite_link(invite_link):
 
 
 def get_total_income(start_date, end_date):
-    conn = create_connection()
-    cur = conn.cursor()
-    
-    cur.execute("""
-        SELECT SUM(amount) 
-        FROM invoices 
-        WHERE date BETWEEN %s AND %s AND status = 'PAID'
-    """, (start_date, end_date))
+    with connection() as (conn, cur):
+        cur.execute("""
+            SELECT SUM(amount) 
+            FROM invoices 
+            WHERE date BETWEEN %s AND %s AND status = 'PAID'
+        """, (start_date, end_date))
     
-    result = cur.fetchone()
-    close_connection(conn)
+        result = cur.fetchone()
     
     return result[0] if result[0] is not None else 0
 
 
 def get_deal_quantity(start_date, end_date):
-    conn = create_connection()
-    cur = conn.cursor()
-    
-    cur.execute("""
-        SELECT COUNT(*) 
-        FROM invoices 
-        WHERE date BETWEEN %s AND %s AND status = 'PAID'
-    """, (start_date, end_date))
+    with connection() as (conn, cur):
+        cur.execute("""
+            SELECT COUNT(*) 
+            FROM invoices 
+            WHERE date BETWEEN %s AND %s AND status = 'PAID'
+        """, (start_date, end_date))
     
-    result = cur.fetchone()
-    close_connection(conn)
+        result = cur.fetchone()
     
     return result[0] if result[0] is not None else 0
 
 def get_unique_customers(start_date, end_date):
-    conn = create_connection()
-    cur = conn.cursor()
-    
-    cur.execute("""
-        SELECT COUNT(DISTINCT user_id) 
-        FROM invoices 
-        WHERE date BETWEEN %s AND %s AND status = 'PAID'
-    """, (start_date, end_date))
+    with connection() as (conn, cur):
+        cur.execute("""
+            SELECT COUNT(DISTINCT user_id) 
+            FROM invoices 
+            WHERE date BETWEEN %s AND %s AND status = 'PAID'
+        """, (start_date, end_date))
     
-    result = cur.fetchone()
-    close_connection(conn)
+        result = cur.fetchone()
     
     return result[0] if result[0] is not None else 0
 
 def get_new_customers(start_date, end_date):
-    conn = create_connection()
-    cur = conn.cursor()
+    with connection() as (conn, cur):
+        cur.execute("""
+            SELECT COUNT(*) 
+            FROM customers
+            WHERE first_paid_at BETWEEN %s AND %s
+        """, (start_date, end_date))
     
-    cur.execute("""
-        SELECT COUNT(*) 
-        FROM (
-            SELECT user_id, MIN(date) as first_purchase_date 
-            FROM invoices 
-            WHERE status = 'PAID' 
-            GROUP BY user_id
-        ) AS user_first_purchases
-        WHERE first_purchase_date BETWEEN %s AND %s
-    """, (start_date, end_date))
-    
-    result = cur.fetchone()
-    close_connection(conn)
+        result = cur.fetchone()
     
     return result[0] if result[0] is not None else 0
 
 def get_income_from_new_customers(start_date, end_date):
-    conn = create_connection()
-    cur = conn.cursor()
-    
-    cur.execute("""
-        SELECT SUM(invoices.amount) 
-        FROM invoices
-        INNER JOIN (
-            SELECT user_id, MIN(date) as first_purchase_date 
-            FROM invoices 
-            WHERE status = 'PAID' 
-            GROUP BY user_id
-        ) AS user_first_purchases ON invoices.user_id = user_first_purchases.user_id
-        WHERE first_purchase_date BETWEEN %s AND %s AND status = 'PAID'
-    """, (start_date, end_date))
+    with connection() as (conn, cur):
+        cur.execute("""
+            SELECT SUM(i.amount)
+            FROM customers c
+            JOIN invoices i ON i.user_id = c.user_id
+            WHERE c.first_paid_at BETWEEN %(start_date)s AND %(end_date)s
+              AND i.status = 'PAID' AND i.date BETWEEN %(start_date)s AND %(end_date)s
+        """, {'start_date': start_date, 'end_date': end_date})
     
-    result = cur.fetchone()
-    close_connection(conn)
+        result = cur.fetchone()
     
     return result[0] if result[0] is not None else 0
 
+
+# Builds customers rows from paid invoices, name and username are taken from the latest one
+CUSTOMERS_FROM_INVOICES_SQL = """
+    INSERT INTO customers (user_id, name, username, first_paid_at, last_paid_at, paid_count, paid_total)
+    SELECT p.user_id,
+           (SELECT l.name FROM invoices l WHERE l.user_id = p.user_id AND l.status = 'PAID' ORDER BY l.date DESC LIMIT 1),
+           (SELECT l.username FROM invoices l WHERE l.user_id = p.user_id AND l.status = 'PAID' ORDER BY l.date DESC LIMIT 1),
+           p.first_paid_at, p.last_paid_at, p.paid_count, p.paid_total
+    FROM (
+        SELECT user_id, MIN(date) AS first_paid_at, MAX(date) AS last_paid_at, COUNT(*) AS paid_count, COALESCE(SUM(amount), 0) AS paid_total
+        FROM invoices
+        WHERE status = 'PAID' AND user_id IS NOT NULL {condition}
+        GROUP BY user_id
+    ) p
+"""
+
+
+def customer_totals(cur, user_id):
+    # (first_paid_at, paid_total) of one customer, (None, 0) if they have no paid invoices
+    cur.execute("SELECT first_paid_at, paid_total FROM customers WHERE user_id = %s", (user_id,))
+    row = cur.fetchone()
+    return (row[0], row[1]) if row else (None, 0)
+
+
+def refresh_customer(cur, user_id):
+    # Recompute one customer after one of their invoices stopped or started being PAID,
+    # runs in the caller's transaction
+    cur.execute("DELETE FROM customers WHERE user_id = %s", (user_id,))
+    cur.execute(CUSTOMERS_FROM_INVOICES_SQL.format(condition="AND user_id = %s"), (user_id,))
+
+
+def rebuild_customers():
+    """Recompute the customers table from the invoices table, returns the number of customers."""
+    with connection() as (conn, cur):
+        backend.lock_tables(cur, 'customers')
+        cur.execute("DELETE FROM customers")
+        cur.execute(CUSTOMERS_FROM_INVOICES_SQL.format(condition=""))
+        row_count = cur.rowcount
+
+        conn.commit()
+
+    logger.info(f'Rebuilt customers: {row_count} rows')
+    return row_count
+
 def add_card(card_number: str, bank: str):
-    conn = create_connection()
-    cur = conn.cursor()
+    with connection() as (conn, cur):
+        # Add the new card number to the table and set it as the current card
+        cur.execute(sql.SQL("""
+            INSERT INTO cards (card_number, bank, is_current)
+            VALUES (%s, %s, false)
+        """), (card_number, bank))
 
-    # Add the new card number to the table and set it as the current card
-    cur.execute(sql.SQL("""
-        INSERT INTO cards (card_number, bank, is_current)
-        VALUES (%s, %s, false)
-    """), (card_number, bank))
+        # Save (commit) the changes and close the connection
+        conn.commit()
 
-    # Save (commit) the changes and close the connection
-    conn.commit()
-    close_connection(conn)
+    config_cache.invalidate('current_card')
 
 
 def get_current_card_and_bank():
-    conn = create_connection()
-    cur = conn.cursor()
-    
-    cur.execute("SELECT card_number, bank FROM cards WHERE is_current = TRUE LIMIT 1;")
-    current_card_and_bank = cur.fetchone()
-    close_connection(conn)
+    return config_cache.get('current_card', _load_current_card_and_bank)
+
+
+def _load_current_card_and_bank():
+    with connection() as (conn, cur):
+        cur.execute("SELECT card_number, bank FROM cards WHERE is_current = TRUE LIMIT 1;")
+        current_card_and_bank = cur.fetchone()
 
     if current_card_and_bank is not None:
         return current_card_and_bank  # Fetch the card number and bank from the tuple
@@ -601,238 +787,501 @@ def get_current_card_and_bank():
 
 
 def check_vip_user(user_id):
-    conn = create_connection()
-    cur = conn.cursor()
-
-    cur.execute("SELECT COUNT(*) FROM vip WHERE user_id = %s", (user_id,))
-    result = cur.fetchone()[0]
-
-    close_connection(conn)
+    with connection() as (conn, cur):
+        cur.execute("SELECT COUNT(*) FROM vip WHERE user_id = %s", (user_id,))
+        result = cur.fetchone()[0]
     
     return result > 0  # Returns True if user is in vip table, False otherwise
 
 def update_vip_subscription(user_id, subscription_length):
-    conn = create_connection()
-    cur = conn.cursor()
+    with connection() as (conn, cur):
+        # Get current date in the UTC timezone
+        current_date = datetime.now(pytz.timezone('Europe/Moscow'))
 
-    # Get current date in the UTC timezone
-    current_date = datetime.now(pytz.timezone('Europe/Moscow'))
+        # Check if user is already in the table
+        cur.execute(sql.SQL("SELECT duration, kick_date, renewal_times FROM vip WHERE user_id = %s"), (user_id,))
 
-    # Check if user is already in the table
-    cur.execute(sql.SQL("SELECT duration, kick_date, renewal_times FROM vip WHERE user_id = %s"), (user_id,))
+        row = cur.fetchone()
 
-    row = cur.fetchone()
+        if row is None:  # If the user is not in the table yet, return False
+            return False
 
-    if row is None:  # If the user is not in the table yet, return False
-        return False
+        current_duration, current_kick_date, current_renewal_times = row[0], row[1], row[2]
 
-    current_duration, current_kick_date, current_renewal_times = row[0], row[1], row[2]
+        # If the current_kick_date is in the future, use it as the starting point
+        if current_kick_date > current_date:
+            base_date = current_kick_date
+        else:  # Otherwise, use the current date as the starting point
+            base_date = current_date
 
-    # If the current_kick_date is in the future, use it as the starting point
-    if current_kick_date > current_date:
-        base_date = current_kick_date
-    else:  # Otherwise, use the current date as the starting point
-        base_date = current_date
+        # Calculate new duration, kick_date and renewal times
+        updated_duration = current_duration + subscription_length
+        updated_kick_date = base_date + timedelta(days=subscription_length)
+        updated_renewal_times = current_renewal_times + 1  # Increment renewal times
 
-    # Calculate new duration, kick_date and renewal times
-    updated_duration = current_duration + subscription_length
-    updated_kick_date = base_date + timedelta(days=subscription_length)
-    updated_renewal_times = current_renewal_times + 1  # Increment renewal times
+        # Update the vip table
+        cur.execute(sql.SQL("""
+            UPDATE vip 
+            SET duration = %s, kick_date = %s, renewal_times = %s, expired_at = NULL
+            WHERE user_id = %s
+            """), (updated_duration, updated_kick_date, updated_renewal_times, user_id))
 
-    # Update the vip table
-    cur.execute(sql.SQL("""
-        UPDATE vip 
-        SET duration = %s, kick_date = %s, renewal_times = %s
-        WHERE user_id = %s
-        """), (updated_duration, updated_kick_date, updated_renewal_times, user_id))
+        conn.commit()
 
-    conn.commit()
-    close_connection(conn)
+    notify_subscription_changed(user_id, updated_kick_date)
     
     return True  # If the user's subscription was successfully updated, return True
 
 
 def get_vip_subscription(user_id):
-    conn = create_connection()
-    cur = conn.cursor()
+    with connection() as (conn, cur):
+        # Fetch user's subscription details
+        cur.execute(sql.SQL("SELECT kick_date, renewal_times FROM vip WHERE user_id = %s"), (user_id,))
 
-    # Fetch user's subscription details
-    cur.execute(sql.SQL("SELECT kick_date, renewal_times FROM vip WHERE user_id = %s"), (user_id,))
+        row = cur.fetchone()
 
-    row = cur.fetchone()
+        # Close the connection
 
     if row is None:  # If the user is not in the table yet, return None
         return None
 
     kick_date, renewal_times = row[0], row[1]
 
-    # Close the connection
-    close_connection(conn)
-
     # Return subscription details
     return {'kick_date': kick_date, 'renewal_times': renewal_times}
 
 
 
 def set_current_card(card_number: str):
-    conn = create_connection()
-    cur = conn.cursor()
+    with connection() as (conn, cur):
+        # Set all cards to not current
+        cur.execute(sql.SQL("""
+            UPDATE cards SET is_current = false
+        """))
 
-    # Set all cards to not current
-    cur.execute(sql.SQL("""
-        UPDATE cards SET is_current = false
-    """))
+        # Set the specified card as current
+        cur.execute(sql.SQL("""
+            UPDATE cards SET is_current = true
+            WHERE card_number = %s
+        """), (card_number,))
 
-    # Set the specified card as current
-    cur.execute(sql.SQL("""
-        UPDATE cards SET is_current = true
-        WHERE card_number = %s
-    """), (card_number,))
+        # Save (commit) the changes and close the connection
+        conn.commit()
 
-    # Save (commit) the changes and close the connection
-    conn.commit()
-    close_connection(conn)
+    config_cache.invalidate('current_card')
 
 def get_all_cards():
-    conn = create_connection()
-    cur = conn.cursor()
+    with connection() as (conn, cur):
+        # Query all card numbers and their associated banks from the cards table
+        cur.execute("SELECT card_number, bank FROM cards")
 
-    # Query all card numbers and their associated banks from the cards table
-    cur.execute("SELECT card_number, bank FROM cards")
-
-    # Fetch all results and convert them to a list of dictionaries
-    cards = [{'card_number': row[0], 'bank': row[1]} for row in cur.fetchall()]
-
-    close_connection(conn)
+        # Fetch all results and convert them to a list of dictionaries
+        cards = [{'card_number': row[0], 'bank': row[1]} for row in cur.fetchall()]
     return cards
 
 def delete_card(card_number):
-    conn = create_connection()
-    cur = conn.cursor()
+    with connection() as (conn, cur):
+        # Delete the card number from the table
+        cur.execute(sql.SQL("DELETE FROM cards WHERE card_number = %s"), (card_number,))
 
-    # Delete the card number from the table
-    cur.execute(sql.SQL("DELETE FROM cards WHERE card_number = %s"), (card_number,))
+        # Save (commit) the changes and close the connection
+        conn.commit()
 
-    # Save (commit) the changes and close the connection
-    conn.commit()
-    close_connection(conn)
+    config_cache.invalidate('current_card')
 
 
 def update_invoice_type(invoice_id, type):
-    conn = create_connection()
-    cur = conn.cursor()
-
-    cur.execute(sql.SQL("UPDATE invoices SET type = %s WHERE invoice_id = %s"), (type, invoice_id))
+    with connection() as (conn, cur):
+        cur.execute(sql.SQL("UPDATE invoices SET type = %s WHERE invoice_id = %s"), (type, invoice_id))
 
-    conn.commit()
-    close_connection(conn)
+        conn.commit()
 
            
 
 def get_incoming_deal_quantity(start_date, end_date):
-    conn = create_connection()
-    cur = conn.cursor()
-
-    cur.execute("SELECT COUNT(*) FROM invoices WHERE status = 'PAID' AND type = 'Incoming' AND date BETWEEN %s AND %s", (start_date, end_date))
-    incoming_deal_quantity = cur.fetchone()[0]
-
-    close_connection(conn)
+    with connection() as (conn, cur):
+        cur.execute("SELECT COUNT(*) FROM invoices WHERE status = 'PAID' AND type = 'Incoming' AND date BETWEEN %s AND %s", (start_date, end_date))
+        incoming_deal_quantity = cur.fetchone()[0]
     
     return incoming_deal_quantity
 
 def get_outgoing_deal_quantity(start_date, end_date):
-    conn = create_connection()
-    cur = conn.cursor()
-
-    cur.execute("SELECT COUNT(*) FROM invoices WHERE status = 'PAID' AND type = 'Outgoing' AND date BETWEEN %s AND %s", (start_date, end_date))
-    outgoing_deal_quantity = cur.fetchone()[0]
-
-    close_connection(conn)
+    with connection() as (conn, cur):
+        cur.execute("SELECT COUNT(*) FROM invoices WHERE status = 'PAID' AND type = 'Outgoing' AND date BETWEEN %s AND %s", (start_date, end_date))
+        outgoing_deal_quantity = cur.fetchone()[0]
     
     return outgoing_deal_quantity
 
 
 def get_total_amount_incoming(start_date, end_date):
-    conn = create_connection()
-    cur = conn.cursor()
-
-    cur.execute("SELECT SUM(amount) FROM invoices WHERE status = 'PAID' AND type = 'Incoming' AND date BETWEEN %s AND %s", (start_date, end_date))
-    total_amount_incoming = cur.fetchone()[0]
-
-    close_connection(conn)
+    with connection() as (conn, cur):
+        cur.execute("SELECT SUM(amount) FROM invoices WHERE status = 'PAID' AND type = 'Incoming' AND date BETWEEN %s AND %s", (start_date, end_date))
+        total_amount_incoming = cur.fetchone()[0]
     
     return total_amount_incoming if total_amount_incoming else 0
 
 def get_total_amount_outgoing(start_date, end_date):
-    conn = create_connection()
-    cur = conn.cursor()
-
-    cur.execute("SELECT SUM(amount) FROM invoices WHERE status = 'PAID' AND type = 'Outgoing' AND date BETWEEN %s AND %s", (start_date, end_date))
-    total_amount_outgoing = cur.fetchone()[0]
-
-    close_connection(conn)
+    with connection() as (conn, cur):
+        cur.execute("SELECT SUM(amount) FROM invoices WHERE status = 'PAID' AND type = 'Outgoing' AND date BETWEEN %s AND %s", (start_date, end_date))
+        total_amount_outgoing = cur.fetchone()[0]
     
     return total_amount_outgoing if total_amount_outgoing else 0
 
     
 def get_average_deal_amount(start_date, end_date):
-    conn = create_connection()
-    cur = conn.cursor()
-
-    cur.execute("SELECT AVG(amount) FROM invoices WHERE status = 'PAID' AND date BETWEEN %s AND %s", (start_date, end_date))
-    average_deal_amount = cur.fetchone()[0]
-
-    close_connection(conn)
+    with connection() as (conn, cur):
+        cur.execute("SELECT AVG(amount) FROM invoices WHERE status = 'PAID' AND date BETWEEN %s AND %s", (start_date, end_date))
+        average_deal_amount = cur.fetchone()[0]
     
     return round(average_deal_amount, 2) if average_deal_amount else 0
 
+
+def export_paid_invoices(file):
+    """Write every paid invoice as CSV (user_id, month, amount) into `file`, returns the number
+    of rows. `month` is year * 12 + month - 1 in Moscow time, for the cohort report."""
+    with connection() as (conn, cur):
+        query = """
+            SELECT user_id, {month} AS month, COALESCE(amount, 0) AS amount
+            FROM invoices
+            WHERE status = 'PAID' AND user_id IS NOT NULL
+        """.format(month=dialect_sql({
+            'postgres': "(EXTRACT(YEAR FROM date AT TIME ZONE 'Europe/Moscow') * 12 + EXTRACT(MONTH FROM date AT TIME ZONE 'Europe/Moscow') - 1)::int",
+            # Timestamps are stored in Moscow time
+            'sqlite': "CAST(substr(date, 1, 4) AS INTEGER) * 12 + CAST(substr(date, 6, 2) AS INTEGER) - 1",
+        }))
+
+        row_count = backend.copy_to_csv(cur, query, (), file)
+
+    logger.info(f'Exported {row_count} paid invoices')
+
+    return row_count
+
+
+def get_report_stats(start_date, end_date):
+    with connection() as (conn, cur):
+        # Revenue and deal counts come from the daily rollup, so they cost one row per
+        # day/salesman/product/type. New customers are found in the customers table by first
+        # purchase date, their income and the distinct buyer count read the period's paid invoices.
+        cur.execute("""
+            WITH totals AS (
+                SELECT
+                    COALESCE(SUM(revenue), 0) AS total_income,
+                    COALESCE(SUM(deals), 0) AS deal_quantity,
+                    COALESCE(SUM(deals) FILTER (WHERE type = 'Incoming'), 0) AS incoming_deal_quantity,
+                    COALESCE(SUM(deals) FILTER (WHERE type = 'Outgoing'), 0) AS outgoing_deal_quantity,
+                    COALESCE(SUM(revenue) FILTER (WHERE type = 'Incoming'), 0) AS total_amount_incoming,
+                    COALESCE(SUM(revenue) FILTER (WHERE type = 'Outgoing'), 0) AS total_amount_outgoing
+                FROM daily_sales_rollup
+                WHERE day BETWEEN %(start_day)s AND %(end_day)s
+            ),
+            buyers AS (
+                SELECT COUNT(DISTINCT user_id) AS unique_customers
+                FROM invoices
+                WHERE status = 'PAID' AND date BETWEEN %(start_date)s AND %(end_date)s
+            ),
+            new_customers AS (
+                SELECT COUNT(DISTINCT c.user_id) AS new_customers, COALESCE(SUM(i.amount), 0) AS new_customers_income
+                FROM customers c
+                JOIN invoices i ON i.user_id = c.user_id
+                WHERE c.first_paid_at BETWEEN %(start_date)s AND %(end_date)s
+                  AND i.status = 'PAID' AND i.date BETWEEN %(start_date)s AND %(end_date)s
+            )
+            SELECT t.total_income, t.deal_quantity, b.unique_customers, n.new_customers, n.new_customers_income,
+                   t.incoming_deal_quantity, t.outgoing_deal_quantity, t.total_amount_incoming, t.total_amount_outgoing
+            FROM totals t, buyers b, new_customers n
+        """, {'start_date': start_date, 'end_date': end_date,
+              'start_day': moscow_date(start_date), 'end_day': moscow_date(end_date)})
+        row = cur.fetchone()
+
+    total_income, deal_quantity = row[0], row[1]
+
+    return {
+        "total_income": total_income,
+        "deal_quantity": deal_quantity,
+        "unique_customers": row[2],
+        "new_customers": row[3],
+        "new_customers_income": row[4],
+        "incoming_deal_quantity": row[5],
+        "outgoing_deal_quantity": row[6],
+        "total_amount_incoming": row[7],
+        "total_amount_outgoing": row[8],
+        "average_deal_amount": round(total_income / deal_quantity, 2) if deal_quantity else 0
+    }
+
+
+def get_live_totals(start_date):
+    """Paid invoices since `start_date` grouped by (day, user_id, type), and the customers
+    whose first purchase is since then, for the in-memory revenue totals."""
+    with connection() as (conn, cur):
+        cur.execute("""
+            SELECT {day}, user_id, type, COUNT(*), COALESCE(SUM(amount), 0)
+            FROM invoices
+            WHERE status = 'PAID' AND date >= %s
+            GROUP BY 1, 2, 3
+        """.format(day=dialect_sql({
+            'postgres': "(date AT TIME ZONE 'Europe/Moscow')::date",
+            # Timestamps are stored in Moscow time, the day is the date part
+            'sqlite': "substr(date, 1, 10)",
+        })), (start_date,))
+        days = [(day if not isinstance(day, str) else datetime.strptime(day, '%Y-%m-%d').date(), user_id, invoice_type, deals, revenue)
+                for day, user_id, invoice_type, deals, revenue in cur.fetchall()]
+
+        cur.execute("SELECT user_id, first_paid_at FROM customers WHERE first_paid_at >= %s", (start_date,))
+        customers = cur.fetchall()
+
+    return days, customers
+
+
+def get_salesman_stats(start_date, end_date, shift_hours):
+    """Invoices created in the period, per salesman and per salesman and shift, in one query.
+
+    Shifts start at the Moscow hours in `shift_hours`, the last one runs until the first
+    one the next day. Returns rows of (salesman, shift or None for the salesman's total,
+    created, paid, declined, revenue, median seconds from creation to approval).
+    """
+    with connection() as (conn, cur):
+        bounds = sorted(int(hour) for hour in shift_hours)
+        overnight = f"'{bounds[-1]:02d}-{bounds[0]:02d}'"
+        shifts = " ".join(f"WHEN shift_hour >= {start} AND shift_hour < {end} THEN '{start:02d}-{end:02d}'"
+                          for start, end in zip(bounds, bounds[1:]))
+        aggregates = """COUNT(*),
+                   COUNT(*) FILTER (WHERE status = 'PAID'),
+                   COUNT(*) FILTER (WHERE status = 'DECLINED'),
+                   COALESCE(SUM(amount) FILTER (WHERE status = 'PAID'), 0),
+                   {median}""".format(median=dialect_sql({
+            'postgres': "percentile_cont(0.5) WITHIN GROUP (ORDER BY approval_seconds)",
+            'sqlite': "median(approval_seconds)",
+        }))
+
+        cur.execute("""
+            WITH period AS (
+                SELECT COALESCE(salesman, '') AS salesman, {hour} AS shift_hour, status, amount,
+                       CASE WHEN status = 'PAID' THEN {approval_seconds} END AS approval_seconds
+                FROM invoices
+                WHERE date BETWEEN %(start_date)s AND %(end_date)s
+            ),
+            shifts AS (
+                SELECT salesman, {shift} AS shift, status, amount, approval_seconds
+                FROM period
+            )
+            SELECT salesman, shift, {aggregates}
+            FROM shifts
+            GROUP BY salesman, shift
+            UNION ALL
+            SELECT salesman, NULL, {aggregates}
+            FROM shifts
+            GROUP BY salesman
+        """.format(
+            hour=dialect_sql({
+                'postgres': "EXTRACT(HOUR FROM date AT TIME ZONE 'Europe/Moscow')",
+                # Timestamps are stored in Moscow time
+                'sqlite': "CAST(substr(date, 12, 2) AS INTEGER)",
+            }),
+            approval_seconds=dialect_sql({
+                'postgres': "EXTRACT(EPOCH FROM paid_at - date)::float8",
+                'sqlite': "seconds_between(date, paid_at)",
+            }),
+            shift=f"CASE {shifts} ELSE {overnight} END" if shifts else overnight,
+            aggregates=aggregates,
+        ), {'start_date': start_date, 'end_date': end_date})
+        rows = cur.fetchall()
+
+    return rows
+
+
+def rebuild_daily_sales_rollup():
+    """Recompute daily_sales_rollup from the invoices table, returns the number of rollup rows."""
+    with connection() as (conn, cur):
+        # Approvals wait on the lock, so no increment is lost or counted twice during the rebuild
+        backend.lock_tables(cur, 'daily_sales_rollup')
+        cur.execute("DELETE FROM daily_sales_rollup")
+        cur.execute("""
+            INSERT INTO daily_sales_rollup (day, salesman, product, type, deals, revenue)
+            SELECT {day}, COALESCE(salesman, ''), COALESCE(product, ''), COALESCE(type, ''),
+                   COUNT(*), COALESCE(SUM(amount), 0)
+            FROM invoices
+            WHERE status = 'PAID'
+            GROUP BY 1, 2, 3, 4
+        """.format(day=dialect_sql({
+            'postgres': "(date AT TIME ZONE 'Europe/Moscow')::date",
+            # Timestamps are stored in Moscow time, the day is the date part
+            'sqlite': "substr(date, 1, 10)",
+        })))
+        row_count = cur.rowcount
+
+        conn.commit()
+
+    logger.info(f'Rebuilt daily_sales_rollup: {row_count} rows')
+    return row_count
+
+
 def add_salesman(name):
-    conn = create_connection()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO salesman (name) VALUES (%s)", (name,))
-    conn.commit()
-    close_connection(conn)
+    with connection() as (conn, cur):
+        cur.execute("INSERT INTO salesman (name) VALUES (%s)", (name,))
+        conn.commit()
 
 def get_current_salesman():
-    conn = create_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT name FROM salesman WHERE is_current = TRUE")
-    current_salesman = cur.fetchone()
-    close_connection(conn)
-    return current_salesman
+    return config_cache.get('current_salesman', _load_current_salesman)
+
+def _load_current_salesman():
+    with connection() as (conn, cur):
+        cur.execute("SELECT name FROM salesman WHERE is_current = TRUE")
+        current_salesman = cur.fetchone()
+    return current_salesman[0] if current_salesman else None
 
 def set_current_salesman(name):
-    conn = create_connection()
-    cur = conn.cursor()
-    cur.execute("UPDATE salesman SET is_current = FALSE WHERE is_current = TRUE")
-    cur.execute("UPDATE salesman SET is_current = TRUE WHERE name = %s", (name,))
-    conn.commit()
-    close_connection(conn)
+    with connection() as (conn, cur):
+        cur.execute("UPDATE salesman SET is_current = FALSE WHERE is_current = TRUE")
+        cur.execute("UPDATE salesman SET is_current = TRUE WHERE name = %s", (name,))
+        conn.commit()
+    config_cache.invalidate('current_salesman')
 
 def get_all_salesmen():
-    conn = create_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT name FROM salesman")
-    salesmen_tuples = cur.fetchall()
-    salesmen = [s[0] for s in salesmen_tuples]  # Extract names from tuples
-    close_connection(conn)
+    with connection() as (conn, cur):
+        cur.execute("SELECT name FROM salesman")
+        salesmen_tuples = cur.fetchall()
+        salesmen = [s[0] for s in salesmen_tuples]  # Extract names from tuples
     return salesmen
 
 
 def set_invoice_salesman(invoice_id, salesman_name):
-    conn = create_connection()
-    cur = conn.cursor()
-    cur.execute("UPDATE invoices SET salesman = %s WHERE invoice_id = %s", (salesman_name, invoice_id,))
-    conn.commit()
-    close_connection(conn)
+    with connection() as (conn, cur):
+        cur.execute("UPDATE invoices SET salesman = %s WHERE invoice_id = %s", (salesman_name, invoice_id,))
+        conn.commit()
 
 def delete_salesman(salesman_name):
-    conn = create_connection()
-    cur = conn.cursor()
+    with connection() as (conn, cur):
+        # Delete the salesman from the table
+        cur.execute(sql.SQL("DELETE FROM salesman WHERE name = %s"), (salesman_name,))
+
+        # Save (commit) the changes and close the connection
+        conn.commit()
+
+    config_cache.invalidate('current_salesman')
+
+
+def add_invite_links(links, user_id=None, invoice_id=None):
+    """Store (link, expires_at) pairs in the invite link pool, or as already issued to
+    `user_id` for `invoice_id` when those are given."""
+    with connection() as (conn, cur):
+        for link, expires_at in links:
+            cur.execute("""
+                INSERT INTO invite_links (link, expires_at, user_id, invoice_id, issued_at)
+                VALUES (%(link)s, %(expires_at)s, %(user_id)s, %(invoice_id)s, CASE WHEN %(user_id)s IS NULL THEN NULL ELSE NOW() END)
+            """, {'link': link, 'expires_at': expires_at, 'user_id': user_id, 'invoice_id': invoice_id})
+
+        conn.commit()
+
+
+def count_free_invite_links(valid_until):
+    with connection() as (conn, cur):
+        cur.execute("SELECT COUNT(*) FROM invite_links WHERE issued_at IS NULL AND expires_at > %s", (valid_until,))
+        count = cur.fetchone()[0]
+
+    return count
+
+
+def take_invite_link(user_id, invoice_id, valid_until):
+    """Issue the free pooled link that expires first but not before `valid_until` to
+    `user_id` for `invoice_id`. Returns the link, or None if the pool is empty."""
+    with connection() as (conn, cur):
+        cur.execute("""
+            UPDATE invite_links
+            SET user_id = %(user_id)s, invoice_id = %(invoice_id)s, issued_at = NOW()
+            WHERE link = (
+                SELECT link FROM invite_links
+                WHERE issued_at IS NULL AND expires_at > %(valid_until)s
+                ORDER BY expires_at
+                LIMIT 1
+                {skip_locked}
+            )
+            RETURNING link
+        """.format(skip_locked=dialect_sql({'postgres': "FOR UPDATE SKIP LOCKED", 'sqlite': ""})),
+            {'user_id': user_id, 'invoice_id': invoice_id, 'valid_until': valid_until})
+        row = cur.fetchone()
+
+        conn.commit()
+
+    return row[0] if row else None
+
+
+def delete_expired_invite_links(valid_until):
+    """Drop pooled links that were never issued and are too close to expiry to hand out."""
+    with connection() as (conn, cur):
+        cur.execute("DELETE FROM invite_links WHERE issued_at IS NULL AND expires_at <= %s", (valid_until,))
+        deleted = cur.rowcount
+
+        conn.commit()
+
+    return deleted
+
+
+def acquire_lease(name, holder, ttl):
+    """Take the lease `name` for `ttl` seconds if it is free or expired, or renew it if
+    `holder` already has it. Returns True if `holder` holds the lease afterwards.
+
+    Expiry is computed and compared on the database clock, replicas' clocks may differ."""
+    with connection() as (conn, cur):
+        cur.execute("""
+            INSERT INTO job_leases AS l (name, holder, expires_at)
+            VALUES (%(name)s, %(holder)s, {expires_at})
+            ON CONFLICT (name) DO UPDATE
+            SET holder = EXCLUDED.holder, expires_at = EXCLUDED.expires_at
+            WHERE l.holder = EXCLUDED.holder OR l.expires_at < NOW()
+        """.format(expires_at=dialect_sql({
+            'postgres': "NOW() + %(ttl)s * INTERVAL '1 second'",
+            'sqlite': "seconds_after(NOW(), %(ttl)s)",
+        })), {'name': name, 'holder': holder, 'ttl': ttl})
+        acquired = cur.rowcount == 1
+
+        conn.commit()
+
+    return acquired
+
+
+def release_lease(name, holder):
+    with connection() as (conn, cur):
+        cur.execute("DELETE FROM job_leases WHERE name = %s AND holder = %s", (name, holder))
+
+        conn.commit()
+
+
+PERSISTENCE_BATCH_SIZE = 200  # rows per INSERT, keeps the parameter count within SQLite's limit
+
+
+def load_persistence(kind):
+    """Returns {key: pickled data} stored by the bot persistence for `kind`."""
+    with connection() as (conn, cur):
+        cur.execute("SELECT key, data FROM bot_persistence WHERE kind = %s", (kind,))
+        rows = cur.fetchall()
+
+    return {key: bytes(data) for key, data in rows}
+
+
+def save_persistence(changes):
+    """Write a batch of (kind, key, data) in one transaction, data None deletes the entry."""
+    upserts = [change for change in changes if change[2] is not None]
+    deletes = [change[:2] for change in changes if change[2] is None]
+
+    with connection() as (conn, cur):
+        for start in range(0, len(upserts), PERSISTENCE_BATCH_SIZE):
+            batch = upserts[start:start + PERSISTENCE_BATCH_SIZE]
+            cur.execute(
+                "INSERT INTO bot_persistence (kind, key, data, updated_at) VALUES "
+                + ", ".join(["(%s, %s, %s, NOW())"] * len(batch))
+                + " ON CONFLICT (kind, key) DO UPDATE SET data = EXCLUDED.data, updated_at = EXCLUDED.updated_at",
+                [value for change in batch for value in change]
+            )
+
+        for kind, key in deletes:
+            cur.execute("DELETE FROM bot_persistence WHERE kind = %s AND key = %s", (kind, key))
+
+        conn.commit()
 
-    # Delete the salesman from the table
-    cur.execute(sql.SQL("DELETE FROM salesman WHERE name = %s"), (salesman_name,))
 
-    # Save (commit) the changes and close the connection
-    conn.commit()
-    close_connection(conn)
+# Every public query function is timed: calls, connection acquire time,
+# query time and rows end up in instrumentation.registry, slow calls in the slow log
+instrumentation.instrument_module(globals(), exclude={
+    'create_connection', 'close_connection', 'connection', 'dialect_sql', 'moscow_date', 'add_to_rollup', 'refresh_customer',
+    'notify_subscription_changed', 'notify_invoice_changed', 'invoice_change', 'customer_totals',
+})
@@ -0,0 +1,97 @@
+import os
+import time
+import heapq
+import logging
+import threading
+import database
+
+# Logging setup
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+EXPIRY_RESYNC_MINUTES = int(os.environ.get('EXPIRY_RESYNC_MINUTES', 15))  # reload from the db, catches other processes' changes
+MAX_SLEEP = 60  # re-check the clock at least this often, in case it jumps
+
+
+class ExpiryScheduler:
+    """Calls `handler(user_id, kick_date)` when a VIP subscription reaches its kick_date.
+
+    Pending expiries live in a heap ordered by kick_date. A subscription that is extended
+    is pushed again with the new date; the outdated heap entry is skipped when it comes
+    up, because `_kick_dates` only remembers the latest date per user.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self._heap = []  # (timestamp, user_id, kick_date)
+        self._kick_dates = {}  # user_id -> kick_date currently scheduled
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+
+    def schedule(self, user_id, kick_date):
+        with self._cond:
+            self._kick_dates[user_id] = kick_date
+            heapq.heappush(self._heap, (kick_date.timestamp(), user_id, kick_date))
+            if self._heap[0][1] == user_id:
+                self._cond.notify()
+
+    def resync(self):
+        """Replace the schedule with the pending expiries stored in the database."""
+        pending = database.get_pending_expiries()
+        with self._cond:
+            self._kick_dates = dict(pending)
+            self._heap = [(kick_date.timestamp(), user_id, kick_date) for user_id, kick_date in pending]
+            heapq.heapify(self._heap)
+            self._cond.notify()
+        logger.info(f"Scheduled {len(pending)} VIP expiries")
+
+    def start(self):
+        self._stopping = False
+        self.resync()
+        self._thread = threading.Thread(target=self._run, name='expiry', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _next_due(self):
+        """Pops the next due expiry, or returns None after waiting for one."""
+        with self._cond:
+            while self._heap:
+                due, user_id, kick_date = self._heap[0]
+                if self._kick_dates.get(user_id) != kick_date:
+                    heapq.heappop(self._heap)  # superseded by a renewal
+                    continue
+
+                wait = due - time.time()
+                if wait > 0:
+                    self._cond.wait(min(wait, MAX_SLEEP))
+                    return None
+
+                heapq.heappop(self._heap)
+                del self._kick_dates[user_id]
+                return user_id, kick_date
+
+            self._cond.wait(MAX_SLEEP)
+            return None
+
+    def _run(self):
+        while not self._stopping:
+            expiry = self._next_due()
+            if expiry is None:
+                continue
+
+            user_id, kick_date = expiry
+            try:
+                self.handler(user_id, kick_date)
+            except Exception:
+                # The handler only marks an expiry handled once the user is removed, so it is
+                # still pending in the database and the next resync schedules it again
+                logger.exception(f"Failed to expire VIP subscription of user {user_id}")
@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import inspect
+import logging
+import functools
+import threading
+import collections
+
+# Logging setup
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+slow_logger = logging.getLogger('database.slow')
+
+
+SLOW_CALL_MS = float(os.environ.get('DB_SLOW_CALL_MS', 500))  # calls slower than this go to the slow log
+METRICS_WINDOW = int(os.environ.get('DB_METRICS_WINDOW', 1000))  # latest calls per function kept for percentiles
+
+
+class FunctionStats:
+    def __init__(self, window):
+        self.calls = 0
+        self.errors = 0
+        self.rows = 0
+        self.acquire_time = 0.0
+        self.query_time = 0.0
+        self.durations = collections.deque(maxlen=window)
+
+
+class MetricsRegistry:
+    """Per-function call counts, totals and a rolling window of durations."""
+
+    def __init__(self, window):
+        self.window = window
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, duration, acquire_time, query_time, rows, failed):
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = FunctionStats(self.window)
+            stats.calls += 1
+            stats.errors += int(failed)
+            stats.rows += rows
+            stats.acquire_time += acquire_time
+            stats.query_time += query_time
+            stats.durations.append(duration)
+
+    def snapshot(self):
+        """Returns {name: stats dict}, times in milliseconds."""
+        with self._lock:
+            items = [(name, stats.calls, stats.errors, stats.rows, stats.acquire_time, stats.query_time, sorted(stats.durations))
+                     for name, stats in self._stats.items()]
+
+        snapshot = {}
+        for name, calls, errors, rows, acquire_time, query_time, durations in items:
+            snapshot[name] = {
+                'calls': calls,
+                'errors': errors,
+                'rows': rows,
+                'avg_acquire_ms': round(acquire_time / calls * 1000, 2),
+                'avg_query_ms': round(query_time / calls * 1000, 2),
+                'p50_ms': percentile(durations, 50),
+                'p95_ms': percentile(durations, 95),
+                'p99_ms': percentile(durations, 99),
+            }
+        return snapshot
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0
+    # Nearest-rank percentile
+    index = max(0, -(-len(sorted_values) * pct // 100) - 1)
+    return round(sorted_values[int(index)] * 1000, 2)
+
+
+registry = MetricsRegistry(METRICS_WINDOW)
+
+
+class CallContext:
+    def __init__(self):
+        self.acquire_time = 0.0
+        self.query_time = 0.0
+        self.rows = 0
+
+
+_local = threading.local()
+
+
+def _current_call():
+    calls = getattr(_local, 'calls', None)
+    return calls[-1] if calls else None
+
+
+def record_acquire(seconds):
+    call = _current_call()
+    if call is not None:
+        call.acquire_time += seconds
+
+
+def record_query(seconds, rows):
+    call = _current_call()
+    if call is not None:
+        call.query_time += seconds
+        call.rows += max(rows, 0)
+
+
+def instrument(name, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not hasattr(_local, 'calls'):
+            _local.calls = []
+        call = CallContext()
+        _local.calls.append(call)
+
+        failed = False
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            _local.calls.pop()
+            registry.record(name, duration, call.acquire_time, call.query_time, call.rows, failed)
+
+            if duration * 1000 >= SLOW_CALL_MS:
+                slow_logger.warning(json.dumps({
+                    'event': 'slow_db_call',
+                    'function': name,
+                    'duration_ms': round(duration * 1000, 2),
+                    'acquire_ms': round(call.acquire_time * 1000, 2),
+                    'query_ms': round(call.query_time * 1000, 2),
+                    'rows': call.rows,
+                    'failed': failed,
+                }))
+
+    return wrapper
+
+
+def instrument_module(namespace, exclude=()):
+    """Wrap every public function defined in the module owning `namespace`."""
+    module_name = namespace['__name__']
+    for name, obj in list(namespace.items()):
+        if name.startswith('_') or name in exclude:
+            continue
+        if not inspect.isfunction(obj) or obj.__module__ != module_name:
+            continue
+        namespace[name] = instrument(name, obj)
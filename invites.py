@@ -0,0 +1,74 @@
+import os
+import logging
+from datetime import datetime, timedelta
+import pytz
+import config
+import database
+import outbox
+
+# Logging setup
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+INVITE_POOL_SIZE = int(os.environ.get('INVITE_POOL_SIZE', 10))  # free links kept ready
+INVITE_LINK_DAYS = int(os.environ.get('INVITE_LINK_DAYS', 7))  # lifetime of a created link
+INVITE_MIN_VALID_DAYS = int(os.environ.get('INVITE_MIN_VALID_DAYS', 2))  # a customer gets at least this long to join
+INVITE_REFILL_MINUTES = int(os.environ.get('INVITE_REFILL_MINUTES', 1))
+
+MOSCOW = pytz.timezone('Europe/Moscow')
+
+
+def _valid_until():
+    return datetime.now(MOSCOW) + timedelta(days=INVITE_MIN_VALID_DAYS)
+
+
+def create_invite_link(bot, priority=outbox.BROADCAST):
+    """Create a single-use link into the VIP chat, returns (link, expires_at)."""
+    expires_at = datetime.now(MOSCOW) + timedelta(days=INVITE_LINK_DAYS)
+    created = outbox.send(bot.create_chat_invite_link, priority=priority, per_chat=False,
+                          chat_id=config.GROUP_ID, member_limit=1, expire_date=expires_at).result()
+    return created.invite_link, expires_at
+
+
+def refill(bot):
+    """Top the pool up to INVITE_POOL_SIZE links that can still be handed out."""
+    valid_until = _valid_until()
+    database.delete_expired_invite_links(valid_until)
+
+    missing = INVITE_POOL_SIZE - database.count_free_invite_links(valid_until)
+    if missing <= 0:
+        return
+
+    links = []
+    for _ in range(missing):
+        try:
+            links.append(create_invite_link(bot))
+        except Exception as e:
+            logger.warning(f"Could not create a VIP invite link: {e}")
+            break
+
+    if links:
+        database.add_invite_links(links)
+        logger.info(f"Added {len(links)} VIP invite links to the pool")
+
+
+def issue_invite_link(bot, user_id, invoice_id):
+    """Hand a single-use VIP link to `user_id` for `invoice_id`, recording who got it.
+
+    Takes a link from the pool, and only if the pool ran dry creates one on the spot.
+    Returns None if no link could be issued.
+    """
+    link = database.take_invite_link(user_id, invoice_id, _valid_until())
+    if link is not None:
+        return link
+
+    logger.warning(f"VIP invite link pool is empty, creating a link for invoice {invoice_id}")
+    try:
+        link, expires_at = create_invite_link(bot, priority=outbox.CUSTOMER)
+    except Exception as e:
+        logger.error(f"Failed to create a VIP invite link for invoice {invoice_id}: {e}")
+        return None
+
+    database.add_invite_links([(link, expires_at)], user_id=user_id, invoice_id=invoice_id)
+    return link
@@ -0,0 +1,96 @@
+import os
+import time
+import uuid
+import socket
+import logging
+import threading
+import database
+
+# Logging setup
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+LEADER_LEASE_SECONDS = int(os.environ.get('LEADER_LEASE_SECONDS', 30))  # how long a dead leader blocks failover
+
+
+class LeaderElection:
+    """Elects one process among the bot replicas to run scheduled work.
+
+    Every replica tries to take or renew the lease row `name` every third of the lease
+    time. The holder runs `on_elected` when it gets the lease and `on_demoted` when it
+    loses it. If the leader dies its lease expires and another replica takes over.
+    A leader that cannot renew for two thirds of the lease steps down on its own, before
+    anyone else can take the lease.
+    """
+
+    def __init__(self, name, on_elected, on_demoted, ttl=LEADER_LEASE_SECONDS):
+        self.name = name
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.ttl = ttl
+        self.holder = f"{os.environ.get('DYNO') or socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.is_leader = False
+        self._renewed_at = 0.0
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f'leader:{self.name}', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.is_leader:
+            self._demote()
+            # Let another replica take over right away instead of after the lease runs out
+            try:
+                database.release_lease(self.name, self.holder)
+            except Exception:
+                logger.exception(f"Could not release the {self.name} lease")
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                acquired = database.acquire_lease(self.name, self.holder, self.ttl)
+            except Exception:
+                logger.exception(f"Could not renew the {self.name} lease")
+                acquired = self.is_leader and time.monotonic() - self._renewed_at < self.ttl * 2 / 3
+            else:
+                if acquired:
+                    self._renewed_at = time.monotonic()
+
+            if acquired and not self.is_leader:
+                self._elect()
+            elif not acquired and self.is_leader:
+                self._demote()
+
+            self._stopping.wait(self.ttl / 3)
+
+    def _elect(self):
+        try:
+            self.on_elected()
+        except Exception:
+            logger.exception(f"Failed to start {self.name} on {self.holder}, giving up the lease")
+            # Undo whatever was started, and let another replica try instead of holding a lease nobody serves
+            try:
+                self.on_demoted()
+            except Exception:
+                logger.exception(f"Failed to stop {self.name} on {self.holder}")
+            try:
+                database.release_lease(self.name, self.holder)
+            except Exception:
+                logger.exception(f"Could not release the {self.name} lease")
+            return
+        self.is_leader = True
+        logger.info(f"{self.holder} is now the leader for {self.name}")
+
+    def _demote(self):
+        logger.info(f"{self.holder} is no longer the leader for {self.name}")
+        self.is_leader = False
+        try:
+            self.on_demoted()
+        except Exception:
+            logger.exception(f"Failed to stop {self.name} on the old leader")
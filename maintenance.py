@@ -0,0 +1,28 @@
+import sys
+import logging
+import database
+
+# Logging setup
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+# One-off maintenance commands, run as e.g. `heroku run python maintenance.py rebuild-rollup`
+COMMANDS = {
+    'rebuild-rollup': database.rebuild_daily_sales_rollup,
+    'rebuild-customers': database.rebuild_customers,
+}
+
+
+def main(argv):
+    if len(argv) != 1 or argv[0] not in COMMANDS:
+        print(f"Usage: python maintenance.py <{'|'.join(COMMANDS)}>")
+        return 1
+
+    result = COMMANDS[argv[0]]()
+    logger.info(f"{argv[0]} finished: {result}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,224 @@
+import logging
+import database
+
+# Logging setup
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+# Advisory lock key, so only one process applies migrations at a time
+MIGRATION_LOCK_ID = 7310001
+
+# Ordered schema steps: (version, description, statements).
+# A statement is either SQL that runs on every backend or a {dialect: SQL} dict, where
+# None skips the statement on that backend. The schema_version table makes each step run
+# only once. Postgres statements must also be idempotent, databases from before versioning
+# already have part of the schema; SQLite databases are only ever built by these steps, so
+# its ADD COLUMN (which has no IF NOT EXISTS) is not.
+# Never edit a step that has shipped, add a new one instead.
+MIGRATIONS = [
+    (1, "Base tables", [
+        {'postgres': """CREATE TABLE IF NOT EXISTS salesman (
+            id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL,
+            is_current BOOLEAN DEFAULT FALSE)""",
+         'sqlite': """CREATE TABLE IF NOT EXISTS salesman (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            is_current BOOLEAN DEFAULT FALSE)"""},
+        """CREATE TABLE IF NOT EXISTS invoices (
+            invoice_id INTEGER PRIMARY KEY,
+            amount INTEGER,
+            name TEXT,
+            username TEXT,
+            user_id BIGINT,
+            product TEXT,
+            status TEXT,
+            type TEXT,
+            date TIMESTAMPTZ,
+            screenshot_id INTEGER,
+            salesman TEXT,
+            subscription_length INTEGER)""",
+        {'postgres': """CREATE TABLE IF NOT EXISTS cards (
+            id SERIAL PRIMARY KEY,
+            card_number VARCHAR(255),
+            bank VARCHAR(255),
+            is_current BOOLEAN DEFAULT FALSE)""",
+         'sqlite': """CREATE TABLE IF NOT EXISTS cards (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            card_number VARCHAR(255),
+            bank VARCHAR(255),
+            is_current BOOLEAN DEFAULT FALSE)"""},
+        """CREATE TABLE IF NOT EXISTS vip (
+            name TEXT,
+            username TEXT,
+            user_id BIGINT PRIMARY KEY,
+            duration INTEGER,
+            kick_date TIMESTAMP WITH TIME ZONE,
+            paid BOOLEAN DEFAULT FALSE,
+            renewal_times INTEGER DEFAULT 0)""",
+    ]),
+    (2, "Hot path indexes", [
+        # get_last_invoice_id_for_user
+        "CREATE INDEX IF NOT EXISTS invoices_user_id_date_idx ON invoices (user_id, date DESC)",
+        # Report queries filter paid invoices by period
+        "CREATE INDEX IF NOT EXISTS invoices_status_date_idx ON invoices (status, date)",
+        "CREATE INDEX IF NOT EXISTS invoices_paid_date_idx ON invoices (date) WHERE status = 'PAID'",
+        # First purchase lookups for new customer metrics
+        "CREATE INDEX IF NOT EXISTS invoices_paid_user_id_date_idx ON invoices (user_id, date) WHERE status = 'PAID'",
+        # get_users_to_kick
+        "CREATE INDEX IF NOT EXISTS vip_kick_date_idx ON vip (kick_date)",
+    ]),
+    # On SQLite invoice_id INTEGER PRIMARY KEY is the rowid and already allocated atomically
+    (3, "Sequence backed invoice ids", [
+        {'postgres': "CREATE SEQUENCE IF NOT EXISTS invoices_invoice_id_seq OWNED BY invoices.invoice_id", 'sqlite': None},
+        # Continue numbering after the ids handed out by the old MAX() + 1 allocator
+        {'postgres': "SELECT setval('invoices_invoice_id_seq', COALESCE((SELECT MAX(invoice_id) FROM invoices), 0) + 1, false)", 'sqlite': None},
+        {'postgres': "ALTER TABLE invoices ALTER COLUMN invoice_id SET DEFAULT nextval('invoices_invoice_id_seq')", 'sqlite': None},
+    ]),
+    (4, "Daily sales rollup", [
+        """CREATE TABLE IF NOT EXISTS daily_sales_rollup (
+            day DATE NOT NULL,
+            salesman TEXT NOT NULL DEFAULT '',
+            product TEXT NOT NULL DEFAULT '',
+            type TEXT NOT NULL DEFAULT '',
+            deals INTEGER NOT NULL DEFAULT 0,
+            revenue BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, salesman, product, type))""",
+        # Backfill from existing paid invoices
+        "DELETE FROM daily_sales_rollup",
+        {'postgres': """INSERT INTO daily_sales_rollup (day, salesman, product, type, deals, revenue)
+        SELECT (date AT TIME ZONE 'Europe/Moscow')::date, COALESCE(salesman, ''), COALESCE(product, ''), COALESCE(type, ''),
+               COUNT(*), COALESCE(SUM(amount), 0)
+        FROM invoices
+        WHERE status = 'PAID'
+        GROUP BY 1, 2, 3, 4""",
+         # Timestamps are stored as Moscow time text, the day is the date part
+         'sqlite': """INSERT INTO daily_sales_rollup (day, salesman, product, type, deals, revenue)
+        SELECT substr(date, 1, 10), COALESCE(salesman, ''), COALESCE(product, ''), COALESCE(type, ''),
+               COUNT(*), COALESCE(SUM(amount), 0)
+        FROM invoices
+        WHERE status = 'PAID'
+        GROUP BY 1, 2, 3, 4"""},
+    ]),
+    (5, "Customers with first purchase", [
+        """CREATE TABLE IF NOT EXISTS customers (
+            user_id BIGINT PRIMARY KEY,
+            name TEXT,
+            username TEXT,
+            first_paid_at TIMESTAMPTZ,
+            last_paid_at TIMESTAMPTZ,
+            paid_count INTEGER NOT NULL DEFAULT 0,
+            paid_total BIGINT NOT NULL DEFAULT 0)""",
+        "CREATE INDEX IF NOT EXISTS customers_first_paid_at_idx ON customers (first_paid_at)",
+        # Backfill from existing paid invoices
+        "DELETE FROM customers",
+        {'postgres': """INSERT INTO customers (user_id, name, username, first_paid_at, last_paid_at, paid_count, paid_total)
+        SELECT user_id, (array_agg(name ORDER BY date DESC))[1], (array_agg(username ORDER BY date DESC))[1],
+               MIN(date), MAX(date), COUNT(*), COALESCE(SUM(amount), 0)
+        FROM invoices
+        WHERE status = 'PAID' AND user_id IS NOT NULL
+        GROUP BY user_id""",
+         'sqlite': None},  # a fresh SQLite database has no invoices to backfill
+    ]),
+    (6, "Handled VIP expiries", [
+        {'postgres': "ALTER TABLE vip ADD COLUMN IF NOT EXISTS expired_at TIMESTAMP WITH TIME ZONE",
+         'sqlite': "ALTER TABLE vip ADD COLUMN expired_at TIMESTAMP WITH TIME ZONE"},
+        # Everything up to the last Moscow midnight was handled by the nightly batch that ran then
+        {'postgres': """UPDATE vip SET expired_at = kick_date
+        WHERE expired_at IS NULL
+          AND kick_date <= date_trunc('day', NOW() AT TIME ZONE 'Europe/Moscow') AT TIME ZONE 'Europe/Moscow'""",
+         'sqlite': None},
+        # get_pending_expiries
+        "CREATE INDEX IF NOT EXISTS vip_pending_kick_date_idx ON vip (kick_date) WHERE expired_at IS NULL",
+    ]),
+    (7, "Bot persistence", [
+        # user_data / chat_data / conversation states, pickled, written by persistence.py
+        """CREATE TABLE IF NOT EXISTS bot_persistence (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            data BYTEA NOT NULL,
+            updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (kind, key))""",
+    ]),
+    (8, "Job leases", [
+        # One row per leader-only job group, see leader.py
+        """CREATE TABLE IF NOT EXISTS job_leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL)""",
+    ]),
+    (9, "VIP invite link pool", [
+        # Single-use links created ahead of time by invites.py, user_id/invoice_id set when issued
+        """CREATE TABLE IF NOT EXISTS invite_links (
+            link TEXT PRIMARY KEY,
+            created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMPTZ NOT NULL,
+            user_id BIGINT,
+            invoice_id INTEGER,
+            issued_at TIMESTAMPTZ)""",
+        # take_invite_link
+        "CREATE INDEX IF NOT EXISTS invite_links_free_expires_at_idx ON invite_links (expires_at) WHERE issued_at IS NULL",
+    ]),
+    (10, "Invoice approval time", [
+        # Set when an invoice becomes PAID, earlier approvals are unknown
+        {'postgres': "ALTER TABLE invoices ADD COLUMN IF NOT EXISTS paid_at TIMESTAMPTZ",
+         'sqlite': "ALTER TABLE invoices ADD COLUMN paid_at TIMESTAMPTZ"},
+        # get_salesman_stats counts every invoice created in the period
+        "CREATE INDEX IF NOT EXISTS invoices_date_idx ON invoices (date)",
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(cur):
+    if not database.backend.table_exists(cur, 'schema_version'):
+        return 0
+
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return cur.fetchone()[0]
+
+
+def statement_for_backend(statement):
+    if isinstance(statement, dict):
+        return statement[database.backend.dialect]
+    return statement
+
+
+def migrate():
+    with database.connection() as (conn, cur):
+        # Fast path: nothing but two reads when the schema is already current
+        version = get_schema_version(cur)
+        if version >= LATEST_VERSION:
+            logger.info(f"Database schema is up to date (version {version})")
+            conn.rollback()
+            return
+
+        # Everything below runs in one transaction, guarded against concurrent boots
+        database.backend.lock_for_migration(cur, MIGRATION_LOCK_ID)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP)
+        """)
+
+        # Another process may have migrated while we waited for the lock
+        version = get_schema_version(cur)
+
+        for step_version, description, statements in MIGRATIONS:
+            if step_version <= version:
+                continue
+
+            logger.info(f"Applying migration {step_version}: {description}")
+            for statement in statements:
+                statement = statement_for_backend(statement)
+                if statement is not None:
+                    cur.execute(statement)
+
+            cur.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s)", (step_version, description))
+
+        conn.commit()
+
+    logger.info(f"Database schema migrated from version {version} to {LATEST_VERSION}")
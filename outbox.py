@@ -0,0 +1,277 @@
+import time
+import logging
+import threading
+import collections
+from concurrent.futures import Future, ThreadPoolExecutor
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+import config
+import instrumentation
+
+# Logging setup
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+# Priorities, lower is sent first
+CUSTOMER = 0   # replies a customer is waiting for
+MANAGER = 1    # notifications to payment/sales managers
+BROADCAST = 2  # bulk sends such as the midnight VIP expirations
+PRIORITIES = (CUSTOMER, MANAGER, BROADCAST)
+
+MAX_IDLE_BUCKETS = 1000  # per-chat buckets kept before full (idle) ones are dropped
+MAX_BACKOFF = 60  # seconds, cap for retrying after network errors
+NOT_IDEMPOTENT = ('send_', 'copy_', 'forward_')  # methods that post a new message every time they go through
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Seconds until a token is available, 0 if one is available now."""
+        self._refill(now)
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, until):
+        # Telegram asked us to back off, also drop the burst we would resume with
+        self.blocked_until = max(self.blocked_until, until)
+        self.tokens = 0
+
+    def idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+
+class SendQueueStopped(Exception):
+    """Set on the future of a call submitted after the send queue has stopped."""
+
+
+class OutboundCall:
+    __slots__ = ('func', 'kwargs', 'priority', 'chat_key', 'future', 'queued_at', 'attempts', 'not_before')
+
+    def __init__(self, func, kwargs, priority, chat_key):
+        self.func = func
+        self.kwargs = kwargs
+        self.priority = priority
+        self.chat_key = chat_key
+        self.future = Future()
+        self.queued_at = time.monotonic()
+        self.attempts = 0
+        self.not_before = 0.0  # set when the call waits to be retried
+
+
+class SendQueue:
+    """Central queue for outgoing Telegram API calls.
+
+    Calls are taken in priority order, subject to a global token bucket and one bucket
+    per chat (Telegram allows about 30 messages/s overall, 1/s per private chat and
+    20/min per group). Calls to one chat are made one at a time in submission order.
+    A failed call is retried on its own, without holding up other chats: a RetryAfter
+    answer pauses the chat (or everything, for calls not tied to a chat) for the
+    requested time, network errors back off exponentially.
+    """
+
+    def __init__(self, global_rate, chat_rate, group_rate, burst, workers, max_retries):
+        self.global_bucket = TokenBucket(global_rate, burst)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.workers = workers
+        self.max_retries = max_retries
+        self._queues = {priority: collections.deque() for priority in PRIORITIES}
+        self._buckets = {}
+        self._in_flight = set()
+        self._sent = 0
+        self._failed = 0
+        self._retried = 0
+        self._waits = collections.deque(maxlen=instrumentation.METRICS_WINDOW)
+        self._stopping = False
+        self._stopped = False  # the sender has finished, nothing submitted now would be sent
+        self._cond = threading.Condition()
+        self._thread = None
+        self._executor = None
+
+    def submit(self, func, priority=MANAGER, per_chat=True, **kwargs):
+        """Queue `func(**kwargs)`, a bot method taking chat_id. Returns a Future of its result.
+
+        per_chat=False only applies the global limit, for calls such as unban_chat_member
+        that do not post into the chat. Calls submitted while `stop` drains the queue are
+        still sent, after that the future fails with SendQueueStopped.
+        """
+        chat_key = str(kwargs['chat_id']) if per_chat else None
+        call = OutboundCall(func, kwargs, priority, chat_key)
+        with self._cond:
+            if self._stopped:
+                call.future.set_exception(SendQueueStopped(f"Not sending {func.__name__} to {chat_key}, the send queue is stopped"))
+                return call.future
+            if self._thread is None:
+                self._start()
+            self._queues[priority].append(call)
+            self._cond.notify()
+        return call.future
+
+    def _start(self):
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='outbox')
+        self._thread = threading.Thread(target=self._run, name='outbox', daemon=True)
+        self._thread.start()
+
+    def _bucket(self, chat_key):
+        bucket = self._buckets.get(chat_key)
+        if bucket is None:
+            if len(self._buckets) >= MAX_IDLE_BUCKETS:
+                now = time.monotonic()
+                self._buckets = {key: b for key, b in self._buckets.items() if not b.idle(now) or key in self._in_flight}
+            rate = self.group_rate if chat_key.startswith('-') else self.chat_rate
+            bucket = self._buckets[chat_key] = TokenBucket(rate, self.burst)
+        return bucket
+
+    def _next_ready(self, now):
+        """Returns (call, None) for the next call to make, or (None, seconds to wait)."""
+        wait = self.global_bucket.delay(now)
+        if wait > 0:
+            return None, wait
+
+        wait = None
+        backing_off = set()  # chats whose oldest call waits for a retry, later calls wait behind it
+        for priority in PRIORITIES:
+            for call in self._queues[priority]:
+                if call.chat_key in backing_off:
+                    continue
+                if call.not_before > now:
+                    if call.chat_key is not None:
+                        backing_off.add(call.chat_key)
+                    delay = call.not_before - now
+                    wait = delay if wait is None else min(wait, delay)
+                    continue
+                if call.chat_key is None:
+                    self._queues[priority].remove(call)
+                    return call, None
+                if call.chat_key in self._in_flight:
+                    continue  # woken up when the call in flight finishes
+                delay = self._bucket(call.chat_key).delay(now)
+                if delay == 0:
+                    self._queues[priority].remove(call)
+                    return call, None
+                wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                call, wait = self._next_ready(now)
+                if call is None:
+                    if self._stopping and not self._in_flight and not any(self._queues.values()):
+                        self._stopped = True
+                        return
+                    self._cond.wait(wait)
+                    continue
+
+                self.global_bucket.consume(now)
+                if call.chat_key is not None:
+                    self._bucket(call.chat_key).consume(now)
+                    self._in_flight.add(call.chat_key)
+            self._executor.submit(self._deliver, call)
+
+    def _deliver(self, call):
+        started = time.monotonic()
+        try:
+            result = call.func(**call.kwargs)
+        except Exception as e:
+            call.attempts += 1
+            delay = retry_delay(e, call.attempts, call.func.__name__)
+            with self._cond:
+                if isinstance(e, RetryAfter):
+                    # Flood control applies to the whole chat, or to everything for calls not tied to one
+                    bucket = self.global_bucket if call.chat_key is None else self._bucket(call.chat_key)
+                    bucket.block(time.monotonic() + delay)
+                retrying = delay is not None and call.attempts <= self.max_retries
+                if retrying:
+                    self._retried += 1
+                    call.not_before = time.monotonic() + delay
+                    # Back to the front of its queue, ahead of later calls to the same chat
+                    self._queues[call.priority].appendleft(call)
+                else:
+                    self._failed += 1
+
+            if retrying:
+                logger.info(f"Retrying {call.func.__name__} to {call.chat_key} in {delay}s: {e}")
+            else:
+                call.future.set_exception(e)
+                logger.warning(f"Failed {call.func.__name__} to {call.chat_key} after {call.attempts} attempts: {e}")
+        else:
+            with self._cond:
+                self._sent += 1
+                self._waits.append(started - call.queued_at)
+            call.future.set_result(result)
+        finally:
+            with self._cond:
+                self._in_flight.discard(call.chat_key)
+                self._cond.notify()
+
+    def stats(self):
+        """Queue depth per priority and delivery counters, times in milliseconds."""
+        with self._cond:
+            queued = {priority: len(calls) for priority, calls in self._queues.items()}
+            in_flight, sent, failed, retried = len(self._in_flight), self._sent, self._failed, self._retried
+            waits = sorted(self._waits)
+
+        return {
+            'queued_customer': queued[CUSTOMER],
+            'queued_manager': queued[MANAGER],
+            'queued_broadcast': queued[BROADCAST],
+            'in_flight': in_flight,
+            'sent': sent,
+            'failed': failed,
+            'retried': retried,
+            'wait_p50_ms': instrumentation.percentile(waits, 50),
+            'wait_p95_ms': instrumentation.percentile(waits, 95),
+            'wait_max_ms': instrumentation.percentile(waits, 100),
+        }
+
+    def stop(self, timeout=30):
+        """Send what is queued, then stop the sender threads."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+            self._executor.shutdown(wait=True)
+
+
+def retry_delay(error, attempts, method):
+    """Seconds to wait before retrying a call to `method` that failed with `error`, None if
+    retrying cannot help or could do the call twice."""
+    if isinstance(error, RetryAfter):
+        return error.retry_after
+    # A timed out request may still have gone through, sending the message again could post it twice
+    if isinstance(error, TimedOut) and method.startswith(NOT_IDEMPOTENT):
+        return None
+    # BadRequest is a NetworkError too, but sending the same request again fails the same way
+    if isinstance(error, NetworkError) and not isinstance(error, BadRequest):
+        return min(2 ** attempts, MAX_BACKOFF)
+    return None
+
+
+sender = SendQueue(config.SEND_GLOBAL_RATE, config.SEND_CHAT_RATE, config.SEND_GROUP_RATE,
+                   config.SEND_BURST, config.SEND_WORKERS, config.SEND_MAX_RETRIES)
+
+
+def send(func, priority=MANAGER, per_chat=True, **kwargs):
+    return sender.submit(func, priority=priority, per_chat=per_chat, **kwargs)
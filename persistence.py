@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import pickle
+import logging
+import threading
+from collections import defaultdict
+from telegram.ext import BasePersistence
+import database
+
+# Logging setup
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+PERSISTENCE_FLUSH_SECONDS = float(os.environ.get('PERSISTENCE_FLUSH_SECONDS', 2))
+
+
+class DatabasePersistence(BasePersistence):
+    """Keeps user_data, chat_data and conversation states in the bot_persistence table.
+
+    Handling an update only pickles the changed data into an in-memory buffer. A
+    background thread writes the buffer in one batch every `flush_interval` seconds, so
+    persistence adds no database round trip per update. `flush` writes whatever is left
+    on shutdown.
+    """
+
+    def __init__(self, flush_interval=PERSISTENCE_FLUSH_SECONDS):
+        super().__init__(store_user_data=True, store_chat_data=True, store_bot_data=False)
+        self.flush_interval = flush_interval
+        self._stored = {}    # (kind, key) -> pickled data as it is in the database
+        self._flushing = {}  # (kind, key) -> pickled data being written right now
+        self._pending = {}   # (kind, key) -> pickled data to write, None to delete
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def _load(self, kind):
+        rows = database.load_persistence(kind)
+        with self._lock:
+            for key, data in rows.items():
+                self._stored[(kind, key)] = data
+        return {key: pickle.loads(data) for key, data in rows.items()}
+
+    def _write(self, kind, key, value):
+        # Ended conversations and emptied data are removed rather than stored
+        data = None if value is None or value == {} else pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        entry = (kind, key)
+        with self._lock:
+            # Most updates leave the data as it was, those are not written again
+            for latest in (self._pending, self._flushing, self._stored):
+                if entry in latest:
+                    if latest[entry] == data:
+                        return
+                    break
+            else:
+                if data is None:
+                    return
+
+            self._pending[entry] = data
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='persistence', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                self._flushing, self._pending = self._pending, {}
+                batch = self._flushing
+            if not batch:
+                return
+
+            try:
+                database.save_persistence([(kind, key, data) for (kind, key), data in batch.items()])
+            except Exception:
+                logger.exception(f"Could not persist {len(batch)} entries, retrying with the next flush")
+                with self._lock:
+                    for entry, data in batch.items():
+                        self._pending.setdefault(entry, data)
+                    self._flushing = {}
+                return
+
+            with self._lock:
+                for entry, data in batch.items():
+                    if data is None:
+                        self._stored.pop(entry, None)
+                    else:
+                        self._stored[entry] = data
+                self._flushing = {}
+
+    def get_user_data(self):
+        return defaultdict(dict, {int(key): data for key, data in self._load('user_data').items()})
+
+    def get_chat_data(self):
+        return defaultdict(dict, {int(key): data for key, data in self._load('chat_data').items()})
+
+    def get_bot_data(self):
+        return {}
+
+    def get_conversations(self, name):
+        return {tuple(json.loads(key)): state for key, state in self._load(f'conversation:{name}').items()}
+
+    def update_conversation(self, name, key, new_state):
+        self._write(f'conversation:{name}', json.dumps(key), new_state)
+
+    def update_user_data(self, user_id, data):
+        self._write('user_data', str(user_id), data)
+
+    def update_chat_data(self, chat_id, data):
+        self._write('chat_data', str(chat_id), data)
+
+    def update_bot_data(self, data):
+        pass
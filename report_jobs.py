@@ -0,0 +1,241 @@
+import os
+import time
+import logging
+import threading
+import collections
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import instrumentation
+import outbox
+
+# Logging setup
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+REPORT_WORKERS = int(os.environ.get('REPORT_WORKERS', 2))  # reports generated at the same time
+REPORT_JOBS_PER_USER = int(os.environ.get('REPORT_JOBS_PER_USER', 2))  # reports one user can wait for at once
+
+QUEUED_TEXT = "⏳ Отчет в очереди..."
+CANCELLED_TEXT = "❌ Формирование отчета отменено"
+FAILED_TEXT = "❌ Не удалось сформировать отчет. Попробуйте еще раз позже"
+
+
+class ReportCancelled(Exception):
+    """Raised inside a job once everyone waiting for it has cancelled."""
+
+
+class Requester:
+    __slots__ = ('user_id', 'chat_id', 'message_id')
+
+    def __init__(self, user_id, chat_id, message_id):
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.message_id = message_id
+
+
+class ReportJob:
+    def __init__(self, runner, bot, work, key, kind, start_date, end_date):
+        self.runner = runner
+        self.bot = bot
+        self.work = work
+        self.key = key
+        self.kind = kind
+        self.start_date = start_date
+        self.end_date = end_date
+        self.requesters = []
+        self.stage = QUEUED_TEXT
+        self.cancelled = False
+
+    def progress(self, text):
+        """Show `text` in every requester's placeholder, raises ReportCancelled if nobody waits any more."""
+        with self.runner._lock:
+            if self.cancelled:
+                raise ReportCancelled()
+            self.stage = text
+            requesters = list(self.requesters)
+        for requester in requesters:
+            self.runner._edit(self.bot, requester, text)
+
+    def deliver(self, text, document, filename, empty_text):
+        """Replace the placeholders with `text` and send `document`, or `empty_text` when it is None
+        (a report without a file passes None for both).
+
+        `document` is a file or the file_id of one sent before. Returns the file_id of the
+        sent document, None if there was none or nobody was waiting for it.
+        """
+        with self.runner._lock:
+            if self.cancelled:
+                raise ReportCancelled()
+            # From here on new requests for the same report start a job of their own
+            self.runner._forget(self)
+            requesters = list(self.requesters)
+
+        file_id = document if isinstance(document, str) else None
+        for requester in requesters:
+            self.runner._edit(self.bot, requester, text)
+            if document is None:
+                if empty_text is not None:
+                    outbox.send(self.bot.send_message, priority=outbox.CUSTOMER, chat_id=requester.chat_id, text=empty_text)
+            elif file_id is None:
+                # Upload once, everyone else gets the file Telegram already has
+                message = outbox.send(_rewinding(self.bot.send_document, document), priority=outbox.CUSTOMER,
+                                      chat_id=requester.chat_id, filename=filename).result()
+                file_id = message.document.file_id
+            else:
+                outbox.send(self.bot.send_document, priority=outbox.CUSTOMER, chat_id=requester.chat_id, document=file_id)
+        return file_id
+
+
+def _rewinding(send_document, document):
+    # The outbox may retry an upload, every attempt has to read the file from the start
+    @functools.wraps(send_document)
+    def send(**kwargs):
+        document.seek(0)
+        return send_document(document=document, **kwargs)
+    return send
+
+
+class ReportRunner:
+    """Generates reports on a worker pool of its own, off the update handlers.
+
+    Each request gets a placeholder message that shows the job's progress and is replaced
+    by the report when it is ready. Requests for a report that is already being generated
+    (same type and period) wait for that job instead of starting another one. A user can
+    wait for at most `per_user` reports at once, and `cancel` drops all of a user's
+    requests; a job nobody waits for any more stops at its next stage.
+    """
+
+    def __init__(self, workers, per_user):
+        self.workers = workers
+        self.per_user = per_user
+        self._jobs = {}  # key -> ReportJob not yet delivering
+        self._waiting = collections.Counter()  # user_id -> requests waiting for a report
+        self._completed = 0
+        self._cancelled = 0
+        self._failed = 0
+        self._durations = collections.deque(maxlen=instrumentation.METRICS_WINDOW)
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def submit(self, bot, work, key, kind, start_date, end_date, user_id, chat_id):
+        """Queue `work(job)` to build a report for `chat_id`. Returns False if the user is over the limit.
+
+        Requests with the same `key` share one job, it should be the key the report is cached under.
+        """
+        with self._lock:
+            if self._waiting[user_id] >= self.per_user:
+                return False
+            self._waiting[user_id] += 1
+
+        try:
+            placeholder = outbox.send(bot.send_message, priority=outbox.CUSTOMER, chat_id=chat_id, text=QUEUED_TEXT).result()
+        except Exception:
+            with self._lock:
+                self._release(user_id)
+            raise
+        requester = Requester(user_id, chat_id, placeholder.message_id)
+
+        with self._lock:
+            job = self._jobs.get(key)
+            joined = job is not None
+            if not joined:
+                job = self._jobs[key] = ReportJob(self, bot, work, key, kind, start_date, end_date)
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='reports')
+                self._executor.submit(self._run, job)
+            job.requesters.append(requester)
+            stage = job.stage
+
+        if joined:
+            logger.info(f"User {user_id} joined the running {kind} report for {start_date} - {end_date}")
+            if stage != QUEUED_TEXT:
+                self._edit(bot, requester, stage)
+        return True
+
+    def cancel(self, user_id):
+        """Drop every report request of `user_id`, returns how many there were."""
+        dropped = []
+        with self._lock:
+            for job in list(self._jobs.values()):
+                mine = [requester for requester in job.requesters if requester.user_id == user_id]
+                if not mine:
+                    continue
+                job.requesters = [requester for requester in job.requesters if requester.user_id != user_id]
+                for requester in mine:
+                    self._release(user_id)
+                    dropped.append((job.bot, requester))
+                if not job.requesters:
+                    job.cancelled = True
+                    self._forget(job)
+
+        for bot, requester in dropped:
+            self._edit(bot, requester, CANCELLED_TEXT)
+        return len(dropped)
+
+    def _run(self, job):
+        started = time.monotonic()
+        try:
+            job.work(job)
+        except ReportCancelled:
+            logger.info(f"Cancelled the {job.kind} report for {job.start_date} - {job.end_date}")
+            with self._lock:
+                self._cancelled += 1
+            return
+        except Exception:
+            logger.exception(f"Failed to generate the {job.kind} report for {job.start_date} - {job.end_date}")
+            with self._lock:
+                self._failed += 1
+                self._forget(job)
+                requesters = list(job.requesters)
+            for requester in requesters:
+                self._edit(job.bot, requester, FAILED_TEXT)
+        else:
+            with self._lock:
+                self._completed += 1
+                self._durations.append(time.monotonic() - started)
+        finally:
+            with self._lock:
+                for requester in job.requesters:
+                    self._release(requester.user_id)
+                job.requesters = []
+
+    def _forget(self, job):
+        if self._jobs.get(job.key) is job:
+            del self._jobs[job.key]
+
+    def _release(self, user_id):
+        self._waiting[user_id] -= 1
+        if self._waiting[user_id] <= 0:
+            del self._waiting[user_id]
+
+    def _edit(self, bot, requester, text):
+        outbox.send(bot.edit_message_text, priority=outbox.CUSTOMER, chat_id=requester.chat_id,
+                    message_id=requester.message_id, text=text)
+
+    def stats(self):
+        """Jobs in progress and finished, times in milliseconds."""
+        with self._lock:
+            durations = sorted(self._durations)
+            return {
+                'jobs': len(self._jobs),
+                'waiting': sum(self._waiting.values()),
+                'completed': self._completed,
+                'cancelled': self._cancelled,
+                'failed': self._failed,
+                'duration_p50_ms': instrumentation.percentile(durations, 50),
+                'duration_p95_ms': instrumentation.percentile(durations, 95),
+            }
+
+    def stop(self):
+        """Cancel whatever is queued and wait for the running jobs."""
+        with self._lock:
+            for job in self._jobs.values():
+                job.cancelled = True
+            self._jobs = {}
+            executor = self._executor
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+runner = ReportRunner(REPORT_WORKERS, REPORT_JOBS_PER_USER)
@@ -1,13 +1,17 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import MAX_MESSAGE_LENGTH
 from telegram.ext import CallbackContext, ConversationHandler
 import logging
 import re
 import traceback
 import datetime
 import database
-import csv
-import io
 import tempfile
+import report_jobs
+import cohorts
+import revenue
+import os
+from cache import PeriodCache
 from pytz import timezone
 from datetime import timedelta
 
@@ -20,6 +24,13 @@ logger = logging.getLogger(__name__)
 
 (START, INPUT_DATE, GENERATE_SALES_BOOK_REPORT, GENERATE_CLIENTS_BOOK_REPORT) = range(4)
 tz = timezone('Europe/Moscow')  # Change this to your actual timezone
+REPORT_SPOOL_SIZE = 1024 * 1024  # bytes of CSV kept in memory before spilling to a temp file
+REPORT_CACHE_TTL = float(os.environ.get('REPORT_CACHE_TTL', 900))  # picks up payments approved by other processes
+REPORT_SHIFT_HOURS = [int(hour) for hour in os.environ.get('REPORT_SHIFT_HOURS', '9,21').split(',')]  # Moscow hours shifts start at
+OPEN_PERIOD_SLACK = timedelta(minutes=5)  # a period ending this close to now runs until now
+
+# (report type, first day, last day) -> (stats text, file_id of the book or None)
+report_cache = PeriodCache(REPORT_CACHE_TTL)
 
 
 
@@ -28,6 +39,8 @@ def reports(update: Update, context: CallbackContext) -> int:
     keyboard = [
         [InlineKeyboardButton("💰 Отчет по продажам", callback_data='sales_book')],
         [InlineKeyboardButton("👤 Отчет по клиентам", callback_data='clients_book')],
+        [InlineKeyboardButton("📊 Когорты", callback_data='cohorts_book')],
+        [InlineKeyboardButton("🏆 Продавцы", callback_data='salesmen_book')],
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
@@ -88,6 +101,46 @@ def clients_book_report(update: Update, context: CallbackContext) -> None:
     )
     return INPUT_DATE
 
+def salesmen_report(update: Update, context: CallbackContext) -> int:
+    logger.info('salesmen_report called')
+    query = update.callback_query
+    query.answer()
+    context.user_data['report_type'] = 'salesmen'
+    logger.info(f"report_type set as: {context.user_data['report_type']}")
+
+    keyboard = [
+        [InlineKeyboardButton("Сегодня", callback_data='today'),
+        InlineKeyboardButton("Вчера", callback_data='yesterday')],
+        [InlineKeyboardButton("Текущий месяц", callback_data='this_month'),
+        InlineKeyboardButton("Текущая неделя", callback_data='this_week')],
+        [InlineKeyboardButton("30 дней", callback_data='30_days'),
+        InlineKeyboardButton("Задать свой период", callback_data='custom_period')]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    query.edit_message_text(
+        text="""🏆 Вы выбрали отчет по продавцам. 
+        
+👉🏻 Пожалуйста, выберите период для отчета или задайте свой период нажав на кнопку Задать свой период""",
+        reply_markup=reply_markup
+    )
+    return INPUT_DATE
+
+
+def cohorts_report(update: Update, context: CallbackContext) -> int:
+    # Cohorts cover all paid invoices, there is no period to choose
+    logger.info('cohorts_report called')
+    query = update.callback_query
+    query.answer()
+    query.edit_message_text(text="📊 Вы выбрали когортный отчет.")
+
+    submitted = report_jobs.runner.submit(context.bot, build_cohort_report, ('cohorts', None, None), 'cohorts', None, None,
+                                          update.effective_user.id, update.effective_chat.id)
+    if not submitted:
+        context.bot.send_message(chat_id=update.effective_chat.id, text=LIMIT_TEXT)
+    return ConversationHandler.END
+
+
 def set_today(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
     query.answer()
@@ -104,6 +157,8 @@ def set_today(update: Update, context: CallbackContext) -> int:
 
     if context.user_data['report_type'] == 'sales':
         return generate_sales_report(update, context)
+    elif context.user_data['report_type'] == 'salesmen':
+        return generate_salesmen_report(update, context)
     else:
         return generate_clients_report(update, context)
     return INPUT_DATE
@@ -122,6 +177,8 @@ def set_yesterday(update: Update, context: CallbackContext) -> int:
 
     if context.user_data['report_type'] == 'sales':
         return generate_sales_report(update, context)
+    elif context.user_data['report_type'] == 'salesmen':
+        return generate_salesmen_report(update, context)
     else:
         return generate_clients_report(update, context)
     return INPUT_DATE
@@ -141,6 +198,8 @@ def set_this_month(update: Update, context: CallbackContext) -> int:
 
     if context.user_data['report_type'] == 'sales':
         return generate_sales_report(update, context)
+    elif context.user_data['report_type'] == 'salesmen':
+        return generate_salesmen_report(update, context)
     else:
         return generate_clients_report(update, context)
     return INPUT_DATE
@@ -161,6 +220,8 @@ def set_this_week(update: Update, context: CallbackContext) -> int:
 
     if context.user_data['report_type'] == 'sales':
         return generate_sales_report(update, context)
+    elif context.user_data['report_type'] == 'salesmen':
+        return generate_salesmen_report(update, context)
     else:
         return generate_clients_report(update, context)
     return INPUT_DATE
@@ -181,6 +242,8 @@ def set_30_days(update: Update, context: CallbackContext) -> int:
 
     if context.user_data['report_type'] == 'sales':
         return generate_sales_report(update, context)
+    elif context.user_data['report_type'] == 'salesmen':
+        return generate_salesmen_report(update, context)
     else:
         return generate_clients_report(update, context)
     return INPUT_DATE
@@ -232,54 +295,38 @@ def input_date(update: Update, context: CallbackContext) -> int:
     elif report_type == 'clients':
         logger.info('Report type is clients, transitioning to GENERATE_CLIENTS_BOOK_REPORT')
         return generate_clients_report(update, context)
+    elif report_type == 'salesmen':
+        logger.info('Report type is salesmen')
+        return generate_salesmen_report(update, context)
     else:
         logger.info('Report type is unknown')
         return ConversationHandler.END
         
 
 def calculate_report_stats(start_date, end_date):
-    total_income = database.get_total_income(start_date, end_date)
-    deal_quantity = database.get_deal_quantity(start_date, end_date)
-    unique_customers = database.get_unique_customers(start_date, end_date)
-    new_customers = database.get_new_customers(start_date, end_date)
-    new_customers_income = database.get_income_from_new_customers(start_date, end_date)
-    incoming_deal_quantity = database.get_incoming_deal_quantity(start_date, end_date)
-    outgoing_deal_quantity = database.get_outgoing_deal_quantity(start_date, end_date)
-    total_amount_incoming = database.get_total_amount_incoming(start_date, end_date)
-    total_amount_outgoing = database.get_total_amount_outgoing(start_date, end_date)
-    average_deal_amount = database.get_average_deal_amount(start_date, end_date)
-
-    return {
-        "total_income": total_income,
-        "deal_quantity": deal_quantity,
-        "unique_customers": unique_customers,
-        "new_customers": new_customers,
-        "new_customers_income": new_customers_income,
-        "incoming_deal_quantity": incoming_deal_quantity,
-        "outgoing_deal_quantity": outgoing_deal_quantity,
-        "total_amount_incoming": total_amount_incoming,
-        "total_amount_outgoing": total_amount_outgoing,
-        "average_deal_amount": average_deal_amount
-    }
+    # Whole days of the last month are summed from the in-memory totals
+    start, end, _ = report_period(start_date, end_date)
+    if not isinstance(start, datetime.datetime) and not isinstance(end, datetime.datetime):
+        stats = revenue.totals.stats(start, end)
+        if stats is not None:
+            return stats
 
+    # Single query and connection for the whole stats block
+    return database.get_report_stats(start_date, end_date)
 
 
-def generate_sales_report(update, context):
-    # Ensure dates have been set in user_data.
-    logger.info("generate_sales_report called")
-    if 'start_date' not in context.user_data or 'end_date' not in context.user_data:
-        update.message.reply_text("Error: Report dates not specified")
-        return ConversationHandler.END
 
-    # New Message Here
-    context.bot.send_message(chat_id=update.effective_chat.id, text="⏳ Отчет загружается...")
+REPORT_BOOKS = {
+    'sales': database.generate_sales_book_report,
+    'clients': database.generate_clients_book_report,
+}
+NO_DATA_TEXT = 'Нет данных для отчета в заданный период. Попробуйте другие даты'
+NO_COHORTS_TEXT = 'Нет оплаченных счетов для когортного отчета'
+LIMIT_TEXT = '⏳ У вас уже формируются отчеты. Дождитесь их или отмените командой /cancel'
 
-    start_date = context.user_data['start_date']
-    end_date = context.user_data['end_date']
-    stats = calculate_report_stats(start_date, end_date)
-    context.bot.send_message(
-    chat_id=update.effective_chat.id, 
-    text=f"""✅ Отчет готов! 
+
+def format_report_stats(start_date, end_date, stats):
+    return f"""✅ Отчет готов! 
 Период: {start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}
         
 💰 Доход за период: {stats['total_income']} рублей
@@ -293,99 +340,164 @@ def generate_sales_report(update, context):
 🗄️ Входящих / Исходящих: 📥 {stats['incoming_deal_quantity']} /  📤 {stats['outgoing_deal_quantity']}
 ↘️ Сумма входящих: {stats['total_amount_incoming']} рублей
 ↗️ Сумма исходящих: {stats['total_amount_outgoing']} рублей"""
-)
-
 
-    report_data = database.generate_sales_book_report(start_date, end_date)
 
-    logger.info(f'report_data: {report_data}')  
+def report_period(start_date, end_date):
+    """Normalized (start, end) of a report period and the last day it covers.
 
-
-    if report_data:
-    # Create a temporary file
-        with tempfile.NamedTemporaryFile(mode='w+', delete=False) as tmp_file:
-        # Create a CSV writer
-            writer = csv.writer(tmp_file)
-
-        # Write the header row
-            header_row = ["Invoice ID", "Amount", "Date", "Name", "Username", "User ID", "In/Out"]
-            writer.writerow(header_row)
-
-        # Write the data rows
-            for row in report_data:
-                writer.writerow(row)
-
-        # Get the file path
-            file_path = tmp_file.name
-
-    # Send the CSV file
-        with open(file_path, 'rb') as doc:
-            context.bot.send_document(chat_id=update.effective_chat.id, document=doc, filename='sales_report.csv')
-
-        return ConversationHandler.END
+    Whole days are reduced to dates, so every press of a preset maps to the same key. A
+    period ending now covers its last day completely: only invoices that become paid
+    change a report, and those invalidate the cache.
+    """
+    start = start_date.date() if start_date.time() == datetime.time() else start_date
+    if end_date >= datetime.datetime.now(tz) - OPEN_PERIOD_SLACK or end_date.time() >= datetime.time(23, 59, 59):
+        end = end_date.date()
     else:
-        logger.info('No data available for the selected period')
-        update.message.reply_text('Нет данных для отчета в заданный период. Попробуйте другие даты')
-        return ConversationHandler.END
-
-
-
-def generate_clients_report(update, context):
-    logger.info("generate_clients_report called")
+        end = end_date
+    return start, end, end_date.date()
+
+
+def invalidate_reports(change):
+    # An invoice counted on some day can change the first purchase of its customer on any
+    # later day, so reports reaching that day or later are dropped
+    report_cache.invalidate_from(database.moscow_date(change['date']))
+
+
+def build_report(job):
+    # Runs on the report workers, see report_jobs.ReportRunner
+    # job.key is the cache key, see submit_report
+    _, _, last_day = report_period(job.start_date, job.end_date)
+    cached, generation = report_cache.get(job.key)
+    if cached is not None:
+        text, file_id = cached
+        job.deliver(text, file_id, f'{job.kind}_report.csv', NO_DATA_TEXT)
+        return
+
+    job.progress("⏳ Считаю показатели...")
+    stats = calculate_report_stats(job.start_date, job.end_date)
+    text = format_report_stats(job.start_date, job.end_date, stats)
+
+    job.progress("⏳ Выгружаю сделки...")
+    # Stream the book into a spooled buffer, it only touches the disk for very large periods
+    with tempfile.SpooledTemporaryFile(max_size=REPORT_SPOOL_SIZE) as report_file:
+        row_count = REPORT_BOOKS[job.kind](job.start_date, job.end_date, report_file)
+
+        job.progress("📤 Отправляю отчет...")
+        report_file.seek(0)
+        file_id = job.deliver(text, report_file if row_count else None, f'{job.kind}_report.csv', NO_DATA_TEXT)
+
+    if file_id is not None or not row_count:
+        report_cache.put(job.key, last_day, (text, file_id), generation)
+
+
+def build_cohort_report(job):
+    # Runs on the report workers, any payment changes it
+    cached, generation = report_cache.get(job.key)
+    if cached is not None:
+        text, file_id = cached
+        job.deliver(text, file_id, 'cohorts_report.xlsx', NO_COHORTS_TEXT)
+        return
+
+    job.progress("⏳ Выгружаю оплаченные счета...")
+    with tempfile.SpooledTemporaryFile(max_size=REPORT_SPOOL_SIZE) as invoices_file, \
+            tempfile.SpooledTemporaryFile(max_size=REPORT_SPOOL_SIZE) as report_file:
+        database.export_paid_invoices(invoices_file)
+        invoices_file.seek(0)
+
+        job.progress("⏳ Считаю когорты...")
+        now = datetime.datetime.now(tz)
+        totals = cohorts.build_cohort_workbook(invoices_file, report_file, now.year * 12 + now.month - 1)
+        text = "✅ Когортный отчет готов!" if totals is None else f"""✅ Когортный отчет готов!
+
+📅 Когорт (месяцев первой покупки): {totals['cohorts']}
+👤 Покупателей: {totals['customers']}
+🔁 Доля повторных покупателей: {totals['repeat_rate']:.1%}
+💰 LTV: {totals['ltv']} рублей"""
+
+        job.progress("📤 Отправляю отчет...")
+        report_file.seek(0)
+        file_id = job.deliver(text, report_file if totals else None, 'cohorts_report.xlsx', NO_COHORTS_TEXT)
+
+    if file_id is not None or totals is None:
+        report_cache.put(job.key, datetime.date.max, (text, file_id), generation)
+
+
+def format_approval_time(seconds):
+    if seconds is None:
+        return "—"
+    if seconds < 3600:
+        return f"{round(seconds / 60)} мин"
+    return f"{seconds / 3600:.1f} ч"
+
+
+def format_salesman_row(row):
+    _, _, created, paid, declined, revenue, approval_seconds = row
+    average = round(revenue / paid) if paid else 0
+    conversion = round(100 * paid / created) if created else 0
+    return (f"💰 {revenue} руб. · 🔢 {paid} сделок · 🧾 {average} руб.\n"
+            f"      ✅ {conversion}% из {created} счетов, ❌ {declined} · ⏱ {format_approval_time(approval_seconds)}")
+
+
+MEDALS = {1: '🥇', 2: '🥈', 3: '🥉'}
+
+
+def format_salesman_stats(start_date, end_date, rows):
+    totals = sorted((row for row in rows if row[1] is None), key=lambda row: row[5], reverse=True)
+    shifts = {}
+    for row in sorted((row for row in rows if row[1] is not None), key=lambda row: row[1]):
+        shifts.setdefault(row[0], []).append(row)
+
+    text = f"🏆 Продавцы за период {start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}"
+    for place, row in enumerate(totals, 1):
+        medal = MEDALS.get(place, f'{place}.')
+        lines = [f"{medal} {row[0] or 'Без продавца'}", "   " + format_salesman_row(row)]
+        for shift_row in shifts.get(row[0], []):
+            lines.append(f"   🕘 Смена {shift_row[1]}: " + format_salesman_row(shift_row))
+        block = "\n\n" + "\n".join(lines)
+        if len(text) + len(block) > MAX_MESSAGE_LENGTH:
+            break
+        text += block
+    return text
+
+
+def build_salesmen_report(job):
+    # Runs on the report workers. Not cached: new and declined invoices change it too,
+    # and those do not notify the report cache.
+    job.progress("⏳ Считаю показатели продавцов...")
+    rows = database.get_salesman_stats(job.start_date, job.end_date, REPORT_SHIFT_HOURS)
+    if not rows:
+        job.deliver(NO_DATA_TEXT, None, None, None)
+        return
+    job.deliver(format_salesman_stats(job.start_date, job.end_date, rows), None, None, None)
+
+
+def submit_report(update, context, report_type, work=build_report):
     # Ensure dates have been set in user_data.
     if 'start_date' not in context.user_data or 'end_date' not in context.user_data:
-        update.message.reply_text("Error: Report dates not specified")
+        update.effective_message.reply_text("Error: Report dates not specified")
         return ConversationHandler.END
 
-    # New Message Here
-    context.bot.send_message(chat_id=update.effective_chat.id, text="⏳ Отчет загружается...")
-
     start_date = context.user_data['start_date']
     end_date = context.user_data['end_date']
-    stats = calculate_report_stats(start_date, end_date)
-    context.bot.send_message(
-    chat_id=update.effective_chat.id, 
-    text=f"""✅ Отчет готов! 
-Период: {start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}
-        
-💰 Доход за период: {stats['total_income']} рублей
-🔢 Количество сделок: {stats['deal_quantity']}
-🧾 Средний чек: {stats['average_deal_amount']} рублей
-
-👤 Всего покупателей: {stats['unique_customers']}
-🆕 Новых покупателей: {stats['new_customers']}
-💸 Доход от новых покупателей: {stats['new_customers_income']} рублей
-
-🗄️ Входящих / Исходящих: 📥 {stats['incoming_deal_quantity']} /  📤 {stats['outgoing_deal_quantity']}
-↘️ Сумма входящих: {stats['total_amount_incoming']} рублей
-↗️ Сумма исходящих: {stats['total_amount_outgoing']} рублей"""
-)
-    
-
-    report_data = database.generate_clients_book_report(start_date, end_date)
+    # Same key as the cache, so a preset pressed twice joins the running job
+    start, end, _ = report_period(start_date, end_date)
+    submitted = report_jobs.runner.submit(context.bot, work, (report_type, start, end), report_type, start_date, end_date,
+                                          update.effective_user.id, update.effective_chat.id)
+    if not submitted:
+        context.bot.send_message(chat_id=update.effective_chat.id, text=LIMIT_TEXT)
+    return ConversationHandler.END
 
-    if report_data:
-    # Create a temporary file
-        with tempfile.NamedTemporaryFile(mode='w+', delete=False) as tmp_file:
-        # Create a CSV writer
-            writer = csv.writer(tmp_file)
 
-        # Write the header row
-            header_row = ["Client ID", "Username", "Name", "Date of First Deal", "Date of Last Deal", "Total Deals", "Total Amount"]
-            writer.writerow(header_row)
+def generate_sales_report(update, context):
+    logger.info("generate_sales_report called")
+    return submit_report(update, context, 'sales')
 
-        # Write the data rows
-            for row in report_data:
-                writer.writerow(row)
 
-        # Get the file path
-            file_path = tmp_file.name
+def generate_clients_report(update, context):
+    logger.info("generate_clients_report called")
+    return submit_report(update, context, 'clients')
 
-    # Send the CSV file
-        with open(file_path, 'rb') as doc:
-            context.bot.send_document(chat_id=update.effective_chat.id, document=doc, filename='clients_report.csv')
 
-        return ConversationHandler.END
-    else:
-        update.message.reply_text('Нет данных для отчета в заданный пероид. Попробуйте другие даты')
-        return ConversationHandler.END
+def generate_salesmen_report(update, context):
+    logger.info("generate_salesmen_report called")
+    return submit_report(update, context, 'salesmen', build_salesmen_report)
@@ -0,0 +1,179 @@
+import os
+import logging
+import threading
+import collections
+from datetime import datetime, timedelta
+import database
+
+# Logging setup
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+REVENUE_RECONCILE_MINUTES = int(os.environ.get('REVENUE_RECONCILE_MINUTES', 10))  # reload from the db, catches other processes' approvals
+LIVE_TOTALS_DAYS = 31  # today and the 30 days before, covers every report preset
+RECONCILE_ATTEMPTS = 3
+
+
+class DayTotals:
+    __slots__ = ('deals', 'revenue', 'incoming_deals', 'incoming_revenue', 'outgoing_deals', 'outgoing_revenue', 'buyers', 'spent')
+
+    def __init__(self):
+        self.deals = 0
+        self.revenue = 0
+        self.incoming_deals = 0
+        self.incoming_revenue = 0
+        self.outgoing_deals = 0
+        self.outgoing_revenue = 0
+        self.buyers = collections.Counter()  # user_id -> paid invoices that day
+        self.spent = collections.Counter()  # user_id -> revenue from them that day
+
+    def add(self, user_id, invoice_type, deals, revenue):
+        self.deals += deals
+        self.revenue += revenue
+        if invoice_type == 'Incoming':
+            self.incoming_deals += deals
+            self.incoming_revenue += revenue
+        elif invoice_type == 'Outgoing':
+            self.outgoing_deals += deals
+            self.outgoing_revenue += revenue
+        if user_id is not None:
+            self.buyers[user_id] += deals
+            self.spent[user_id] += revenue
+            if self.buyers[user_id] <= 0:
+                del self.buyers[user_id]
+                del self.spent[user_id]
+
+
+class LiveTotals:
+    """Running report totals per day for the last `days` days, kept in memory.
+
+    Approvals and status changes are applied as they are committed (see
+    database.invoice_listeners), so the stats of the report presets are summed from at
+    most a month of day totals without a query. Buyers are kept per day with their
+    number of paid invoices and what they paid, so unique buyers and the income from new
+    customers stay exact when a payment is reversed.
+    Everything is reloaded from the database on `start` and every `reconcile_minutes`,
+    which also picks up approvals made by other processes and moves the window at
+    midnight.
+    """
+
+    def __init__(self, days=LIVE_TOTALS_DAYS, reconcile_minutes=REVENUE_RECONCILE_MINUTES):
+        self.days = days
+        self.reconcile_minutes = reconcile_minutes
+        self._first_day = None  # None until loaded, then stats are answered from this day on
+        self._days = {}  # date -> DayTotals
+        self._customers = {}  # user_id -> first paid day, first purchases since _first_day
+        self._changes = 0
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def record(self, change):
+        """Apply one invoice change from database.invoice_listeners."""
+        day = database.moscow_date(change['date'])
+        with self._lock:
+            self._changes += 1
+            if self._first_day is None:
+                return
+            if day >= self._first_day:
+                self._days.setdefault(day, DayTotals()).add(
+                    change['user_id'], change['type'], change['delta'], change['delta'] * change['amount'])
+            self._set_customer(self._customers, self._first_day, change['user_id'], change['first_paid_at'])
+
+    @staticmethod
+    def _set_customer(customers, first_day, user_id, first_paid_at):
+        first_paid_day = database.moscow_date(first_paid_at) if first_paid_at is not None else None
+        if first_paid_day is not None and first_paid_day >= first_day:
+            customers[user_id] = first_paid_day
+        else:
+            customers.pop(user_id, None)
+
+    def reconcile(self):
+        """Replace the totals with the ones stored in the database."""
+        first_day = datetime.now(database.MOSCOW).date() - timedelta(days=self.days - 1)
+        start_date = database.MOSCOW.localize(datetime.combine(first_day, datetime.min.time()))
+
+        for attempt in range(RECONCILE_ATTEMPTS):
+            with self._lock:
+                changes = self._changes
+
+            day_rows, customer_rows = database.get_live_totals(start_date)
+            days = {}
+            for day, user_id, invoice_type, deals, revenue in day_rows:
+                days.setdefault(day, DayTotals()).add(user_id, invoice_type, deals, revenue)
+            customers = {}
+            for user_id, first_paid_at in customer_rows:
+                self._set_customer(customers, first_day, user_id, first_paid_at)
+
+            with self._lock:
+                # A change recorded while loading may or may not be in what was loaded
+                if self._changes == changes or attempt == RECONCILE_ATTEMPTS - 1:
+                    self._first_day, self._days, self._customers = first_day, days, customers
+                    break
+
+        logger.info(f"Loaded revenue totals for {len(days)} days since {first_day}")
+
+    def stats(self, first_day, last_day):
+        """Report stats for the whole days first_day..last_day, same as database.get_report_stats.
+
+        Returns None if the period starts before the tracked days.
+        """
+        with self._lock:
+            if self._first_day is None or first_day < self._first_day:
+                return None
+
+            new_customers = {user_id for user_id, first_paid_day in self._customers.items()
+                             if first_day <= first_paid_day <= last_day}
+            new_customers_income = 0
+
+            totals = DayTotals()
+            buyers = set()
+            for day, day_totals in self._days.items():
+                if first_day <= day <= last_day:
+                    totals.deals += day_totals.deals
+                    totals.revenue += day_totals.revenue
+                    totals.incoming_deals += day_totals.incoming_deals
+                    totals.incoming_revenue += day_totals.incoming_revenue
+                    totals.outgoing_deals += day_totals.outgoing_deals
+                    totals.outgoing_revenue += day_totals.outgoing_revenue
+                    buyers.update(day_totals.buyers)
+                    # Only what new customers paid within the period counts as their income
+                    new_customers_income += sum(revenue for user_id, revenue in day_totals.spent.items()
+                                                if user_id in new_customers)
+
+        return {
+            "total_income": totals.revenue,
+            "deal_quantity": totals.deals,
+            "unique_customers": len(buyers),
+            "new_customers": len(new_customers),
+            "new_customers_income": new_customers_income,
+            "incoming_deal_quantity": totals.incoming_deals,
+            "outgoing_deal_quantity": totals.outgoing_deals,
+            "total_amount_incoming": totals.incoming_revenue,
+            "total_amount_outgoing": totals.outgoing_revenue,
+            "average_deal_amount": round(totals.revenue / totals.deals, 2) if totals.deals else 0
+        }
+
+    def start(self):
+        try:
+            self.reconcile()
+        except Exception:
+            logger.exception("Could not load revenue totals, reports query the database until the next attempt")
+        self._thread = threading.Thread(target=self._run, name='revenue', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopping.wait(self.reconcile_minutes * 60):
+            try:
+                self.reconcile()
+            except Exception:
+                logger.exception("Could not reconcile revenue totals")
+
+
+totals = LiveTotals()
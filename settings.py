@@ -2,6 +2,7 @@ from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import CallbackContext, MessageHandler, Filters, CallbackQueryHandler, ConversationHandler
 import config
 import database
+import cashier
 import re
 
 MANAGE_PAYMENTS, CHOOSE_EDIT, ADD_CARD_NUMBER, ADD_CARD_BANK, CONFIRM_ADD_CARD, DELETE_CARD, CONFIRM_DELETE_CARD, \
@@ -199,6 +200,7 @@ def edit_salesman(update: Update, context: CallbackContext):
     
     # Set the selected salesman as the current active salesman in the database
     database.set_current_salesman(salesman_name)
+    cashier.inline_results.invalidate()  # cached invoice results show the salesman
 
     query.answer()
     query.edit_message_text(f'✅ Текущий продажник был изменен на : {salesman_name}')
@@ -262,6 +264,7 @@ def delete_salesman(update: Update, context: CallbackContext):
     query = update.callback_query
     salesman = query.data.split("_")[1]
     database.delete_salesman(salesman)
+    cashier.inline_results.invalidate()  # cached invoice results show the salesman
     query.answer()
     query.edit_message_text(f"🚮 Продажник {salesman} был удален из списка.")
     return ConversationHandler.END
@@ -330,5 +333,7 @@ conv_handler_payments_and_salesman = ConversationHandler(
         CallbackQueryHandler(cancel_manage_payments),
         CallbackQueryHandler(cancel_manage_salesman),
         MessageHandler(Filters.all, lambda u, c: ConversationHandler.END)
-    ]
+    ],
+    name='payments_and_salesman',
+    persistent=True
 )
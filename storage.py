@@ -0,0 +1,425 @@
+import os
+import re
+import csv
+import io
+import sqlite3
+import threading
+import collections
+import time
+import logging
+from datetime import datetime, date, timedelta
+from urllib.parse import urlparse
+import pytz
+import psycopg2
+from psycopg2 import sql
+from psycopg2 import extensions
+import instrumentation
+
+# Logging setup
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+DB_TIMEZONE = 'Europe/Moscow'
+
+# Connection pool settings, can be tuned per dyno through config vars
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 2))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))  # seconds to wait for a free connection
+DB_HEALTHCHECK_INTERVAL = float(os.environ.get('DB_HEALTHCHECK_INTERVAL', 60))  # ping connections idle for longer than this
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """Thread-safe pool of physical connections shared by the whole process.
+
+    Connections are opened lazily up to `maxconn`, handed out most recently used first
+    and pinged before reuse if they sat idle for longer than `healthcheck_interval`.
+    Broken connections are dropped and replaced with fresh ones.
+    """
+
+    def __init__(self, connect, minconn, maxconn, timeout=None, healthcheck_interval=60):
+        self._connect = connect
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+        self._idle = collections.deque()  # (conn, last_used) pairs
+        self._size = 0  # idle + checked out connections
+        self._cond = threading.Condition()
+
+    def prewarm(self):
+        for _ in range(self.minconn):
+            with self._cond:
+                if self._size >= self.minconn:
+                    return
+                self._size += 1
+            conn = self._open()
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def getconn(self):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+
+        while True:
+            with self._cond:
+                while not self._idle and self._size >= self.maxconn:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise PoolTimeout(f"No database connection available after {self.timeout} seconds")
+                    self._cond.wait(remaining)
+
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                else:
+                    self._size += 1
+                    conn, last_used = None, None
+
+            if conn is None:
+                return self._open()
+
+            if self._is_healthy(conn, last_used):
+                return conn
+
+            logger.warning("Dropping broken database connection from the pool")
+            self._discard(conn)
+
+    def putconn(self, conn):
+        if conn.closed:
+            self._discard(conn)
+            return
+
+        status = conn.info.transaction_status
+        if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+            # Server connection was lost
+            self._discard(conn)
+            return
+        if status != extensions.TRANSACTION_STATUS_IDLE:
+            # The caller did not commit, never leak an open transaction to the next user
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                self._discard(conn)
+                return
+
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            conn.close()
+
+    def _open(self):
+        try:
+            return self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.healthcheck_interval:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+
+class InstrumentedCursor(extensions.cursor):
+    """Cursor that reports query time and returned rows to the instrumentation registry."""
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            instrumentation.record_query(time.perf_counter() - start, self.rowcount)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            instrumentation.record_query(time.perf_counter() - start, self.rowcount)
+
+
+class PostgresBackend:
+    """Production backend: pooled psycopg2 connections."""
+
+    dialect = 'postgres'
+
+    def __init__(self, url):
+        self.url = url
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def _connect(self):
+        # The session timezone is sent as a startup option, so it is set once per
+        # physical connection without any extra round trips
+        return psycopg2.connect(self.url, sslmode='require', options=f'-c timezone={DB_TIMEZONE}',
+                                cursor_factory=InstrumentedCursor)
+
+    def get_pool(self):
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    pool = ConnectionPool(self._connect, DB_POOL_MIN, DB_POOL_MAX,
+                                          timeout=DB_POOL_TIMEOUT, healthcheck_interval=DB_HEALTHCHECK_INTERVAL)
+                    pool.prewarm()
+                    self._pool = pool
+                    logger.info(f"Database pool ready: min={DB_POOL_MIN}, max={DB_POOL_MAX}, timezone={DB_TIMEZONE}")
+        return self._pool
+
+    def getconn(self):
+        return self.get_pool().getconn()
+
+    def putconn(self, conn):
+        self.get_pool().putconn(conn)
+
+    def copy_to_csv(self, cur, query, params, file):
+        # COPY streams rows from the server straight into the file, so memory use
+        # does not depend on the size of the result
+        copy_sql = "COPY ({}) TO STDOUT WITH (FORMAT CSV, HEADER)".format(cur.mogrify(query, params).decode())
+        cur.copy_expert(copy_sql, file)
+        return cur.rowcount
+
+    def table_exists(self, cur, table):
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL", (table,))
+        return cur.fetchone()[0]
+
+    def lock_for_migration(self, cur, lock_id):
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (lock_id,))
+
+    def lock_tables(self, cur, *tables):
+        # Writers to these tables wait until the caller commits, readers are not blocked
+        cur.execute("LOCK TABLE {} IN EXCLUSIVE MODE".format(', '.join(tables)))
+
+
+# --- SQLite ---------------------------------------------------------------------------
+# Used for local runs, load tests and report benchmarks. Timestamps are stored as text in
+# Moscow time with a fixed format, so they sort and compare like TIMESTAMPTZ values.
+
+MOSCOW = pytz.timezone(DB_TIMEZONE)
+SQLITE_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f%z'
+SQLITE_TIMESTAMP_RE = re.compile(r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d{6}[+-]\d{4}$')
+SQLITE_DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+SQLITE_PARAM_RE = re.compile(r'%\((\w+)\)s|%s|%%')
+
+
+def _sqlite_timestamp(value):
+    if value.tzinfo is None:
+        value = MOSCOW.localize(value)
+    return value.astimezone(MOSCOW).strftime(SQLITE_TIMESTAMP_FORMAT)
+
+
+def _sqlite_value(value):
+    if isinstance(value, str):
+        if SQLITE_TIMESTAMP_RE.match(value):
+            return datetime.strptime(value, SQLITE_TIMESTAMP_FORMAT).astimezone(MOSCOW)
+        if SQLITE_DATE_RE.match(value):
+            return date.fromisoformat(value)
+    return value
+
+
+def _sqlite_query(query):
+    if isinstance(query, sql.SQL):
+        query = query.string
+
+    def replace(match):
+        if match.group(1):
+            return ':' + match.group(1)
+        return '?' if match.group(0) == '%s' else '%'
+
+    return SQLITE_PARAM_RE.sub(replace, query)
+
+
+def _sqlite_greatest(*values):
+    values = [v for v in values if v is not None]
+    return max(values) if values else None
+
+
+def _sqlite_least(*values):
+    values = [v for v in values if v is not None]
+    return min(values) if values else None
+
+
+def _sqlite_to_char(value, fmt):
+    # Only the patterns used by the reports
+    if value is None:
+        return None
+    value = _sqlite_value(value)
+    for pattern, directive in (('YYYY', '%Y'), ('HH24', '%H'), ('MM', '%m'), ('DD', '%d'), ('MI', '%M'), ('SS', '%S')):
+        fmt = fmt.replace(pattern, directive)
+    return value.strftime(fmt)
+
+
+def _sqlite_seconds_between(start, end):
+    if start is None or end is None:
+        return None
+    return (_sqlite_value(end) - _sqlite_value(start)).total_seconds()
+
+
+def _sqlite_seconds_after(value, seconds):
+    # value + seconds * INTERVAL '1 second'
+    if value is None or seconds is None:
+        return None
+    return _sqlite_timestamp(_sqlite_value(value) + timedelta(seconds=seconds))
+
+
+class _SQLiteMedian:
+    # percentile_cont(0.5) WITHIN GROUP (ORDER BY value), NULLs are ignored
+    def __init__(self):
+        self.values = []
+
+    def step(self, value):
+        if value is not None:
+            self.values.append(value)
+
+    def finalize(self):
+        if not self.values:
+            return None
+        values = sorted(self.values)
+        middle = len(values) // 2
+        return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+
+class SQLiteCursor(sqlite3.Cursor):
+    """psycopg2 style cursor: %s / %(name)s placeholders, timestamps come back as datetimes."""
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(_sqlite_query(query), vars if vars is not None else ())
+        finally:
+            instrumentation.record_query(time.perf_counter() - start, self.rowcount)
+
+    def fetchone(self):
+        row = super().fetchone()
+        return None if row is None else tuple(_sqlite_value(value) for value in row)
+
+    def fetchall(self):
+        return [tuple(_sqlite_value(value) for value in row) for row in super().fetchall()]
+
+
+class SQLiteConnection(sqlite3.Connection):
+    def cursor(self, factory=SQLiteCursor):
+        return super().cursor(factory)
+
+
+class SQLiteBackend:
+    """Embedded backend with the same schema and behaviour as Postgres.
+
+    `path` is a file name or ':memory:'. Every thread gets its own connection, an in-memory
+    database is shared between them through SQLite's shared cache.
+    """
+
+    dialect = 'sqlite'
+
+    def __init__(self, path):
+        if path == ':memory:':
+            self.database = f'file:brutalbot-{id(self)}?mode=memory&cache=shared'
+        else:
+            self.database = f'file:{path}'
+        self._local = threading.local()
+        self._keeper = None
+
+        sqlite3.register_adapter(datetime, _sqlite_timestamp)
+        sqlite3.register_adapter(date, date.isoformat)
+
+        if path == ':memory:':
+            # The in-memory database lives as long as one connection to it is open
+            self._keeper = self._connect()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, uri=True, timeout=30, factory=SQLiteConnection, check_same_thread=False)
+        conn.execute("PRAGMA foreign_keys = ON")
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.create_function('NOW', 0, lambda: _sqlite_timestamp(datetime.now(MOSCOW)))
+        conn.create_function('GREATEST', -1, _sqlite_greatest)
+        conn.create_function('LEAST', -1, _sqlite_least)
+        conn.create_function('to_char', 2, _sqlite_to_char)
+        conn.create_function('seconds_between', 2, _sqlite_seconds_between)
+        conn.create_function('seconds_after', 2, _sqlite_seconds_after)
+        conn.create_aggregate('median', 1, _SQLiteMedian)
+        return conn
+
+    def getconn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def putconn(self, conn):
+        # Same contract as the Postgres pool: never leak an open transaction
+        if conn.in_transaction:
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                # Unusable, the thread opens a fresh connection next time
+                logger.warning("Dropping broken SQLite connection")
+                self._local.conn = None
+                conn.close()
+
+    def copy_to_csv(self, cur, query, params, file):
+        cur.execute(query, params)
+        text = io.TextIOWrapper(file, encoding='utf-8', newline='', write_through=True)
+        writer = csv.writer(text)
+        writer.writerow([column[0] for column in cur.description])
+
+        row_count = 0
+        rows = cur.fetchmany(1000)
+        while rows:
+            writer.writerows(rows)
+            row_count += len(rows)
+            rows = cur.fetchmany(1000)
+
+        # Leave the caller's file open
+        text.detach()
+        return row_count
+
+    def table_exists(self, cur, table):
+        cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = %s", (table,))
+        return cur.fetchone()[0] > 0
+
+    def lock_for_migration(self, cur, lock_id):
+        cur.execute("BEGIN IMMEDIATE")
+
+    def lock_tables(self, cur, *tables):
+        # SQLite has a single writer, taking the write lock up front is the equivalent
+        cur.execute("BEGIN IMMEDIATE")
+
+
+def backend_from_url(url):
+    """sqlite:///relative.db, sqlite:////absolute.db or sqlite:// (in memory) selects SQLite,
+    anything else is Postgres."""
+    if url.startswith('sqlite:'):
+        path = urlparse(url).path[1:]
+        return SQLiteBackend(path or ':memory:')
+    return PostgresBackend(url)
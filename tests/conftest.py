@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# database.py reads DATABASE_URL on import, the tests run against the embedded SQLite backend
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
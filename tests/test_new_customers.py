@@ -0,0 +1,77 @@
+from datetime import datetime, time, timedelta
+
+import pytest
+
+import database
+import migrations
+import revenue
+
+
+def day_bounds(day):
+    start = database.MOSCOW.localize(datetime.combine(day, time.min))
+    return start, start + timedelta(days=1) - timedelta(microseconds=1)
+
+
+def add_paid_invoice(invoice_id, user_id, amount, day):
+    paid_at = database.MOSCOW.localize(datetime.combine(day, time(12)))
+    with database.connection() as (conn, cur):
+        cur.execute(
+            "INSERT INTO invoices (invoice_id, amount, name, username, user_id, product, date, salesman) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
+            (invoice_id, amount, f'user {user_id}', f'user{user_id}', user_id, 'VIP', paid_at, 'Ivan')
+        )
+        conn.commit()
+    assert database.approve_invoice(invoice_id, 'Incoming') is not None
+
+
+@pytest.fixture
+def days():
+    migrations.migrate()
+    with database.connection() as (conn, cur):
+        for table in ('invoices', 'customers', 'daily_sales_rollup'):
+            cur.execute(f"DELETE FROM {table}")
+        conn.commit()
+
+    today = datetime.now(database.MOSCOW).date()
+    return today - timedelta(days=10), today - timedelta(days=3)
+
+
+def test_new_customer_income_is_limited_to_the_period(days):
+    first_day, second_day = days
+    add_paid_invoice(1, 101, 100, first_day)
+    add_paid_invoice(2, 101, 250, second_day)  # repeat purchase of the same customer
+    add_paid_invoice(3, 102, 40, second_day)
+
+    first = database.get_report_stats(*day_bounds(first_day))
+    assert (first['new_customers'], first['new_customers_income']) == (1, 100)
+    assert database.get_income_from_new_customers(*day_bounds(first_day)) == 100
+
+    second = database.get_report_stats(*day_bounds(second_day))
+    assert (second['new_customers'], second['new_customers_income']) == (1, 40)
+    assert database.get_income_from_new_customers(*day_bounds(second_day)) == 40
+
+    both = database.get_report_stats(day_bounds(first_day)[0], day_bounds(second_day)[1])
+    assert (both['new_customers'], both['new_customers_income']) == (2, 390)
+
+
+def test_live_totals_match_the_database(days):
+    first_day, second_day = days
+    add_paid_invoice(1, 101, 100, first_day)
+
+    totals = revenue.LiveTotals()
+    totals.reconcile()
+    database.invoice_listeners.append(totals.record)
+    try:
+        add_paid_invoice(2, 101, 250, second_day)
+        add_paid_invoice(3, 102, 40, second_day)
+    finally:
+        database.invoice_listeners.remove(totals.record)
+
+    for first, last in ((first_day, first_day), (second_day, second_day), (first_day, second_day)):
+        live = totals.stats(first, last)
+        stored = database.get_report_stats(day_bounds(first)[0], day_bounds(last)[1])
+        assert (live['new_customers'], live['new_customers_income']) == (stored['new_customers'], stored['new_customers_income'])
+    assert totals.stats(first_day, first_day)['new_customers_income'] == 100
+
+    totals.reconcile()
+    assert totals.stats(first_day, first_day)['new_customers_income'] == 100
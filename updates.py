@@ -0,0 +1,128 @@
+import time
+import logging
+import threading
+import collections
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+from telegram.ext import Dispatcher, ExtBot, JobQueue, Updater
+from telegram.utils.request import Request
+import config
+import instrumentation
+
+# Logging setup
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+def ordering_key(update):
+    """Updates with the same key are handled one at a time, in arrival order."""
+    chat = getattr(update, 'effective_chat', None)
+    if chat is not None:
+        return chat.id
+    # Inline queries and other chat-less updates are ordered per user
+    user = getattr(update, 'effective_user', None)
+    if user is not None:
+        return ('user', user.id)
+    return None
+
+
+class OrderedDispatcher(Dispatcher):
+    """Dispatcher that hands updates to a pool of `update_workers` threads.
+
+    Updates of different chats run in parallel, updates of one chat run strictly one
+    after another, so ConversationHandler state and chat_data see them in order.
+    With update_workers=0 updates are handled on the dispatcher thread as before.
+    """
+
+    def __init__(self, *args, update_workers=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.update_workers = update_workers
+        self._executor = ThreadPoolExecutor(update_workers, thread_name_prefix='update') if update_workers else None
+        self._chat_queues = {}  # ordering key -> deque of (update, queued_at) waiting for the chat's worker
+        self._pending = 0
+        self._processed = 0
+        self._waits = collections.deque(maxlen=instrumentation.METRICS_WINDOW)
+        self._durations = collections.deque(maxlen=instrumentation.METRICS_WINDOW)
+        self._chat_lock = threading.Lock()
+
+    def process_update(self, update):
+        if self._executor is None:
+            super().process_update(update)
+            return
+
+        key = ordering_key(update)
+        if key is None:
+            key = object()  # unordered, never shares a queue
+
+        with self._chat_lock:
+            self._pending += 1
+            chat_queue = self._chat_queues.get(key)
+            if chat_queue is not None:
+                # A worker is already draining this chat and will pick the update up
+                chat_queue.append((update, time.monotonic()))
+                return
+            self._chat_queues[key] = collections.deque([(update, time.monotonic())])
+
+        self._executor.submit(self._drain, key)
+
+    def _drain(self, key):
+        while True:
+            with self._chat_lock:
+                chat_queue = self._chat_queues[key]
+                if not chat_queue:
+                    del self._chat_queues[key]
+                    return
+                update, queued_at = chat_queue.popleft()
+                self._pending -= 1
+
+            started = time.monotonic()
+            try:
+                super().process_update(update)
+            except Exception:
+                logger.exception(f"Unhandled error while processing an update for {key}")
+            finished = time.monotonic()
+
+            with self._chat_lock:
+                self._processed += 1
+                self._waits.append(started - queued_at)
+                self._durations.append(finished - started)
+
+    def backlog(self):
+        """Updates received but not yet being handled."""
+        with self._chat_lock:
+            return self.update_queue.qsize() + self._pending
+
+    def stats(self):
+        """Queue depth and wait/processing times, times in milliseconds."""
+        with self._chat_lock:
+            pending, active_chats, processed = self._pending, len(self._chat_queues), self._processed
+            waits, durations = sorted(self._waits), sorted(self._durations)
+
+        return {
+            'workers': self.update_workers,
+            'intake_queue': self.update_queue.qsize(),
+            'pending': pending,
+            'active_chats': active_chats,
+            'processed': processed,
+            'wait_p50_ms': instrumentation.percentile(waits, 50),
+            'wait_p95_ms': instrumentation.percentile(waits, 95),
+            'wait_max_ms': instrumentation.percentile(waits, 100),
+            'handle_p50_ms': instrumentation.percentile(durations, 50),
+            'handle_p95_ms': instrumentation.percentile(durations, 95),
+        }
+
+    def stop(self):
+        super().stop()
+        if self._executor is not None:
+            # Let the workers finish what they already accepted
+            self._executor.shutdown(wait=True)
+
+
+def build_updater(token, persistence=None):
+    # One HTTP connection per update worker, plus the run_async workers, polling and jobs
+    request = Request(con_pool_size=config.UPDATE_WORKERS + 8)
+    bot = ExtBot(token, request=request)
+    dispatcher = OrderedDispatcher(bot, Queue(), job_queue=JobQueue(), persistence=persistence, use_context=True,
+                                   update_workers=config.UPDATE_WORKERS)
+    # workers=None: the Updater's default of 4 is rejected together with a dispatcher
+    return Updater(dispatcher=dispatcher, workers=None)
@@ -0,0 +1,154 @@
+import json
+import hmac
+import signal
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from telegram import Update
+from telegram.error import TelegramError
+import config
+
+# Logging setup
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+MAX_BODY_SIZE = 1024 * 1024  # Telegram updates are a few KB, anything this big is not one
+RETRY_AFTER = 5  # seconds Telegram is asked to wait when the intake queue is full
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        # Health check for the load balancer / platform router
+        self._respond(200, b'ok')
+
+    def do_POST(self):
+        listener = self.server.listener
+
+        if self.path != listener.url_path:
+            self._respond(404)
+            return
+
+        # Telegram sends the token given to setWebhook with every request
+        secret = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(secret.encode(), listener.secret_token.encode()):
+            logger.warning(f"Rejected webhook request from {self.client_address[0]}: bad secret token")
+            self._respond(403)
+            return
+
+        length = int(self.headers.get('Content-Length') or 0)
+        if length <= 0 or length > MAX_BODY_SIZE:
+            self._respond(413 if length > 0 else 400)
+            return
+
+        try:
+            data = json.loads(self.rfile.read(length))
+            update = Update.de_json(data, listener.dispatcher.bot)
+        except ValueError as e:
+            logger.warning(f"Rejected malformed webhook update: {e}")
+            self._respond(400)
+            return
+
+        # A non-2xx answer makes Telegram keep the update and redeliver it later
+        if not listener.enqueue(update):
+            self._respond(503, headers={'Retry-After': str(RETRY_AFTER)})
+            return
+
+        self._respond(200)
+
+    def _respond(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class WebhookListener:
+    """HTTP endpoint that feeds verified updates to the dispatcher.
+
+    The dispatcher's backlog is the intake queue. It is capped at `queue_size` pending
+    updates: past that the listener answers 503 and Telegram retries later,
+    instead of the process buffering an unbounded backlog in memory.
+    """
+
+    def __init__(self, dispatcher, url_path, secret_token, queue_size):
+        self.dispatcher = dispatcher
+        self.url_path = url_path
+        self.secret_token = secret_token
+        self.queue_size = queue_size
+        self.accepting = False
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    def enqueue(self, update):
+        with self._lock:
+            if not self.accepting or self.dispatcher.backlog() >= self.queue_size:
+                return False
+            self.dispatcher.update_queue.put(update)
+            return True
+
+    def start(self, listen, port):
+        self._server = ThreadingHTTPServer((listen, port), WebhookRequestHandler)
+        self._server.daemon_threads = True
+        self._server.listener = self
+        self._thread = threading.Thread(target=self._server.serve_forever, name='webhook', daemon=True)
+        self._thread.start()
+        self.accepting = True
+        logger.info(f"Webhook listener running on {listen}:{port}{self.url_path}")
+
+    def stop(self):
+        # Refuse new updates first, so Telegram redelivers them to another process
+        self.accepting = False
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+
+def run(updater):
+    """Serve updates through the webhook until SIGINT/SIGTERM.
+
+    Returns False without consuming any updates when the webhook cannot be set up,
+    so the caller can fall back to long polling.
+    """
+    if not config.WEBHOOK_URL:
+        logger.error("WEBHOOK_URL is not set, falling back to polling")
+        return False
+
+    listener = WebhookListener(updater.dispatcher, config.WEBHOOK_PATH, config.WEBHOOK_SECRET, config.WEBHOOK_QUEUE_SIZE)
+    try:
+        listener.start(config.WEBHOOK_LISTEN, config.WEBHOOK_PORT)
+        updater.bot.set_webhook(
+            url=config.WEBHOOK_URL.rstrip('/') + config.WEBHOOK_PATH,
+            max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+            api_kwargs={'secret_token': config.WEBHOOK_SECRET},
+        )
+    except (OSError, TelegramError) as e:
+        logger.error(f"Could not start webhook mode, falling back to polling: {e}")
+        listener.stop()
+        return False
+
+    updater.job_queue.start()
+    dispatcher_thread = threading.Thread(target=updater.dispatcher.start, name='dispatcher')
+    dispatcher_thread.start()
+
+    stopping = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda signum, frame: stopping.set())
+    while not stopping.wait(1):
+        pass
+
+    logger.info("Stopping webhook listener...")
+    listener.stop()
+    updater.job_queue.stop()
+    updater.dispatcher.stop()
+    dispatcher_thread.join()
+    return True